@@ -0,0 +1,130 @@
+# 调试产物 (截图 / HTML 快照) 采集
+# Debug artifact (screenshot / HTML snapshot) capture
+#
+# 失败请求和"无链接"页面不再无条件保存整页截图，而是按采样率和预算采集，
+# 写盘在后台线程中完成，目录按文件数量轮转。
+
+import asyncio
+import gzip
+import logging
+import os
+import random
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class ArtifactCapture:
+    """
+    按采样率、单次运行的数量/字节预算采集调试产物。
+    - 截图默认只截视口 (ARTIFACTS_FULL_PAGE = False)，可选 JPEG 压缩。
+    - HTML 快照以 gzip 压缩保存。
+    - 写盘通过单线程执行器异步完成，挂起的写任务数量有上限。
+    - 产物目录中的文件数量超过 ARTIFACTS_DIR_MAX_FILES 时删除最旧的文件。
+    """
+    def __init__(self, settings):
+        self.enabled = settings.getbool('ARTIFACTS_ENABLED', True)
+        self.base_dir = settings.get('ARTIFACTS_DIR', 'artifacts')
+        # 每种产物类型的采样率 (0~1)，未列出的类型使用默认值
+        self.sample_rates = settings.getdict('ARTIFACTS_SAMPLE_RATES', {})
+        self.default_sample_rate = settings.getfloat('ARTIFACTS_SAMPLE_RATE', 0.1)
+        self.max_count = settings.getint('ARTIFACTS_MAX_COUNT', 50) # 单次运行最多采集次数 (0 表示不限)
+        self.max_bytes = settings.getint('ARTIFACTS_MAX_BYTES', 100 * 1024 * 1024) # 单次运行最多写入字节数 (0 表示不限)
+        self.capture_screenshot = settings.getbool('ARTIFACTS_SCREENSHOT', True)
+        self.capture_html = settings.getbool('ARTIFACTS_HTML', True)
+        self.full_page = settings.getbool('ARTIFACTS_FULL_PAGE', False)
+        self.screenshot_type = settings.get('ARTIFACTS_SCREENSHOT_TYPE', 'jpeg') # 'jpeg' 或 'png'
+        self.screenshot_quality = settings.getint('ARTIFACTS_SCREENSHOT_QUALITY', 60) # 仅对 jpeg 生效
+        self.dir_max_files = settings.getint('ARTIFACTS_DIR_MAX_FILES', 500)
+        self.max_pending_writes = settings.getint('ARTIFACTS_MAX_PENDING_WRITES', 8)
+
+        self.captured_count = 0 # 已采集次数
+        self.bytes_written = 0 # 已写入 (或已排队写入) 的字节数
+        self.skipped_count = 0 # 因采样 / 预算 / 队列满而跳过的次数
+        self.pending_writes = 0
+        self._dir_files = None # 产物目录中的文件 (按时间从旧到新)，在写线程中懒加载
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='artifacts')
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings)
+
+    def _budget_exhausted(self):
+        if self.max_count and self.captured_count >= self.max_count: return True
+        if self.max_bytes and self.bytes_written >= self.max_bytes: return True
+        return False
+
+    def should_capture(self, kind):
+        """在触碰浏览器之前判断是否需要采集 (采样 + 预算 + 写队列)。"""
+        if not self.enabled or not (self.capture_screenshot or self.capture_html): return False
+        rate = float(self.sample_rates.get(kind, self.default_sample_rate))
+        if rate <= 0 or (rate < 1 and random.random() >= rate):
+            self.skipped_count += 1; return False
+        if self._budget_exhausted():
+            self.skipped_count += 1
+            logger.debug(f"调试产物预算已用尽 (次数: {self.captured_count}, 字节: {self.bytes_written})，跳过采集 [{kind}]")
+            return False
+        if self.pending_writes >= self.max_pending_writes:
+            self.skipped_count += 1
+            logger.debug(f"调试产物写队列已满 ({self.pending_writes})，跳过采集 [{kind}]")
+            return False
+        return True
+
+    async def capture(self, page, kind, label=None):
+        """
+        采集页面截图和 HTML 快照，并异步写入产物目录。
+        page: Playwright Page 对象；kind: 产物类型 (如 'error', 'nolinks')；label: 用于文件名的附加标识。
+        """
+        if page is None or page.is_closed() or not self.should_capture(kind): return
+        self.captured_count += 1 # 先占用预算，避免并发回调同时越过上限
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        stem = f"{kind}_{timestamp}"
+        if label: stem += '_' + re.sub(r'[^A-Za-z0-9_.-]+', '_', str(label))[:80]
+
+        files = [] # [(文件名, 原始字节, 是否需要 gzip 压缩)]
+        if self.capture_html:
+            try:
+                html_content = await page.content()
+                files.append((f"{stem}.html.gz", html_content.encode('utf-8'), True))
+            except Exception as e: logger.error(f"获取页面 HTML 失败 [{kind}]: {e}")
+        if self.capture_screenshot:
+            try:
+                screenshot_kwargs = {'full_page': self.full_page, 'type': self.screenshot_type}
+                if self.screenshot_type == 'jpeg': screenshot_kwargs['quality'] = self.screenshot_quality
+                image_bytes = await page.screenshot(**screenshot_kwargs)
+                files.append((f"{stem}.{'jpg' if self.screenshot_type == 'jpeg' else 'png'}", image_bytes, False))
+            except Exception as e: logger.error(f"页面截图失败 [{kind}]: {e}")
+        if not files: return
+
+        self.bytes_written += sum(len(data) for _, data, _ in files) # 按未压缩大小计入预算 (保守估计)
+        self.pending_writes += 1
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self._write_files, files)
+        future.add_done_callback(self._write_done)
+        logger.info(f"已排队保存调试产物 [{kind}]: {', '.join(name for name, _, _ in files)}")
+
+    def _write_done(self, future):
+        self.pending_writes -= 1
+        if future.exception(): logger.error(f"写入调试产物失败: {future.exception()}")
+
+    def _write_files(self, files):
+        # 在写线程中执行：压缩、写盘、轮转
+        os.makedirs(self.base_dir, exist_ok=True)
+        if self._dir_files is None:
+            existing = [os.path.join(self.base_dir, name) for name in os.listdir(self.base_dir)]
+            self._dir_files = deque(sorted((p for p in existing if os.path.isfile(p)), key=os.path.getmtime))
+        for name, data, compress in files:
+            path = os.path.join(self.base_dir, name)
+            with open(path, 'wb') as f: f.write(gzip.compress(data, compresslevel=6) if compress else data)
+            self._dir_files.append(path)
+        while self.dir_max_files and len(self._dir_files) > self.dir_max_files:
+            oldest = self._dir_files.popleft()
+            try: os.remove(oldest)
+            except OSError as e: logger.debug(f"删除旧调试产物失败 {oldest}: {e}")
+
+    def close(self):
+        """等待挂起的写任务完成并关闭写线程。"""
+        self._executor.shutdown(wait=True)
+        logger.info(f"调试产物采集结束: 采集 {self.captured_count} 次, 约 {self.bytes_written} 字节, 跳过 {self.skipped_count} 次")
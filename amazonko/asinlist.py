@@ -0,0 +1,91 @@
+# ASIN 列表模式：跳过搜索页，直接抓取已知 ASIN 的详情页
+# ASIN-list mode: skip search pages and crawl the detail pages of known ASINs
+#
+# 价格 / 图片监控时 ASIN 已知，不需要先加载搜索页。列表来自文件 (.gz 也可) 或标准输入 ('-')，
+# 可以有几百万行，因此按行惰性读取：爬虫每次只取一批 (ASIN_LIST_CHUNK_SIZE) 生成请求，
+# 调度器中的待处理请求少于 ASIN_LIST_LOW_WATERMARK (或爬虫空闲) 时再取下一批 —— 请求队列的大小有上限。
+# 读取在线程中进行 (deferToThread)：标准输入的管道可能长时间没有数据，不能阻塞 reactor；
+# 同一时间只有一个读取线程，读取期间爬虫不会因空闲而关闭。
+# 每批请求使用一个抓取身份，各批轮流使用 ASIN_LIST_IDENTITIES 个身份 (粘性键 asins-<批次编号 % N>)：
+# 整个列表不会由同一个身份抓取，身份 (及其上下文、代理分配) 的数量也不随列表长度增长。
+# 每行一个条目，空行和 # 开头的行忽略：
+#   B0ABCDEF12            -> 本次运行的每个站点各抓取一次
+#   uk,B0ABCDEF12         -> 只抓取指定站点 (分隔符可以是逗号、制表符、空格或冒号)
+#   https://www.amazon.de/xxx/dp/B0ABCDEF12?th=1  -> 按链接所属站点，规范化为 /dp/{ASIN}
+
+import gzip
+import logging
+import re
+import sys
+from collections import deque
+
+from amazonko.marketplaces import extract_asin, marketplace_for_url
+
+logger = logging.getLogger(__name__)
+
+ASIN_VALUE_RE = re.compile(r'^[A-Z0-9]{10}$')
+_SEPARATOR_RE = re.compile(r'[\s,;:]+')
+
+
+class AsinListReader:
+    """
+    按行惰性读取 ASIN 列表，next_chunk(n) 返回最多 n 个 (Marketplace, ASIN)。
+    next_chunk 可能阻塞 (等待标准输入)，由爬虫在线程中调用，同一时间只有一个调用。
+    marketplaces: 站点代码 -> Marketplace (本次运行的站点)。
+    """
+    def __init__(self, path, marketplaces):
+        self.path = path
+        self.marketplaces = marketplaces
+        self.lines = 0
+        self.invalid = 0
+        self.exhausted = False
+        self._file = None
+        self._pending = deque() # 一行展开为多个站点时尚未取出的条目
+
+    def _open(self):
+        if self.path == '-': self._file = sys.stdin
+        elif self.path.endswith('.gz'): self._file = gzip.open(self.path, 'rt', encoding='utf-8', errors='replace')
+        else: self._file = open(self.path, encoding='utf-8', errors='replace')
+        logger.info(f"读取 ASIN 列表: {'标准输入' if self.path == '-' else self.path}")
+
+    def _parse(self, line):
+        """解析一行，返回 [(Marketplace, ASIN), ...]；无效行返回 None。"""
+        if '/' in line:
+            asin = extract_asin(line)
+            marketplace = marketplace_for_url(self.marketplaces.values(), line)
+            return [(marketplace, asin)] if asin and marketplace else None
+        parts = _SEPARATOR_RE.split(line)
+        if len(parts) == 1: code, asin = None, parts[0].upper()
+        elif len(parts) == 2: code, asin = parts[0].lower(), parts[1].upper()
+        else: return None
+        if not ASIN_VALUE_RE.match(asin): return None
+        if code is None: return [(marketplace, asin) for marketplace in self.marketplaces.values()]
+        return [(self.marketplaces[code], asin)] if code in self.marketplaces else None
+
+    def next_chunk(self, size):
+        chunk = []
+        while len(chunk) < size and self._pending: chunk.append(self._pending.popleft())
+        if self.exhausted: return chunk
+        if self._file is None: self._open()
+        while len(chunk) < size:
+            line = self._file.readline()
+            if not line: self.exhausted = True; self.close(); break
+            line = line.strip()
+            if not line or line.startswith('#'): continue
+            self.lines += 1
+            entries = self._parse(line)
+            if entries is None:
+                self.invalid += 1
+                if self.invalid <= 20: logger.warning(f"ASIN 列表中的无效行 (或不属于本次运行的站点)，已跳过: {line[:100]}")
+                continue
+            self._pending.extend(entries)
+            while len(chunk) < size and self._pending: chunk.append(self._pending.popleft())
+        return chunk
+
+    @property
+    def done(self):
+        return self.exhausted and not self._pending
+
+    def close(self):
+        if self._file is not None and self._file is not sys.stdin: self._file.close()
+        self._file = None
@@ -0,0 +1,218 @@
+# 常驻浏览器服务 (CDP)
+# Long-lived shared browser server (CDP)
+#
+# BROWSER_MODE = 'attach' 时，爬虫不再每次运行都启动 Chromium，而是通过 CDP 连接到
+# 一个在本机常驻、被多次运行共享的 Chromium (PLAYWRIGHT_CDP_URL)。
+# ensure_browser_server() 先做健康检查 (GET /json/version)，浏览器未启动或已退出时启动它；
+# 启动过程用文件锁保护，避免同时启动的多个爬虫各自启动一个浏览器。
+# 浏览器被多个爬虫共享：进程仍在但无响应时，只重启本进程启动的浏览器 (pid 文件中的 owner_pid)，
+# 其他进程启动的浏览器不会被结束 (需要时用 stop 命令手动处理)。
+# 运行期间的监控 (BrowserServerMonitor) 连续 BROWSER_SERVER_MAX_FAILURES 次健康检查失败
+# (每次超时 BROWSER_SERVER_MONITOR_TIMEOUT 秒) 才认为浏览器不可用，负载高时的短暂卡顿不会触发重启。
+# 浏览器进程在独立的会话中运行，爬虫结束后继续存活，供下一次运行使用。
+#
+# 命令行 (Command line):
+#     python -m amazonko.browser_server start|stop|status
+
+import fcntl
+import glob
+import json
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from urllib.error import URLError
+from urllib.request import urlopen
+
+logger = logging.getLogger(__name__)
+
+PID_FILE = 'browser.json'
+LOCK_FILE = 'browser.lock'
+
+
+def cdp_url(settings):
+    return f"http://127.0.0.1:{settings.getint('BROWSER_SERVER_PORT', 9222)}"
+
+
+def cdp_healthy(url, timeout=1.0):
+    """CDP 端点可用时返回浏览器版本信息 (dict)，否则返回 None。"""
+    try:
+        with urlopen(f"{url}/json/version", timeout=timeout) as response:
+            info = json.loads(response.read().decode('utf-8'))
+    except (URLError, OSError, ValueError):
+        return None
+    return info if info.get('webSocketDebuggerUrl') else None
+
+
+def find_chromium(settings):
+    """按顺序查找 Chromium 可执行文件：BROWSER_SERVER_EXECUTABLE、PATH、Playwright 下载的浏览器。"""
+    executable = settings.get('BROWSER_SERVER_EXECUTABLE')
+    if executable: return executable
+    for name in ('chromium', 'chromium-browser', 'google-chrome', 'google-chrome-stable'):
+        path = shutil.which(name)
+        if path: return path
+    browsers_dir = os.environ.get('PLAYWRIGHT_BROWSERS_PATH') or os.path.expanduser('~/.cache/ms-playwright')
+    candidates = sorted(glob.glob(os.path.join(browsers_dir, 'chromium-*', 'chrome-linux*', 'chrome')))
+    if candidates: return candidates[-1] # 版本号最大的
+    raise RuntimeError("找不到 Chromium，请设置 BROWSER_SERVER_EXECUTABLE 或运行 playwright install chromium")
+
+
+def _read_state(state_dir):
+    try:
+        with open(os.path.join(state_dir, PID_FILE), encoding='utf-8') as f: return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _alive(pid):
+    if not pid: return False
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except PermissionError: return True
+    return True
+
+
+def _kill(pid):
+    if not pid: return
+    try:
+        os.killpg(pid, signal.SIGTERM) # 浏览器以新会话启动，pid 即进程组 id
+    except (ProcessLookupError, PermissionError):
+        return
+    for _ in range(50):
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0]: return # 本进程启动的浏览器 (监控重启时)：回收僵尸进程
+        except ChildProcessError:
+            pass
+        try: os.kill(pid, 0)
+        except ProcessLookupError: return
+        time.sleep(0.1)
+    try: os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError): pass
+
+
+def _launch(settings, state_dir):
+    port = settings.getint('BROWSER_SERVER_PORT', 9222)
+    launch_options = settings.getdict('PLAYWRIGHT_LAUNCH_OPTIONS')
+    command = [
+        find_chromium(settings),
+        f"--remote-debugging-port={port}", "--remote-debugging-address=127.0.0.1",
+        f"--user-data-dir={os.path.join(state_dir, 'profile')}",
+        "--no-first-run", "--no-default-browser-check",
+    ] + list(launch_options.get('args', []))
+    if launch_options.get('headless', True): command.append("--headless=new")
+    command.append("about:blank")
+    log_file = open(os.path.join(state_dir, 'browser.log'), 'ab')
+    process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+    log_file.close()
+    with open(os.path.join(state_dir, PID_FILE), 'w', encoding='utf-8') as f:
+        json.dump({'pid': process.pid, 'owner_pid': os.getpid(), 'port': port, 'started_at': time.time(), 'command': command}, f)
+    logger.info(f"已启动常驻浏览器 (pid {process.pid}, 端口 {port})")
+    return process
+
+
+def ensure_browser_server(settings):
+    """
+    返回可用的 CDP URL；浏览器未运行 (或已退出) 时启动它。
+    浏览器进程仍在但无响应时，只重启本进程启动的浏览器，否则抛出 RuntimeError (不结束其他爬虫正在使用的浏览器)。
+    健康时只需一次本地 HTTP 请求 (毫秒级)。
+    """
+    url = cdp_url(settings)
+    timeout = settings.getfloat('BROWSER_SERVER_HEALTH_TIMEOUT', 1.0)
+    if cdp_healthy(url, timeout): return url
+    state_dir = os.path.abspath(settings.get('BROWSER_SERVER_DIR', '.browser_server'))
+    os.makedirs(state_dir, exist_ok=True)
+    with open(os.path.join(state_dir, LOCK_FILE), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX) # 其他进程可能正在启动浏览器
+        try:
+            if cdp_healthy(url, timeout): return url
+            state = _read_state(state_dir)
+            if _alive(state.get('pid')):
+                if state.get('owner_pid') != os.getpid():
+                    raise RuntimeError(f"常驻浏览器 (pid {state['pid']}) 无响应，且不是本进程启动的，不自动重启；"
+                                       f"确认没有其他爬虫在使用后运行 python -m amazonko.browser_server stop")
+                logger.warning(f"常驻浏览器无响应，重新启动 (旧 pid {state['pid']})")
+                _kill(state['pid'])
+            process = _launch(settings, state_dir)
+            deadline = time.monotonic() + settings.getfloat('BROWSER_SERVER_START_TIMEOUT', 30)
+            while time.monotonic() < deadline:
+                if cdp_healthy(url, timeout): return url
+                if process.poll() is not None:
+                    raise RuntimeError(f"常驻浏览器启动后立即退出 (代码 {process.returncode})，见 {state_dir}/browser.log")
+                time.sleep(0.1)
+            raise RuntimeError(f"常驻浏览器在超时时间内没有响应: {url}")
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class BrowserServerMonitor:
+    """
+    运行期间定期 (BROWSER_SERVER_HEALTH_INTERVAL 秒) 在线程中检查常驻浏览器。
+    连续 max_failures 次检查失败后调用 ensure_browser_server：浏览器已退出时重新启动，
+    无响应时只重启本进程启动的浏览器。
+    scrapy-playwright 检测到连接断开后 (PLAYWRIGHT_RESTART_DISCONNECTED_BROWSER) 会在下一个请求时重新连接同一个 CDP URL。
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.url = cdp_url(settings)
+        self.interval = settings.getfloat('BROWSER_SERVER_HEALTH_INTERVAL', 30)
+        self.timeout = settings.getfloat('BROWSER_SERVER_MONITOR_TIMEOUT', 5)
+        self.max_failures = max(1, settings.getint('BROWSER_SERVER_MAX_FAILURES', 3))
+        self.failures = 0 # 连续失败次数
+        self._loop = None
+
+    def start(self):
+        if self.interval <= 0: return
+        from twisted.internet import task
+        self._loop = task.LoopingCall(self._check)
+        self._loop.start(self.interval, now=False)
+
+    def _check(self):
+        from twisted.internet import threads
+        d = threads.deferToThread(self._probe)
+        d.addErrback(lambda failure: logger.error(f"常驻浏览器健康检查 / 重启失败: {failure.value}"))
+        return d
+
+    def _probe(self):
+        # 在线程中执行
+        if cdp_healthy(self.url, self.timeout): self.failures = 0; return
+        self.failures += 1
+        logger.warning(f"常驻浏览器健康检查失败 ({self.failures}/{self.max_failures})")
+        if self.failures < self.max_failures: return
+        self.failures = 0
+        ensure_browser_server(self.settings)
+
+    def stop(self):
+        if self._loop and self._loop.running: self._loop.stop()
+
+
+def stop_browser_server(settings):
+    state_dir = os.path.abspath(settings.get('BROWSER_SERVER_DIR', '.browser_server'))
+    state = _read_state(state_dir)
+    _kill(state.get('pid'))
+    try: os.remove(os.path.join(state_dir, PID_FILE))
+    except OSError: pass
+
+
+def main(argv=None):
+    from scrapy.utils.project import get_project_settings
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    action = (argv or sys.argv[1:] or ['status'])[0]
+    settings = get_project_settings()
+    if action == 'start':
+        print(ensure_browser_server(settings))
+    elif action == 'stop':
+        stop_browser_server(settings)
+    elif action == 'status':
+        info = cdp_healthy(cdp_url(settings))
+        print(json.dumps(info, indent=2) if info else "not running")
+        return 0 if info else 1
+    else:
+        print("usage: python -m amazonko.browser_server start|stop|status"); return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,188 @@
+# 实时 Item 推送 (NDJSON over Unix socket / HTTP chunked / SSE)
+# Live item feed (NDJSON over Unix socket / HTTP chunked / SSE)
+#
+# CSV 在爬虫结束时才关闭，下游 (改价服务) 要等整次运行结束才能用到数据。
+# FeedServer 在抓取期间把每个 Item 作为一行 JSON 推送给已连接的消费者：
+#   - Unix socket (STREAM_FEED_UNIX_SOCKET): 连接后直接读取 NDJSON 行，例如 `nc -U amazonko-feed.sock`
+#   - HTTP (STREAM_FEED_HTTP_PORT): GET /items 返回分块传输的 NDJSON；
+#     Accept: text/event-stream 或 /items?format=sse 时返回 SSE (data: <json>)
+# 每个消费者有一个有界队列 (STREAM_FEED_CLIENT_QUEUE)。消费者读得慢时 socket 写缓冲区满，
+# Twisted 暂停该消费者 (IPushProducer.pauseProducing)，Item 留在队列中；队列满时 publish() 等待，
+# 管道的 process_item 因此变慢，Scrapy 的 scraper 槽位积压后引擎停止调度新的下载 —— 内存不会无限增长。
+# 消费者阻塞抓取超过 STREAM_FEED_SLOW_CLIENT_TIMEOUT 秒时断开该消费者。
+# 没有消费者连接时 Item 不缓存 (数据仍写入 CSV / SQLite)。
+
+import json
+import logging
+import os
+from collections import deque
+
+from twisted.internet import defer, protocol
+from twisted.internet.interfaces import IPushProducer
+from twisted.web import resource, server
+from zope.interface import implementer
+
+logger = logging.getLogger(__name__)
+
+
+def item_line(item, field_names):
+    """把 Item 的指定字段序列化为一行 NDJSON (bytes)。"""
+    row = {name: getattr(item, name, None) for name in field_names}
+    return json.dumps(row, ensure_ascii=False, default=str).encode('utf-8') + b'\n'
+
+
+@implementer(IPushProducer)
+class FeedClient:
+    """一个消费者：有界队列 + 由传输层的写缓冲区驱动的暂停 / 恢复。"""
+    def __init__(self, name, write, disconnect, max_queue=1000):
+        self.name = name
+        self._write = write
+        self._disconnect = disconnect
+        self.max_queue = max(1, max_queue)
+        self.queue = deque()
+        self.paused = False
+        self.closed = False
+        self.sent = 0
+        self._space_waiters = []
+
+    @property
+    def full(self):
+        return len(self.queue) >= self.max_queue
+
+    def push(self, data):
+        self.queue.append(data)
+        self._drain()
+
+    def _drain(self):
+        while self.queue and not self.paused and not self.closed:
+            self._write(self.queue.popleft()); self.sent += 1
+        if not self.full: self._wake()
+
+    def wait_for_space(self):
+        d = defer.Deferred()
+        if self.closed or not self.full: d.callback(None)
+        else: self._space_waiters.append(d)
+        return d
+
+    def _wake(self):
+        waiters, self._space_waiters = self._space_waiters, []
+        for d in waiters: d.callback(None)
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        self.queue.clear()
+        self._wake()
+        self._disconnect()
+
+    # IPushProducer：传输层写缓冲区满 / 清空时调用
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._drain()
+
+    def stopProducing(self):
+        self.closed = True
+        self.queue.clear()
+        self._wake()
+
+
+class _SocketProtocol(protocol.Protocol):
+    def connectionMade(self):
+        self.client = FeedClient(f"unix:fd{self.transport.fileno()}", self.transport.write, self.transport.loseConnection,
+                                 self.factory.feed.max_queue)
+        self.transport.registerProducer(self.client, True)
+        self.factory.feed.add_client(self.client)
+
+    def dataReceived(self, data):
+        pass # 只推送，忽略消费者发送的数据
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.client.stopProducing()
+        self.factory.feed.remove_client(self.client)
+
+
+class _ItemsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, feed):
+        super().__init__()
+        self.feed = feed
+
+    def render_GET(self, request):
+        if request.path.rstrip(b'/') != b'/items':
+            request.setResponseCode(404); return b"not found\n"
+        sse = b'text/event-stream' in (request.getHeader(b'accept') or b'') or request.args.get(b'format') == [b'sse']
+        request.setHeader(b'Content-Type', b'text/event-stream' if sse else b'application/x-ndjson; charset=utf-8')
+        request.setHeader(b'Cache-Control', b'no-cache')
+        write = (lambda line: request.write(b'data: ' + line.rstrip(b'\n') + b'\n\n')) if sse else request.write
+        def finish():
+            request.unregisterProducer(); request.finish()
+        client = FeedClient(f"http:{request.getClientAddress()}", write, finish, self.feed.max_queue)
+        request.registerProducer(client, True)
+        request.notifyFinish().addBoth(lambda _: (client.stopProducing(), self.feed.remove_client(client)))
+        self.feed.add_client(client)
+        return server.NOT_DONE_YET
+
+
+class FeedServer:
+    """
+    管理消费者连接并向其广播 NDJSON 行。
+    publish(line) 返回 Deferred：所有消费者的队列都有空间时立即完成，否则等待 (背压)。
+    """
+    def __init__(self, unix_socket=None, http_port=None, http_host='127.0.0.1', max_queue=1000, slow_client_timeout=60):
+        self.unix_socket = unix_socket
+        self.http_port = http_port
+        self.http_host = http_host
+        self.max_queue = max_queue
+        self.slow_client_timeout = slow_client_timeout # 秒，0 表示一直等待慢消费者
+        self.clients = []
+        self.published = 0
+        self._ports = []
+
+    def start(self):
+        from twisted.internet import reactor
+        if self.unix_socket:
+            if os.path.exists(self.unix_socket): os.remove(self.unix_socket) # 上次运行残留的 socket 文件
+            factory = protocol.Factory.forProtocol(_SocketProtocol); factory.feed = self
+            self._ports.append(reactor.listenUNIX(self.unix_socket, factory))
+            logger.info(f"Item 推送已监听 Unix socket: {self.unix_socket}")
+        if self.http_port:
+            site = server.Site(_ItemsResource(self)); site.noisy = False
+            self._ports.append(reactor.listenTCP(self.http_port, site, interface=self.http_host))
+            logger.info(f"Item 推送已监听 http://{self.http_host}:{self.http_port}/items")
+
+    def add_client(self, client):
+        self.clients.append(client)
+        logger.info(f"Item 推送消费者已连接: {client.name} (共 {len(self.clients)} 个)")
+
+    def remove_client(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+            logger.info(f"Item 推送消费者已断开: {client.name}，已发送 {client.sent} 条")
+
+    @defer.inlineCallbacks
+    def publish(self, line):
+        from twisted.internet import reactor
+        for client in list(self.clients):
+            if client.full:
+                d = client.wait_for_space()
+                if self.slow_client_timeout > 0: d.addTimeout(self.slow_client_timeout, reactor)
+                try:
+                    yield d
+                except defer.TimeoutError:
+                    logger.warning(f"Item 推送消费者 {client.name} 超过 {self.slow_client_timeout} 秒未读取，断开连接")
+                    self.remove_client(client); client.close()
+                    continue
+            if not client.closed: client.push(line)
+        self.published += 1
+
+    def stop(self):
+        for client in list(self.clients):
+            client.resumeProducing() # 剩余数据交给传输层 (loseConnection 会先写完缓冲区)
+            client.close()
+        self.clients = []
+        for port in self._ports: port.stopListening() # Unix socket 文件由 Twisted 删除
+        self._ports = []
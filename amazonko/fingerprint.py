@@ -0,0 +1,51 @@
+# 浏览器指纹覆盖 (语言 / 地理位置 / 时区)
+# Browser fingerprint overrides (language / geolocation / timezone)
+#
+# 脚本以 init script 的形式注册到浏览器上下文 (BrowserContext.add_init_script)：
+# 上下文中的每个页面在执行任何页面脚本之前都会先运行它，每个上下文只需注册一次。
+
+from functools import lru_cache
+
+
+@lru_cache(maxsize=32)
+def build_spoof_script(locale, timezone_id):
+    """生成指定 locale / 时区的指纹覆盖脚本 (立即执行的函数表达式)。"""
+    return f"""
+    (() => {{
+        try {{
+            // 覆盖语言设置
+            Object.defineProperty(navigator, 'language', {{ get: () => '{locale}', configurable: true }});
+            Object.defineProperty(navigator, 'languages', {{ get: () => ['{locale}', 'en'], configurable: true }});
+            // 模拟地理位置 API (拒绝访问)
+            if (navigator.geolocation) {{
+                navigator.geolocation.getCurrentPosition = function(success, error) {{
+                    if (error) error({{ code: 1, message: "Geolocation access denied by spoof." }});
+                }};
+                navigator.geolocation.watchPosition = function(success, error) {{
+                    if (error) error({{ code: 1, message: "Geolocation access denied by spoof." }});
+                    return 0; // 返回 watchId
+                }};
+            }}
+            // 覆盖时区偏移量 (分钟)，根据 timezone_id 计算
+            const originalGetTimezoneOffset = Date.prototype.getTimezoneOffset;
+            Date.prototype.getTimezoneOffset = function() {{
+                try {{
+                    const offset = this.toLocaleString("en-US", {{timeZone: "{timezone_id}", timeZoneName: "shortOffset"}}).split("GMT")[1];
+                    if (offset) {{
+                        const [hours, minutes] = offset.split(":");
+                        return -(parseInt(hours, 10) * 60 + Math.sign(parseInt(hours, 10)) * parseInt(minutes || "0", 10));
+                    }}
+                    return 0; // "GMT" 无偏移
+                }} catch (e) {{ return originalGetTimezoneOffset.call(this); }}
+            }};
+            Intl.DateTimeFormat.prototype.resolvedOptions = new Proxy(Intl.DateTimeFormat.prototype.resolvedOptions, {{
+                apply(target, self, args) {{
+                    const options = Reflect.apply(target, self, args);
+                    options.timeZone = '{timezone_id}';
+                    options.locale = '{locale}';
+                    return options;
+                }}
+            }});
+        }} catch (e) {{ console.error('Error during JS spoofing:', e); }}
+    }})();
+    """
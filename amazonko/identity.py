@@ -0,0 +1,240 @@
+# 抓取身份：代理端点 + User-Agent + 视口 + locale / 时区 绑定为一个一致的身份
+# Crawl identities: proxy endpoint + User-Agent + viewport + locale / timezone bound together
+#
+# 之前 UA 按请求随机选择 (包括 iPhone UA)，与代理和 1920x1080 桌面上下文互相独立，
+# 指纹不一致容易触发 Robot Check。现在每个身份对应一个命名的 Playwright 上下文
+# (playwright_context)，上下文的 proxy / user_agent / viewport / locale 与请求头保持一致。
+# - 按粘性键 (默认是搜索关键词) 分配身份，同一关键词的搜索页、详情页、图片使用同一身份。
+# - 连续被阻止 (403 / 429 / 503 / Robot Check) IDENTITY_MAX_BLOCKS 次后轮换：
+#   旧身份退役，新身份避开旧身份的代理端点。
+# - 身份的代理端点熔断或在本请求中失败时，只更换端点 (上下文代数 +1，以新代理建立新上下文)。
+# - 启用 SESSION_ENABLED 时，上下文以该身份保存的 storage_state 创建 (见 amazonko/sessions.py)；
+#   同一代理端点总是使用同一个 UA 配置，跨运行时会话键保持稳定。
+# - 多站点时身份属于一个站点 (见 amazonko/marketplaces.py)：使用站点的 locale / 时区，只从站点的代理子集中选择端点。
+
+import hashlib
+import itertools
+import logging
+import random
+import re
+import time
+from urllib.parse import urlparse
+
+from scrapy.exceptions import NotConfigured
+
+from amazonko.proxies import ProxyPool
+from amazonko.sessions import SessionStore, session_key
+
+logger = logging.getLogger(__name__)
+
+BLOCK_STATUSES = (403, 429, 503)
+BLOCK_TITLE_MARKERS = ("robot check", "sorry", "captcha")
+_TITLE_RE = re.compile(rb'<title[^>]*>(.*?)</title>', re.IGNORECASE | re.DOTALL)
+
+
+def page_title(response):
+    """页面标题 (小写)。标题在文档开头，只在前 16 KB 中查找，不解析整页。"""
+    match = _TITLE_RE.search(response.body[:16384])
+    return match.group(1).decode('utf-8', 'ignore').strip().lower() if match else ''
+
+
+def is_block_response(response):
+    """根据状态码和页面标题判断请求是否被阻止。"""
+    if response.status in BLOCK_STATUSES: return True
+    if response.status != 200: return False
+    title = page_title(response)
+    return any(marker in title for marker in BLOCK_TITLE_MARKERS)
+
+
+class Identity:
+    """一个一致的抓取身份。context_name 随代数变化 (更换代理后需要新的浏览器上下文)。"""
+    def __init__(self, identity_id, profile, endpoint, locale, timezone_id, marketplace=None):
+        self.id = identity_id
+        self.profile = profile
+        self.user_agent = profile['user_agent']
+        self.viewport = profile.get('viewport', {'width': 1920, 'height': 1080})
+        self.endpoint = endpoint # ProxyEndpoint 或 None (未配置代理)
+        self.locale = locale
+        self.timezone_id = timezone_id
+        self.marketplace = marketplace # Marketplace 或 None
+        self.generation = 0
+        self.pages = 0
+        self.consecutive_blocks = 0
+        self.retired = False
+        self.created_at = time.time()
+        self.storage_state = None # 恢复的会话 (cookies + localStorage)，创建上下文时使用
+
+    @property
+    def session_key(self):
+        return session_key(self.endpoint.url if self.endpoint is not None else None, self.user_agent, self.locale)
+
+    @property
+    def context_name(self):
+        return f"identity-{self.id}-g{self.generation}"
+
+    @property
+    def accept_language(self):
+        language = self.locale.split('-')[0]
+        return f"{self.locale},{language};q=0.9" if language != self.locale else self.locale
+
+    def playwright_proxy(self):
+        if self.endpoint is None: return None
+        parsed = urlparse(self.endpoint.url)
+        proxy = {'server': f"{parsed.scheme}://{parsed.hostname}:{parsed.port}"}
+        username = self.endpoint.config.get('username') or parsed.username
+        password = self.endpoint.config.get('password') or parsed.password
+        if username and password: proxy.update(username=username, password=password)
+        return proxy
+
+    def context_kwargs(self):
+        kwargs = {
+            'user_agent': self.user_agent,
+            'viewport': self.viewport,
+            'locale': self.locale,
+            'timezone_id': self.timezone_id,
+        }
+        for key in ('device_scale_factor', 'is_mobile', 'has_touch'):
+            if key in self.profile: kwargs[key] = self.profile[key]
+        proxy = self.playwright_proxy()
+        if proxy: kwargs['proxy'] = proxy
+        if self.storage_state: kwargs['storage_state'] = self.storage_state
+        return kwargs
+
+    def __repr__(self):
+        return f"<Identity {self.id} g{self.generation} {self.endpoint} {self.viewport['width']}x{self.viewport['height']}>"
+
+
+class IdentityManager:
+    """
+    身份池，按爬虫 (crawler) 共享一个实例 (见 from_crawler)。
+    - for_key(key): 返回该粘性键当前的身份 (没有或已退役时创建新身份)。
+    - report_block / report_success: 由 IdentityMiddleware 根据响应调用。
+    """
+    def __init__(self, settings, pool=None, stats=None, sessions=None):
+        browser_type = settings.get('PLAYWRIGHT_BROWSER_TYPE', 'chromium')
+        profiles = settings.getlist('IDENTITY_PROFILES')
+        # 只使用与实际浏览器内核一致的 UA (Chromium 上使用 Safari / Firefox UA 本身就是不一致的指纹)
+        self.profiles = [p for p in profiles if p.get('browser', browser_type) == browser_type] or profiles
+        if not self.profiles:
+            raise NotConfigured("IDENTITY_PROFILES 为空。")
+        context_args = settings.getdict('PLAYWRIGHT_CONTEXT_ARGS')
+        self.default_locale = context_args.get('locale', 'en-US')
+        self.default_timezone = context_args.get('timezone_id', 'America/New_York')
+        self.max_blocks = settings.getint('IDENTITY_MAX_BLOCKS', 2)
+        self.max_pages = settings.getint('IDENTITY_MAX_PAGES', 0) # 0 表示不按页数轮换
+        self.pool = pool
+        self.stats = stats
+        self.sessions = sessions # SessionStore 或 None
+        self.identities = {} # id -> Identity
+        self.assignments = {} # 粘性键 -> 身份 id
+        self._ids = itertools.count(1)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        manager = getattr(crawler, 'identity_manager', None)
+        if manager is None:
+            try:
+                pool = ProxyPool.from_crawler(crawler) # 与代理中间件共享同一个代理池 (熔断状态)
+            except NotConfigured:
+                pool = None
+            sessions = SessionStore.from_settings(crawler.settings) if crawler.settings.getbool('SESSION_ENABLED', True) else None
+            manager = crawler.identity_manager = cls(crawler.settings, pool, crawler.stats, sessions)
+        return manager
+
+    def _inc_stat(self, key):
+        if self.stats: self.stats.inc_value(key)
+
+    def _in_use_urls(self, excluding=None):
+        return {ident.endpoint.url for ident in self.identities.values()
+                if not ident.retired and ident.endpoint is not None and ident is not excluding}
+
+    def _pick_endpoint(self, avoid=(), identity=None, marketplace=None):
+        if self.pool is None: return None
+        candidates = self.pool.subset(marketplace.proxy_providers) if marketplace is not None else None
+        # 优先选择未被其他身份占用、也不在 avoid 中的端点；pick 在候选为空时会自动放宽
+        exclude = set(avoid) | self._in_use_urls(excluding=identity)
+        if len(exclude) >= len(candidates or self.pool.endpoints): exclude = set(avoid)
+        return self.pool.pick(exclude=exclude, candidates=candidates)
+
+    def _profile_for(self, endpoint):
+        # 同一出口固定使用同一个 UA 配置 (更像真实用户，也让会话键跨运行保持稳定)
+        if endpoint is None and self.sessions is None: return random.choice(self.profiles)
+        digest = hashlib.sha1((endpoint.url if endpoint is not None else 'direct').encode('utf-8')).digest()
+        return self.profiles[int.from_bytes(digest[:4], 'big') % len(self.profiles)]
+
+    def _restore_session(self, identity):
+        if self.sessions is None: return
+        identity.storage_state = self.sessions.load(identity.session_key)
+        if identity.storage_state: self._inc_stat('identity/session_restored')
+
+    def _create(self, avoid=(), marketplace=None):
+        endpoint = self._pick_endpoint(avoid, marketplace=marketplace)
+        config = endpoint.config if endpoint is not None else {}
+        if marketplace is not None: # 站点决定页面语言和时区
+            locale, timezone_id = marketplace.locale, marketplace.timezone_id
+        else:
+            locale, timezone_id = config.get('locale', self.default_locale), config.get('timezone_id', self.default_timezone)
+        identity = Identity(next(self._ids), self._profile_for(endpoint), endpoint, locale, timezone_id, marketplace)
+        self._restore_session(identity)
+        self.identities[identity.id] = identity
+        self._inc_stat('identity/created')
+        logger.info(f"创建抓取身份: {identity} UA={identity.user_agent[:60]}...")
+        return identity
+
+    def get(self, identity_id):
+        return self.identities.get(identity_id)
+
+    def for_key(self, key, marketplace=None):
+        identity = self.identities.get(self.assignments.get(key))
+        if identity is None or identity.retired:
+            avoid = [identity.endpoint.url] if identity is not None and identity.endpoint is not None else ()
+            identity = self._create(avoid, marketplace)
+            self.assignments[key] = identity.id
+        return identity
+
+    def ensure_endpoint(self, identity, failed=()):
+        """身份的代理端点已熔断 (或半开且已有试探请求) 或在本请求中失败过时，为身份换一个端点 (并换用新的浏览器上下文)。"""
+        endpoint = identity.endpoint
+        if endpoint is None or self.pool is None: return
+        if self.pool.is_available(endpoint) and endpoint.url not in failed: return
+        identity.endpoint = self._pick_endpoint(avoid=set(failed) | {endpoint.url}, identity=identity, marketplace=identity.marketplace)
+        identity.generation += 1
+        self._restore_session(identity) # 会话与出口绑定，换端点后使用新端点的会话
+        self._inc_stat('identity/endpoint_changed')
+        logger.info(f"身份 {identity.id} 的代理端点不可用，换用 {identity.endpoint}")
+
+    def report_success(self, identity):
+        identity.consecutive_blocks = 0
+        identity.pages += 1
+        if self.max_pages and identity.pages >= self.max_pages: self.retire(identity, f"已使用 {identity.pages} 页")
+
+    def report_block(self, identity, reason):
+        identity.consecutive_blocks += 1
+        self._inc_stat('identity/blocked')
+        logger.warning(f"身份 {identity.id} 被阻止 ({reason})，连续 {identity.consecutive_blocks} 次")
+        if identity.consecutive_blocks >= self.max_blocks:
+            self.retire(identity, reason)
+            if self.sessions is not None: self.sessions.delete(identity.session_key) # 被标记的会话不再复用
+
+    async def maybe_save_session(self, identity, page):
+        """成功页面之后保存身份所在上下文的 storage_state (按身份节流)。"""
+        if self.sessions is None or page is None or identity.retired: return
+        key = identity.session_key
+        if not self.sessions.should_save(key): return
+        try:
+            identity.storage_state = await page.context.storage_state()
+        except Exception as e: # 页面 / 上下文可能已被关闭
+            logger.debug(f"读取会话状态失败 (身份 {identity.id}): {e}"); return
+        self.sessions.save(key, identity.storage_state)
+        self._inc_stat('identity/session_saved')
+
+    def recycle(self, identity):
+        """换用新的浏览器上下文 (代数 +1)，端点、UA 和会话不变 (由浏览器看门狗按页数 / 内存调用)。"""
+        identity.generation += 1
+        self._inc_stat('identity/context_recycled')
+
+    def retire(self, identity, reason):
+        if identity.retired: return
+        identity.retired = True
+        self._inc_stat('identity/rotated')
+        logger.warning(f"轮换抓取身份 {identity} (原因: {reason})")
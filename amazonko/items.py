@@ -1,43 +1,66 @@
 # Define here the models for your scraped items
 # 在此定义抓取项目的数据模型
 # See documentation in: (参阅文档)
-# https://docs. scrapy.org/en/latest/topics/items.html
+# https://docs.scrapy.org/en/latest/topics/items.html
+#
+# 使用 slots dataclass 代替 scrapy.Item：每个 Item 不再携带字段字典，
+# 在等待图片下载的大量 Item 中能显著降低内存占用。
+# Scrapy / itemadapter 原生支持 dataclass Item。
 
-import scrapy
-
-class AmazonkoItem(scrapy.Item):
-    # Define the fields for your item here like:
-    # 在此定义 Item 的字段，例如:
-    # name = scrapy.Field()
+from dataclasses import dataclass, field
+from typing import Optional
 
+@dataclass(slots=True)
+class AmazonkoItem:
     # 基础信息 (Basic Information)
-    search_keyword = scrapy.Field() # 搜索关键词 (Search Keyword)
-    product_url = scrapy.Field()    # 商品详情页 URL (Product Detail Page URL) - 用于去重和关联
-    asin = scrapy.Field()           # 商品 ASIN (Amazon Standard Identification Number) - 唯一标识符
+    search_keyword: Optional[str] = None # 搜索关键词 (Search Keyword)
+    marketplace: Optional[str] = None    # 站点代码 (Marketplace code, e.g. us / uk / de)
+    product_url: Optional[str] = None    # 商品详情页 URL (Product Detail Page URL) - 用于去重和关联
+    asin: Optional[str] = None           # 商品 ASIN (Amazon Standard Identification Number) - 唯一标识符
 
     # 商品信息 (Product Information)
-    title = scrapy.Field()          # 商品标题 (Product Title)
+    title: Optional[str] = None          # 商品标题 (Product Title)
 
     # 图片信息 (Image Information)
     # 存储所有需要下载的图片 URL (包括主图和变体图)
     # Stores all image URLs to be downloaded (main image and variation images)
-    image_urls_to_download = scrapy.Field()
+    image_urls_to_download: list = field(default_factory=list)
     # 图片下载管道处理后的结果 (包含下载状态、本地路径等)
     # Results after processing by the image pipeline (contains status, local path, etc.)
-    # Scrapy 的 ImagesPipeline 会填充这个字段 (默认为 'images')
-    # Scrapy's ImagesPipeline populates this field (defaults to 'images')
-    image_download_results = scrapy.Field()
+    image_download_results: Optional[list] = None
 
     # 清洗和处理后的数据 (Cleaned and Processed Data) - 由 Pipeline 填充
-    main_image_url = scrapy.Field() # 清洗后的主图 URL (通常是 image_urls_to_download 的第一个)
-                                     # Cleaned main image URL (usually the first one from image_urls_to_download)
-    downloaded_image_name = scrapy.Field() # 下载到本地的图片文件名 (由 Pipeline 设置)
-                                           # Filename of the image downloaded locally (set by Pipeline)
+    main_image_url: Optional[str] = None # 清洗后的主图 URL (通常是 image_urls_to_download 的第一个)
+                                         # Cleaned main image URL (usually the first one from image_urls_to_download)
+    downloaded_image_name: Optional[str] = None # 下载到本地的图片文件名 (由 Pipeline 设置)
+                                                # Filename of the image downloaded locally (set by Pipeline)
 
     # 变体信息 (Variation Information) - 如果需要区分
-    is_variation = scrapy.Field()   # 标记是否为变体 SKU (Flag indicating if it's a variation SKU)
-    variation_type = scrapy.Field() # 变体类型 (例如 Color) (Variation Type, e.g., Color)
-    variation_value = scrapy.Field()# 变体值 (例如 Red, Blue) (Variation Value, e.g., Red, Blue)
+    is_variation: bool = False             # 标记是否为变体 SKU (Flag indicating if it's a variation SKU)
+    parent_asin: Optional[str] = None      # 变体所属的父商品 ASIN (Parent product ASIN of a variation)
+    variation_type: Optional[str] = None   # 变体类型 (例如 Color) (Variation Type, e.g., Color)
+    variation_value: Optional[str] = None  # 变体值 (例如 Red, Blue) (Variation Value, e.g., Red, Blue)
 
     # 采集元数据 (Crawling Metadata)
-    crawled_at = scrapy.Field()     # 抓取时间戳 (Crawling Timestamp)
+    crawled_at: Optional[str] = None     # 抓取时间戳 (Crawling Timestamp)
+
+    # 注意：代理等仅用于路由的临时数据不放在 Item 中，
+    # 由爬虫的 item_context (按 (站点, ASIN) 索引，同一 ASIN 在各站点使用各自的代理) 传递给图片管道。
+    # Note: transient routing data (e.g. proxy) is not stored on the Item;
+    # it is passed to the image pipeline via the spider's item_context (keyed by (marketplace, asin), since the same ASIN uses a different proxy per marketplace).
+
+
+def normalize_item(item):
+    """
+    所有管道共用的一次性数据清洗 (由第一个管道调用)。
+    One-time normalization shared by all pipelines (called by the first pipeline).
+    """
+    # 清洗标题：去除首尾空白，合并中间多余空白
+    # Clean title: strip leading/trailing whitespace, consolidate internal whitespace
+    if item.title:
+        item.title = ' '.join(item.title.split())
+    # 提取主图 URL (如果尚未在 Item 中设置)
+    # Extract main image URL (if not already set in the Item)
+    if not item.main_image_url and item.image_urls_to_download:
+        item.main_image_url = item.image_urls_to_download[0]
+    return item
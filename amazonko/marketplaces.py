@@ -0,0 +1,96 @@
+# Amazon 站点 (marketplace) 配置
+# Amazon marketplace configuration
+#
+# 每个站点 (us / uk / de / jp ...) 有自己的根 URL、locale / 时区 (浏览器上下文参数)、
+# 代理子集 (PROXY_CONFIG 的 provider_type) 以及并发 / 延迟预算。
+# 爬虫为每个站点的主机配置一个独立的下载 slot (DOWNLOAD_SLOTS)，AutoThrottle 也按 slot 调整延迟，
+# 调度器按 (站点, 请求类别) 分配预算 —— 一个站点被限速不会拖慢其他站点。
+# 商品链接按站点规范化为 {base_url}/dp/{ASIN}。
+
+import logging
+import re
+from urllib.parse import parse_qs, quote_plus, unquote, urljoin, urlparse
+
+logger = logging.getLogger(__name__)
+
+ASIN_RE = re.compile(r'/(?:dp|gp/product|gp/aw/d)/([A-Z0-9]{10})(?:[/?#]|$)')
+
+
+def extract_asin(url):
+    """从商品链接中提取 ASIN (支持 /dp/、/gp/product/、/gp/aw/d/ 和 /sspa/click 跳转链接)，找不到时返回 None。"""
+    if '/sspa/click' in url:
+        target = parse_qs(urlparse(url).query).get('url')
+        if not target: return None
+        url = unquote(target[0])
+    match = ASIN_RE.search(url.split('?')[0])
+    return match.group(1) if match else None
+
+
+def _domain(host):
+    return host[4:] if host.startswith('www.') else host
+
+
+class Marketplace:
+    """单个站点的配置 (见 settings.MARKETPLACES)。"""
+    def __init__(self, code, config, settings):
+        self.code = code
+        self.base_url = config['base_url'].rstrip('/')
+        self.host = urlparse(self.base_url).hostname
+        self.domain = _domain(self.host) # allowed_domains 使用
+        default_context = settings.getdict('PLAYWRIGHT_CONTEXT_ARGS')
+        self.locale = config.get('locale', default_context.get('locale', 'en-US'))
+        self.timezone_id = config.get('timezone_id', default_context.get('timezone_id', 'America/New_York'))
+        self.proxy_providers = list(config.get('proxy_providers', [])) # 为空表示使用全部代理
+        self.concurrency = int(config.get('concurrency', settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN', 4)))
+        self.delay = float(config.get('delay', settings.getfloat('DOWNLOAD_DELAY', 0)))
+        self.context_args = dict(config.get('context_args', {})) # 额外的浏览器上下文参数 (如 geolocation)
+
+    def search_url(self, keyword):
+        return f"{self.base_url}/s?k={quote_plus(keyword)}"
+
+    def product_url(self, asin):
+        return f"{self.base_url}/dp/{asin}"
+
+    def canonical_product_url(self, link, base=None):
+        """把搜索结果中的相对 / 跳转 / 其他站点链接规范化为本站点的 /dp/{ASIN}，返回 (url, asin)。"""
+        asin = extract_asin(urljoin(base or self.base_url, link))
+        return (self.product_url(asin), asin) if asin else (None, None)
+
+    def owns(self, url):
+        host = urlparse(url).hostname or ''
+        return host == self.host or host.endswith('.' + self.domain) or host == self.domain
+
+    def download_slot(self):
+        return {'concurrency': self.concurrency, 'delay': self.delay, 'randomize_delay': True}
+
+    def __repr__(self):
+        return f"<Marketplace {self.code} {self.base_url} {self.locale}>"
+
+
+def load_marketplaces(settings, codes=None):
+    """
+    按站点代码 (逗号分隔的字符串或列表) 返回 Marketplace 列表。
+    未指定时使用 CRAWL_MARKETPLACES；仍为空时只抓取 AMAZON_BASE_URL 对应的站点 (兼容单站点运行和基准测试)。
+    """
+    configs = settings.getdict('MARKETPLACES')
+    if isinstance(codes, str): codes = [c.strip() for c in codes.split(',') if c.strip()]
+    codes = codes or settings.getlist('CRAWL_MARKETPLACES')
+    if codes:
+        unknown = [code for code in codes if code not in configs]
+        if unknown: raise ValueError(f"未知的站点代码: {unknown}，可选: {sorted(configs)}")
+        return [Marketplace(code, configs[code], settings) for code in dict.fromkeys(codes)]
+    code = default_marketplace_code(settings)
+    return [Marketplace(code, configs.get(code) or {'base_url': settings.get('AMAZON_BASE_URL', 'https://www.amazon.com')}, settings)]
+
+
+def default_marketplace_code(settings):
+    """AMAZON_BASE_URL 对应的站点代码 (多站点之前唯一抓取的站点)；不在 MARKETPLACES 中时为其主机名。"""
+    base_url = settings.get('AMAZON_BASE_URL', 'https://www.amazon.com').rstrip('/')
+    for code, config in settings.getdict('MARKETPLACES').items():
+        if config['base_url'].rstrip('/') == base_url: return code
+    return urlparse(base_url).hostname
+
+
+def marketplace_for_url(marketplaces, url):
+    """按 URL 主机查找所属站点，找不到时返回 None。"""
+    return next((m for m in marketplaces if m.owns(url)), None)
@@ -2,113 +2,61 @@
 # 在此定义爬虫中间件的模型
 import random
 import logging
-import base64 # 用于代理认证编码
 from urllib.parse import urlparse # 用于解析代理 URL
 from scrapy import signals
 from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse
 from scrapy.downloadermiddlewares.retry import RetryMiddleware
 from scrapy.utils.response import response_status_message
 # 导入 TunnelError 以便在 process_exception 中检查
 from scrapy.core.downloader.handlers.http11 import TunnelError
+from twisted.internet.error import ConnectError, ConnectionRefusedError as TxConnectionRefusedError, DNSLookupError, TCPTimedOutError
+from amazonko.proxies import ProxyPool
+from amazonko.identity import IdentityManager, is_block_response
+from amazonko.watchdog import BrowserWatchdog
+from amazonko.rendercache import RenderedPageStore, rendered_cache_key
+from amazonko.snapshot import is_compact_response
 
 logger = logging.getLogger(__name__)
 
 # --- 通用 HTTP 代理中间件 ---
+# 视为代理连接级失败的响应状态码 (403/429/503 是 Amazon 的阻止，不代表代理不可用)
+PROXY_FAILURE_STATUSES = (407, 502, 504)
+# 视为代理连接级失败的异常 (Playwright 的就绪 / 导航 TimeoutError 多半是页面慢或选择器未出现，不计入熔断)
+PROXY_FAILURE_EXCEPTIONS = (TunnelError, ConnectionRefusedError, TxConnectionRefusedError, DNSLookupError, TCPTimedOutError, ConnectError)
+PROXY_FAILURE_NET_ERRORS = ('net::ERR_PROXY_', 'net::ERR_TUNNEL_CONNECTION_FAILED')
+
+def is_proxy_failure(exception):
+    """异常是否说明代理端点本身不可用 (连接 / 隧道 / DNS / TCP 超时，或 Chromium 的代理网络错误)。"""
+    if isinstance(exception, PROXY_FAILURE_EXCEPTIONS): return True
+    message = str(exception)
+    return any(marker in message for marker in PROXY_FAILURE_NET_ERRORS)
+
 class CustomHttpProxyMiddleware:
     """
     通用代理中间件，支持从 settings.py 中的 PROXY_CONFIG 配置多个提供商。
     - 为标准 Scrapy HTTPS 请求添加 Proxy-Authorization 头。
     - 为 Playwright 请求设置 meta['playwright_page_proxy']。
     - 处理特定提供商的额外请求头 (如 16yun 的 Proxy-Tunnel, Connection)。
+    - 通过 ProxyPool 的熔断器避开连续失败的端点；重试请求换用本请求未失败过的端点。
     """
-    def __init__(self, settings):
-        # 获取所有代理配置
-        self.proxy_configs = settings.getlist('PROXY_CONFIG')
-        # 过滤出已启用的配置
-        self.enabled_proxies = [p for p in self.proxy_configs if p.get('enabled')]
-
-        if not self.enabled_proxies:
-            raise NotConfigured("没有在 PROXY_CONFIG 中找到启用的代理配置。")
-
-        logger.info(f"Initialized CustomHttpProxyMiddleware with {len(self.enabled_proxies)} enabled proxy configurations.")
-
-        # 预计算 Basic Auth 头 (如果用户名密码直接可用)
-        self.proxy_auth_headers = {} # 存储 {完整代理URL: 认证头bytes}
-        for config in self.enabled_proxies:
-            username = config.get('username')
-            password = config.get('password')
-            if not username or not password: continue # 跳过没有完整认证信息的配置
-
-            user_pass = f"{username}:{password}"
-            encoded_user_pass = base64.b64encode(user_pass.encode()).decode('latin-1')
-            auth_header_bytes = b'Basic ' + encoded_user_pass.encode('latin-1')
-
-            # 根据配置类型构建代理 URL 并存储认证头
-            provider_type = config.get('provider_type')
-            endpoints = config.get('endpoints', [])
-            proxy_url_format = config.get('proxy_url_format')
-            host = config.get('host')
-            port = config.get('port')
-
-            if provider_type == 'oxylabs_isp': # Oxylabs 直接提供完整 URL
-                for endpoint_url in endpoints:
-                    # 格式化 URL (替换用户名密码占位符)
-                    formatted_url = endpoint_url.format(username=username, password=password)
-                    self.proxy_auth_headers[formatted_url] = auth_header_bytes
-            elif proxy_url_format and host and port: # 需要构建 URL (如 16yun)
-                proxy_url = proxy_url_format.format(username=username, password=password, host=host, port=port)
-                self.proxy_auth_headers[proxy_url] = auth_header_bytes
-            elif endpoints: # 尝试直接使用 endpoint 作为 key (如果它是完整 URL)
-                 for endpoint_url in endpoints:
-                     if "://" in endpoint_url: # 简单判断是否是 URL
-                          # 假设 endpoint 已包含认证或无需认证，或者需要后续处理
-                          # 这里可能需要根据具体情况调整，但至少为已知格式的 URL 存储了头
-                          # 对于 Oxylabs 这种已格式化的，这里会重复存储，但不影响
-                          self.proxy_auth_headers[endpoint_url] = auth_header_bytes
-
-        logger.debug(f"Pre-calculated auth headers for: {list(self.proxy_auth_headers.keys())}")
-
+    def __init__(self, pool):
+        self.pool = pool
+        logger.info(f"Initialized CustomHttpProxyMiddleware with {len(self.pool.endpoints)} proxy endpoints.")
+        logger.debug(f"Proxy endpoints: {self.pool.endpoints}")
 
     @classmethod
     def from_crawler(cls, crawler):
         # Scrapy 调用此方法来创建中间件实例
-        return cls(crawler.settings)
-
-    def _get_random_proxy(self):
-        """随机选择一个启用的代理配置，并返回其完整代理 URL 和配置字典。"""
-        if not self.enabled_proxies: return None, None # 没有可用代理
-
-        chosen_config = random.choice(self.enabled_proxies)
-        provider_type = chosen_config.get('provider_type', 'unknown')
-        endpoints = chosen_config.get('endpoints', [])
-        if not endpoints: return None, None # 配置无效
-
-        # 随机选择一个端点
-        endpoint = random.choice(endpoints)
-
-        # 构建完整的代理 URL
-        proxy_url = None
-        username = chosen_config.get('username')
-        password = chosen_config.get('password')
-        proxy_url_format = chosen_config.get('proxy_url_format')
-        host = chosen_config.get('host')
-        port = chosen_config.get('port')
-
-        # 优先使用格式化模板构建
-        if proxy_url_format and host and port and username and password:
-             proxy_url = proxy_url_format.format(username=username, password=password, host=host, port=port)
-        # 其次，如果 endpoint 本身包含协议头，认为它是完整 URL (适用于 Oxylabs)
-        elif "://" in endpoint:
-             # 如果 endpoint 模板包含占位符，进行替换
-             if "{username}" in endpoint and "{password}" in endpoint:
-                  proxy_url = endpoint.format(username=username, password=password)
-             else:
-                  proxy_url = endpoint # 假设 endpoint 已包含认证或无需认证
-        else: # 其他情况无法确定 URL
-             logger.error(f"无法为提供商 {provider_type} 构建有效的代理 URL (endpoint: {endpoint})")
-             return None, None
+        return cls(ProxyPool.from_crawler(crawler))
 
-        return proxy_url, chosen_config # 返回完整 URL 和配置字典
+    def _needs_new_proxy(self, request):
+        """预设的代理在本请求中失败过 (重试)、已熔断或半开且试探名额已被占用时，需要换一个端点。"""
+        proxy_url = request.meta.get('proxy')
+        if not proxy_url or '://' not in proxy_url: return True
+        if proxy_url in request.meta.get('proxy_failed', ()): return True
+        endpoint = self.pool.get(proxy_url)
+        return endpoint is not None and not self.pool.is_available(endpoint)
 
     def process_request(self, request, spider):
         # 处理请求，分配代理和认证
@@ -119,24 +67,37 @@ class CustomHttpProxyMiddleware:
         needs_proxy = True # 默认所有请求都需要代理，除非特殊标记
         # 可以添加逻辑，例如根据 URL 或 meta 标记某些请求不需要代理
         # if 'dont_proxy' in request.meta: needs_proxy = False
+        reassigned = False
 
         # 如果请求已设置有效代理，并且我们不需要强制更换，则跳过
-        if request.meta.get('proxy') and '://' in request.meta['proxy'] and needs_proxy:
+        if needs_proxy and not self._needs_new_proxy(request):
             logger.debug(f"Request already has proxy: {request.meta['proxy']}, skipping assignment.")
             proxy_url = request.meta['proxy']
-            provider_type = "unknown (preset)" # 无法轻易反查配置
+            endpoint = self.pool.get(proxy_url)
+            provider_type = endpoint.provider_type if endpoint else "unknown (preset)"
         elif needs_proxy:
-            # 获取一个随机代理及其配置
-            proxy_url, proxy_config = self._get_random_proxy()
-            if not proxy_url or not proxy_config:
-                logger.error("未能获取有效代理，请求将不使用代理。")
-                return # 不使用代理
+            # 从代理池 (请求所属站点的代理子集) 选择一个可用端点，排除本请求已失败过的端点
+            failed = request.meta.get('proxy_failed', ())
+            marketplace = getattr(spider, 'marketplaces', {}).get(request.meta.get('marketplace'))
+            candidates = self.pool.subset(marketplace.proxy_providers) if marketplace is not None else None
+            endpoint = self.pool.pick(exclude=failed, candidates=candidates)
+            reassigned = bool(request.meta.get('proxy'))
+            proxy_url = endpoint.url
             request.meta['proxy'] = proxy_url # 设置 Scrapy 使用的代理 meta
-            provider_type = proxy_config.get('provider_type', 'unknown')
-            logger.debug(f"[{provider_type}] Using proxy: {proxy_url} for request: {request.url}")
+            provider_type = endpoint.provider_type
+            if reassigned: logger.info(f"[{provider_type}] 重试请求换用代理端点 {endpoint} (已失败: {len(failed)} 个): {request.url}")
+            else: logger.debug(f"[{provider_type}] Using proxy: {proxy_url} for request: {request.url}")
+        else:
+            # 请求不需要代理
+            logger.debug(f"Request {request.url} does not require proxy, skipping assignment.")
+            proxy_url = None # 明确无代理
+            provider_type = None
+            endpoint = None
 
-            # --- 处理特定提供商的请求头 ---
-            extra_headers = proxy_config.get('headers', {})
+        # --- 处理特定提供商的请求头 (新分配的端点和预设的端点，如身份中间件分配的端点) ---
+        if endpoint is not None:
+            self.pool.claim(endpoint) # 请求经由该端点发出：半开端点由本请求占用唯一的试探名额
+            extra_headers = endpoint.config.get('headers', {})
             for header, value in extra_headers.items():
                 if header == 'Proxy-Tunnel' and value == 'random':
                     tunnel_id = str(random.randint(1, 10000))
@@ -145,15 +106,11 @@ class CustomHttpProxyMiddleware:
                 else:
                     request.headers[header] = value
                     logger.debug(f"[{provider_type}] Added header: {header}={value}")
-        else:
-            # 请求不需要代理
-            logger.debug(f"Request {request.url} does not require proxy, skipping assignment.")
-            proxy_url = None # 明确无代理
-            provider_type = None
 
         # --- 处理 Playwright ---
+        # (启用 IdentityMiddleware 时，代理通过身份的命名上下文 playwright_context_kwargs['proxy'] 生效)
         if is_playwright_request:
-            if 'playwright_page_proxy' not in request.meta and proxy_url:
+            if ('playwright_page_proxy' not in request.meta or reassigned) and proxy_url:
                 try:
                     parsed_proxy = urlparse(proxy_url)
                     if parsed_proxy.hostname and parsed_proxy.port and parsed_proxy.username and parsed_proxy.password:
@@ -167,7 +124,7 @@ class CustomHttpProxyMiddleware:
         # --- 处理标准 Scrapy HTTPS (CONNECT 隧道认证) ---
         # 仅当需要代理且是 HTTPS 请求时才添加认证头
         if needs_proxy and proxy_url and request.url.startswith('https'):
-            auth_header = self.proxy_auth_headers.get(proxy_url)
+            auth_header = endpoint.auth_header if endpoint else None
             if auth_header:
                  request.headers[b'Proxy-Authorization'] = auth_header
                  logger.debug(f"[{provider_type}] Added Proxy-Authorization header for standard HTTPS: {request.url}")
@@ -183,18 +140,141 @@ class CustomHttpProxyMiddleware:
              else:
                   logger.error(f"Image request {request.url} proceeding WITHOUT proxy!") # 这可以解释 Proxy None 错误
 
-    # (process_response 和 process_exception 保持不变)
+    def _record_failure(self, request, reason):
+        # 记录端点失败，并让重试请求避开该端点
+        proxy = request.meta.get('proxy')
+        if not proxy: return
+        self.pool.record_failure(proxy, reason=reason)
+        request.meta['proxy_failed'] = list(request.meta.get('proxy_failed', ())) + [proxy]
+
     def process_response(self, request, response, spider):
         proxy = request.meta.get('proxy')
         if response.status == 407: logger.error(f"Proxy Authentication Failed! Proxy: {proxy}...")
         elif response.status >= 500 or response.status in [403, 429]: logger.warning(f"Proxy {proxy} returned status {response.status}...")
-        elif "captcha" in response.text.lower(): logger.warning(f"Proxy {proxy} likely hit a CAPTCHA...")
+        elif "captcha" in getattr(response, 'text', '').lower(): logger.warning(f"Proxy {proxy} likely hit a CAPTCHA...")
+        if 'rendered_cache' in response.flags: return response # 来自缓存，未经过代理
+        if response.status in PROXY_FAILURE_STATUSES: self._record_failure(request, f"HTTP {response.status}")
+        elif proxy: self.pool.record_success(proxy)
         return response
     def process_exception(self, request, exception, spider):
         proxy = request.meta.get('proxy')
         if isinstance(exception, TunnelError): logger.error(f"TunnelError with proxy {proxy} for {request.url}: {exception}. Check proxy connectivity and credentials for HTTPS.")
         elif "TimeoutError" in str(type(exception)): logger.error(f"Playwright TimeoutError with proxy {proxy} for {request.url}: {exception}. Amazon might be blocking or proxy is too slow.")
         else: logger.error(f"Proxy {proxy} encountered exception: {exception} for request: {request.url}")
+        if is_proxy_failure(exception): self._record_failure(request, type(exception).__name__)
+        elif proxy: self.pool.release(proxy) # 页面超时等不说明代理不可用，只记录日志
+
+
+# --- 抓取身份中间件 ---
+class IdentityMiddleware:
+    """
+    为每个请求分配一致的抓取身份 (见 amazonko/identity.py)：
+    - 设置与身份一致的 User-Agent / Accept-Language 请求头 (CustomRandomUserAgentMiddleware 不再覆盖)。
+    - 设置身份的代理端点 (meta['proxy'])；CustomHttpProxyMiddleware 保留未失败、未熔断的预设代理。
+    - Playwright 请求使用身份的命名上下文 (playwright_context) 和上下文参数 (proxy / user_agent / viewport / locale)。
+    - 响应被阻止时向 IdentityManager 报告，连续被阻止后轮换身份；成功时 (节流) 保存会话 storage_state。
+    粘性键: meta['identity_key'] > meta['search_keyword'] > spider.search_keyword，多站点时加上站点代码 (每个站点独立的身份)。
+    """
+    def __init__(self, manager):
+        self.manager = manager
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('IDENTITY_ENABLED', True):
+            raise NotConfigured("IDENTITY_ENABLED 未启用。")
+        return cls(IdentityManager.from_crawler(crawler))
+
+    def _sticky_key(self, request, spider):
+        key = request.meta.get('identity_key') or request.meta.get('search_keyword') or getattr(spider, 'search_keyword', None) or 'default'
+        marketplace = request.meta.get('marketplace')
+        return f"{marketplace}:{key}" if marketplace else key
+
+    def process_request(self, request, spider):
+        identity = self.manager.get(request.meta.get('identity'))
+        if identity is None or identity.retired: # 新请求，或重试时原身份已轮换
+            marketplace = getattr(spider, 'marketplaces', {}).get(request.meta.get('marketplace'))
+            identity = self.manager.for_key(self._sticky_key(request, spider), marketplace)
+        self.manager.ensure_endpoint(identity, failed=request.meta.get('proxy_failed', ()))
+        request.meta['identity'] = identity.id
+        request.headers[b'User-Agent'] = identity.user_agent
+        request.headers[b'Accept-Language'] = identity.accept_language
+        if request.meta.get('playwright'):
+            request.meta['playwright_context'] = identity.context_name
+            request.meta['playwright_context_kwargs'] = dict(request.meta.get('playwright_context_kwargs', {}), **identity.context_kwargs())
+            if identity.endpoint is not None: request.meta['proxy'] = identity.endpoint.url
+        elif identity.endpoint is not None and not request.meta.get('proxy'):
+            request.meta['proxy'] = identity.endpoint.url # 图片请求通常已带有详情页使用的代理
+
+    async def process_response(self, request, response, spider):
+        identity = self.manager.get(request.meta.get('identity'))
+        if identity is None or 'rendered_cache' in response.flags: return response
+        if is_block_response(response): self.manager.report_block(identity, f"HTTP {response.status} {request.url}")
+        elif response.status == 200 and request.meta.get('playwright'):
+            self.manager.report_success(identity)
+            await self.manager.maybe_save_session(identity, request.meta.get('playwright_page')) # 保存 cookies / localStorage
+        return response
+
+
+class BrowserWatchdogMiddleware:
+    """
+    为浏览器看门狗 (见 amazonko/watchdog.py) 记录 Playwright 请求：
+    - 未指定上下文的请求使用当前代的默认上下文 (回收后换用新上下文)。
+    - 按上下文统计在途请求和已渲染页数 (渲染缓存命中不计页数)。
+    需要位于 IdentityMiddleware 之后 (身份上下文名称已确定)。
+    """
+    def __init__(self, watchdog):
+        self.watchdog = watchdog
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(BrowserWatchdog.from_crawler(crawler))
+
+    def process_request(self, request, spider):
+        if not request.meta.get('playwright'): return
+        name = request.meta['playwright_context'] = self.watchdog.context_for(request)
+        request.meta['watchdog_context'] = name
+        self.watchdog.request_started(name)
+
+    def _finished(self, request):
+        name = request.meta.pop('watchdog_context', None)
+        if name is not None: self.watchdog.request_finished(name)
+        return name
+
+    def process_response(self, request, response, spider):
+        name = self._finished(request)
+        if name is not None and request.meta.get('playwright_page') is not None:
+            manager = getattr(self.watchdog.crawler, 'identity_manager', None)
+            self.watchdog.page_rendered(name, manager.get(request.meta.get('identity')) if manager else None)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self._finished(request)
+
+
+class PageCloseSpiderMiddleware:
+    """
+    回调结束后 (正常结束、提前 return 或抛出异常) 关闭仍然打开的 Playwright 页面，
+    避免回调遗漏 page.close() 时页面一直占用浏览器内存。
+    """
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('WATCHDOG_ENABLED', True):
+            raise NotConfigured("WATCHDOG_ENABLED 未启用。")
+        return cls(crawler.stats)
+
+    async def process_spider_output(self, response, result, spider):
+        try:
+            async for output in result: yield output
+        finally:
+            page = response.meta.get('playwright_page') if response is not None else None
+            if page is not None and not page.is_closed():
+                logger.debug(f"回调结束时页面仍未关闭，已关闭: {response.url}")
+                self.stats.inc_value('watchdog/unclosed_pages')
+                try: await page.close()
+                except Exception as e: logger.debug(f"关闭页面时出错: {e}")
 
 
 # --- 自定义随机 User-Agent 中间件 ---
@@ -214,3 +294,75 @@ class CustomRandomUserAgentMiddleware:
         else: user_agent = self.fallback_ua; logger.warning(f"CustomRandomUserAgentMiddleware: Using fallback UA: {self.fallback_ua} for request: {request.url}")
         request.headers.setdefault(b'User-Agent', user_agent.encode('utf-8'))
         logger.info(f"CustomRandomUserAgentMiddleware: Assigned User-Agent: {user_agent} for request: {request.url}")
+
+
+# --- 渲染页面缓存中间件 ---
+class RenderedPageCacheMiddleware:
+    """
+    缓存 Playwright 渲染后的 HTML，命中时直接返回快照，不创建页面、不执行 playwright_page_methods。
+    - 缓存键: 规范化 URL + locale。
+    - 按 meta['page_type'] (search / detail) 使用不同的 TTL (RENDER_CACHE_TTLS)。
+    - 命中时 meta 中没有 'playwright_page'，回调需要处理 page 为 None 的情况。
+    - 设置 meta['render_cache_skip'] = True 可以跳过缓存。
+    - 阻止页面 (与身份中间件相同的判断) 不写入缓存；compact 模式下没有生成精简快照的页面 (缺少预期内容) 也不写入。
+    """
+    def __init__(self, settings, stats):
+        if not settings.getbool('RENDER_CACHE_ENABLED'):
+            raise NotConfigured("RENDER_CACHE_ENABLED 未启用。")
+        self.ttls = settings.getdict('RENDER_CACHE_TTLS', {})
+        self.default_ttl = settings.getint('RENDER_CACHE_DEFAULT_TTL', 3600)
+        self.default_locale = settings.getdict('PLAYWRIGHT_CONTEXT_ARGS').get('locale', 'en-US')
+        self.store = RenderedPageStore(
+            settings.get('RENDER_CACHE_PATH', 'httpcache/rendered.sqlite3'),
+            max_bytes=settings.getint('RENDER_CACHE_MAX_BYTES', 0),
+            compress_level=settings.getint('RENDER_CACHE_COMPRESS_LEVEL', 6),
+            access_batch=settings.getint('RENDER_CACHE_ACCESS_BATCH', 100),
+        )
+        self.compact_only = settings.get('DOM_EXTRACTION_MODE', 'compact') == 'compact'
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        mw = cls(crawler.settings, crawler.stats)
+        crawler.signals.connect(mw.spider_closed, signal=signals.spider_closed)
+        return mw
+
+    def spider_closed(self, spider):
+        self.store.close()
+
+    def _cache_key_and_ttl(self, request):
+        page_type = request.meta.get('page_type', 'default')
+        ttl = int(self.ttls.get(page_type, self.default_ttl))
+        locale = request.meta.get('playwright_context_kwargs', {}).get('locale', self.default_locale)
+        return rendered_cache_key(request.url, locale), page_type, ttl
+
+    def process_request(self, request, spider):
+        if not request.meta.get('playwright') or request.meta.get('render_cache_skip'): return
+        key, page_type, ttl = self._cache_key_and_ttl(request)
+        if ttl <= 0: return # 该页面类型不缓存
+        cached = self.store.get(key, ttl)
+        if cached is None:
+            self.stats.inc_value(f'rendered_cache/miss/{page_type}', spider=spider)
+            return
+        url, status, body = cached
+        self.stats.inc_value(f'rendered_cache/hit/{page_type}', spider=spider)
+        request.meta['render_cache_hit'] = True
+        logger.debug(f"渲染页面缓存命中 [{page_type}]: {request.url}")
+        return HtmlResponse(url=url, status=status, body=body, encoding='utf-8', request=request, flags=['rendered_cache'])
+
+    def process_response(self, request, response, spider):
+        if not request.meta.get('playwright') or request.meta.get('render_cache_hit') or request.meta.get('render_cache_skip'): return response
+        if response.status != 200 or not isinstance(response, HtmlResponse): return response
+        key, page_type, ttl = self._cache_key_and_ttl(request)
+        if ttl <= 0: return response
+        if is_block_response(response): # 只在前 16 KB 中查找标题，不为读取标题构建整页 lxml 树
+            logger.debug(f"错误/阻止页面不写入渲染缓存: {response.url}")
+            return response
+        if self.compact_only and not is_compact_response(response):
+            logger.debug(f"没有生成精简快照的页面不写入渲染缓存: {response.url}")
+            return response
+        try:
+            self.store.put(key, response.url, page_type, response.status, response.body)
+            self.stats.inc_value(f'rendered_cache/store/{page_type}', spider=spider)
+        except Exception as e: logger.error(f"写入渲染页面缓存失败: {response.url} - Error: {e}")
+        return response
@@ -7,42 +7,136 @@
 import csv
 import os
 import logging
-from itemadapter import ItemAdapter # 用于方便地访问 Item 字段
-from scrapy.exceptions import DropItem # 用于丢弃 Item
-from scrapy.pipelines.images import ImagesPipeline # 导入图片管道基类
+import hashlib
+from io import BytesIO
+from dataclasses import fields
+from operator import attrgetter # 一次性取出 CSV 行所需的全部字段
+from twisted.internet import defer, task, threads
+from twisted.python.threadpool import ThreadPool
+from scrapy import signals
+from scrapy.exceptions import DropItem, NotConfigured # 用于丢弃 Item
+from scrapy.pipelines.files import FilesPipeline, FSFilesStore
+from scrapy.pipelines.images import ImagesPipeline, ImageException # 导入图片管道基类
+from scrapy.utils.defer import maybe_deferred_to_future
 from scrapy import Request # 用于创建下载请求
+from amazonko.items import AmazonkoItem, normalize_item
+from amazonko.store import ProductStore
+from amazonko.marketplaces import default_marketplace_code
+from amazonko.feed import FeedServer, item_line
+from amazonko.profiling import timed
 
 logger = logging.getLogger(__name__)
 
+# --- 图片格式检测 (根据文件头魔数) ---
+# Image format detection (by magic bytes)
+IMAGE_MAGIC_NUMBERS = (
+    (b'\xff\xd8\xff', 'jpeg', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png', 'image/png'),
+    (b'GIF87a', 'gif', 'image/gif'),
+    (b'GIF89a', 'gif', 'image/gif'),
+)
+
+def detect_image_format(data):
+    """返回 (格式, MIME 类型)；无法识别时返回 (None, None)。"""
+    for magic, image_format, mime_type in IMAGE_MAGIC_NUMBERS:
+        if data.startswith(magic): return image_format, mime_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP': return 'webp', 'image/webp'
+    if data[4:12] in (b'ftypavif', b'ftypavis'): return 'avif', 'image/avif'
+    return None, None
+
+
 # --- 图片下载管道 (继承并修改默认管道) ---
 class CustomImagePipeline(ImagesPipeline):
     """
     处理图片下载，并将下载后的默认文件名存储到 Item 中。
     Handles image downloading and stores the default downloaded filename into the Item.
+
+    IMAGES_STORAGE_MODE = 'original' (默认) 时不经过 PIL 解码和 JPEG 重新编码：
+    按魔数检测格式后原样保存，MD5 只计算一次；可选的校验 / 缩放 (IMAGES_VALIDATE,
+    IMAGES_MAX_DIMENSION) 和写盘都在线程池中执行，并用信号量限制排队数量，不阻塞 reactor。
+    IMAGES_STORAGE_MODE = 'reencode' 时保持 ImagesPipeline 的默认行为。
     """
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = super().from_crawler(crawler)
+        settings = crawler.settings
+        pipeline.storage_mode = settings.get('IMAGES_STORAGE_MODE', 'original')
+        pipeline.validate_images = settings.getbool('IMAGES_VALIDATE', False)
+        pipeline.max_dimension = settings.getint('IMAGES_MAX_DIMENSION', 0) # 0 表示不缩放
+        pipeline.worker_pool = None
+        if pipeline.storage_mode == 'original':
+            pipeline.worker_pool = ThreadPool(minthreads=1, maxthreads=settings.getint('IMAGES_WORKER_THREADS', 2), name='image-workers')
+            pipeline.worker_pool.start()
+            # 同时提交到线程池的任务数上限 (其余在信号量上等待)
+            pipeline.worker_semaphore = defer.DeferredSemaphore(settings.getint('IMAGES_WORKER_QUEUE_SIZE', 8))
+            crawler.signals.connect(pipeline._stop_worker_pool, signal=signals.spider_closed)
+            logger.info(f"CustomImagePipeline: 原样保存图片 (校验: {pipeline.validate_images}, 最大边长: {pipeline.max_dimension or '不限'})")
+        return pipeline
+
+    def _stop_worker_pool(self, spider):
+        if self.worker_pool is not None: self.worker_pool.stop()
+
+    async def file_downloaded(self, response, request, info, *, item=None):
+        if self.storage_mode != 'original':
+            return await super().file_downloaded(response, request, info, item=item)
+        from twisted.internet import reactor # 延迟导入，避免在 Scrapy 安装 asyncio reactor 之前安装默认 reactor
+        path = self.file_path(request, response=response, info=info, item=item)
+        return await maybe_deferred_to_future(self.worker_semaphore.run(
+            threads.deferToThreadPool, reactor, self.worker_pool, self._store_original, path, response.body, info, request.url
+        ))
+
+    def _store_original(self, path, body, info, url):
+        """(在线程池中执行) 检测格式、可选校验/缩放、计算校验和并保存，返回 MD5。"""
+        image_format, mime_type = detect_image_format(body)
+        if image_format is None:
+            raise ImageException(f"不是可识别的图片格式 (文件头: {body[:8]!r}): {url}")
+        if self.validate_images or self.max_dimension:
+            body = self._validate_and_resize(body, image_format, url)
+        checksum = hashlib.md5(body).hexdigest() # 只计算一次
+        if isinstance(self.store, FSFilesStore):
+            self.store.persist_file(path, BytesIO(body), info, headers={'Content-Type': mime_type})
+        else:
+            # S3 / GCS 等存储返回 Deferred，需要回到 reactor 线程执行
+            from twisted.internet import reactor
+            threads.blockingCallFromThread(reactor, self.store.persist_file, path, BytesIO(body), info, headers={'Content-Type': mime_type})
+        return checksum
+
+    def _validate_and_resize(self, body, image_format, url):
+        """(在线程池中执行) 用 PIL 校验图片并检查最小尺寸，超过 IMAGES_MAX_DIMENSION 时按原格式缩小。"""
+        with self._Image.open(BytesIO(body)) as image:
+            image.load()
+            width, height = image.size
+            if width < self.min_width or height < self.min_height:
+                raise ImageException(f"图片尺寸过小 ({width}x{height} < {self.min_width}x{self.min_height}): {url}")
+            if not self.max_dimension or max(width, height) <= self.max_dimension: return body
+            image.thumbnail((self.max_dimension, self.max_dimension), self._Image.LANCZOS)
+            buf = BytesIO()
+            image.save(buf, image.format or image_format.upper())
+            return buf.getvalue()
+
     # 重写 get_media_requests 以便传递代理信息
     def get_media_requests(self, item, info):
-        adapter = ItemAdapter(item)
-        urls = adapter.get(self.images_urls_field, [])
+        urls = item.image_urls_to_download
         if not urls:
-            logger.warning(f"Item 没有要下载的图片 URL: {adapter.get('product_url') or adapter.get('title')}")
+            logger.warning(f"Item 没有要下载的图片 URL: {item.product_url or item.title}")
             return
 
-        # *** 从 Item 中获取之前保存的代理信息 ***
-        proxy_to_use = adapter.get('proxy_info_for_images')
-        # **************************************
+        # *** 从爬虫的 item_context 中取出 (并移除) 之前保存的代理信息 ***
+        proxy_to_use = getattr(info.spider, 'item_context', {}).pop((item.marketplace, item.asin), None) # 同一 ASIN 在各站点使用各自的代理
+        # **************************************************************
 
         requests = []
         for url in urls:
-            img_request = Request(url)
+            # 图片使用独立的下载 slot 和请求类别，不占用页面请求的并发预算
+            img_request = Request(url, meta={'request_class': 'image', 'download_slot': 'images'})
             # *** 如果获取到了代理信息，则设置到图片请求的 meta 中 ***
             if proxy_to_use:
                 img_request.meta['proxy'] = proxy_to_use
-                logger.debug(f"为图片 {url} 设置代理 (来自 Item): {proxy_to_use}")
+                logger.debug(f"为图片 {url} 设置代理 (来自 item_context): {proxy_to_use}")
             else:
-                # 如果 Item 中没有代理信息（可能来自旧的或非 Playwright 请求），
-                # 记录警告，并依赖中间件分配（可能导致 Proxy None）
-                logger.warning(f"Item (URL: {adapter.get('product_url')}) 中缺少 proxy_info_for_images，图片请求 {url} 可能无法使用代理！")
+                # 如果没有代理信息（例如渲染缓存命中的页面），
+                # 记录调试信息，并依赖中间件分配
+                logger.debug(f"Item (URL: {item.product_url}) 没有关联的代理信息，图片请求 {url} 将由中间件分配代理。")
             # ****************************************************
             requests.append(img_request)
 
@@ -57,18 +151,17 @@ class CustomImagePipeline(ImagesPipeline):
         image_info_or_failure 是一个字典 (成功时) 或 Twisted Failure 对象 (失败时)。
         image_info_or_failure is a dict (on success) or a Twisted Failure object (on failure).
         """
-        adapter = ItemAdapter(item)
         # 从结果中提取成功下载的图片信息中的 'path' 字段
         # Extract the 'path' field from successfully downloaded image info in results
         image_paths = [x['path'] for ok, x in results if ok and 'path' in x]
 
         if not image_paths:
             # 如果没有任何图片成功下载
-            logger.warning(f"未能为 Item 下载任何图片: {item.get('product_url') or item.get('title')}")
-            adapter['downloaded_image_name'] = None # 明确设置为空
+            logger.warning(f"未能为 Item 下载任何图片: {item.product_url or item.title}")
+            item.downloaded_image_name = None # 明确设置为空
             # 根据需求决定是否丢弃 Item
             # Decide whether to drop the Item based on requirements
-            # raise DropItem(f"No images downloaded for {item.get('product_url')}")
+            # raise DropItem(f"No images downloaded for {item.product_url}")
         else:
             # 假设我们只关心第一张成功下载的图片的文件名
             # Assume we only care about the filename of the first successfully downloaded image
@@ -76,16 +169,12 @@ class CustomImagePipeline(ImagesPipeline):
             # ImagesPipeline uses SHA1 hash of the URL as filename by default, path is like 'full/abcdef123456.jpg'
             # 从路径中提取文件名
             # Extract the filename from the path
-            adapter['downloaded_image_name'] = os.path.basename(image_paths[0])
-            logger.debug(f"成功下载图片 {adapter['downloaded_image_name']} for item: {item.get('product_url')}")
+            item.downloaded_image_name = os.path.basename(image_paths[0])
+            logger.debug(f"成功下载图片 {item.downloaded_image_name} for item: {item.product_url}")
 
         # Scrapy 的 ImagesPipeline 默认会将 results 写入 IMAGES_RESULT_FIELD 字段
         # Scrapy's ImagesPipeline will write results to the IMAGES_RESULT_FIELD by default
-        # adapter[self.images_result_field] = results # 如果需要显式存储
-        
-        # 清理掉不再需要的代理信息 (可选)
-        #if 'proxy_info_for_images' in adapter:
-        #     del adapter['proxy_info_for_images']
+        # item.image_download_results = results # 如果需要显式存储
 
         return item # 必须返回 Item 对象以供后续管道处理
                      # Must return the Item object for subsequent pipelines
@@ -98,7 +187,11 @@ class CustomImagePipeline(ImagesPipeline):
         By default, it uses the SHA1 hash of the URL.
         需求是记录默认名称，所以我们保持默认行为。
         Requirement is to record the default name, so we keep the default behavior.
+        original 模式下扩展名取自 URL (FilesPipeline 的规则)，而不是固定的 .jpg。
+        In 'original' mode the extension comes from the URL (FilesPipeline rule) instead of a fixed .jpg.
         """
+        if getattr(self, 'storage_mode', 'reencode') == 'original':
+            return FilesPipeline.file_path(self, request, response=response, info=info, item=item)
         # 调用父类的默认实现
         # Call the parent class's default implementation
         return super().file_path(request, response=response, info=info, item=item)
@@ -142,22 +235,26 @@ class DuplicateItemPipeline:
     def process_item(self, item, spider):
         # 处理每个 Item
         # Process each Item
-        adapter = ItemAdapter(item)
-        # 优先使用 ASIN 作为唯一标识，其次使用 product_url
-        # Prioritize ASIN as the unique identifier, then product_url
-        item_id = adapter.get('asin') or adapter.get('product_url')
+        # 所有管道共用的数据清洗只在这里执行一次
+        # The shared normalization runs once here, for all pipelines
+        normalize_item(item)
+        # 优先使用 ASIN 作为唯一标识，其次使用 product_url (同一 ASIN 在不同站点是不同的商品页)
+        # Prioritize ASIN as the unique identifier, then product_url (the same ASIN on another marketplace is a distinct page)
+        item_id = item.asin or item.product_url
+        if item_id and item.marketplace: item_id = f"{item.marketplace}:{item_id}"
 
         if not item_id:
             # 如果没有唯一标识，无法去重，直接通过
             # If no unique identifier, cannot deduplicate, pass through
-            logger.warning(f"Item 缺少唯一标识 (ASIN or product_url): {adapter.get('title')}")
+            logger.warning(f"Item 缺少唯一标识 (ASIN or product_url): {item.title}")
             return item
 
         # 检查此 ID 是否已存在于集合中
         # Check if this ID already exists in the set
         if item_id in self.ids_seen:
-            # 如果已存在，则认为是重复 Item，丢弃它
-            # If it exists, consider it a duplicate Item and drop it
+            # 如果已存在，则认为是重复 Item，丢弃它 (同时清理其代理上下文)
+            # If it exists, consider it a duplicate Item and drop it (and release its proxy context)
+            getattr(spider, 'item_context', {}).pop((item.marketplace, item.asin), None)
             raise DropItem(f"发现重复 Item: {item_id}")
         else:
             # 如果是新 Item，将其 ID 添加到集合中，并允许通过
@@ -180,11 +277,19 @@ class CsvExportPipeline:
         # Get CSV output filename and fields to export from settings
         self.output_file = settings.get('CSV_OUTPUT_FILE', 'output.csv')
         self.fields_to_export = settings.getlist('CSV_EXPORT_FIELDS', []) # 默认为空列表
+        item_fields = {f.name for f in fields(AmazonkoItem)}
+        unknown_fields = [f for f in self.fields_to_export if f not in item_fields]
+        if unknown_fields:
+             logger.error(f"CSV_EXPORT_FIELDS 包含 AmazonkoItem 中不存在的字段，已忽略: {unknown_fields}")
+             self.fields_to_export = [f for f in self.fields_to_export if f in item_fields]
         if not self.fields_to_export:
              logger.error("CSV_EXPORT_FIELDS is not defined or empty in settings. Cannot export CSV.")
              # raise NotConfigured("CSV_EXPORT_FIELDS is required for CsvExportPipeline")
+        # 预先构建字段取值函数，每行直接得到一个元组，无需再构建 dict
+        # Pre-build the field getter so each row is a tuple, no per-row dict
+        self.row_getter = attrgetter(*self.fields_to_export) if self.fields_to_export else None
         self.file = None # 文件句柄
-        self.writer = None # csv DictWriter 对象
+        self.writer = None # csv writer 对象
         self.encoder = settings.get('CSV_EXPORT_ENCODING', 'utf-8') # 文件编码
         self.include_header = settings.getbool('CSV_INCLUDE_HEADER', True) # 是否包含表头
         self.first_item = True # 用于控制是否写入表头
@@ -214,13 +319,13 @@ class CsvExportPipeline:
             # 使用 'w' 模式打开文件（覆盖），指定编码和 newline=''
             # Open the file in 'w' mode (overwrite), specify encoding and newline=''
             self.file = open(self.output_file, 'w', newline='', encoding=self.encoder)
-            # 创建 DictWriter，指定字段名，extrasaction='ignore' 忽略 Item 中多余的字段
-            # Create DictWriter, specify fieldnames, extrasaction='ignore' ignores extra fields in Item
-            self.writer = csv.DictWriter(self.file, fieldnames=self.fields_to_export, extrasaction='ignore')
+            # 创建 csv writer，按 CSV_EXPORT_FIELDS 的顺序写入元组行
+            # Create csv writer, rows are tuples in CSV_EXPORT_FIELDS order
+            self.writer = csv.writer(self.file)
             # 如果需要写入表头且是第一次写入
             # If header is needed and it's the first write
             if self.include_header:
-                self.writer.writeheader()
+                self.writer.writerow(self.fields_to_export)
                 self.first_item = False
             logger.info(f"CsvExportPipeline opened. Exporting to {self.output_file}")
         except IOError as e:
@@ -241,37 +346,112 @@ class CsvExportPipeline:
              logger.warning("CSV writer not available, skipping item export.")
              return item # 如果 writer 未初始化，直接返回
 
-        adapter = ItemAdapter(item)
-
-        # --- 数据清洗示例 ---
-        # Example Data Cleaning
-        # 清洗标题：去除首尾空白，合并中间多余空白
-        # Clean title: strip leading/trailing whitespace, consolidate internal whitespace
-        if adapter.get('title'):
-            adapter['title'] = ' '.join(adapter['title'].split())
-
-        # 确保要导出的字段都存在于 adapter 中，即使值为 None
-        # Ensure all fields to export exist in the adapter, even if None
-        row_data = {}
-        for field in self.fields_to_export:
-            row_data[field] = adapter.get(field) # 使用 get 获取，不存在则为 None
-
-        # 提取主图 URL (如果尚未在 Item 中设置)
-        # Extract main image URL (if not already set in the Item)
-        if 'main_image_url' in self.fields_to_export and not row_data.get('main_image_url'):
-            urls_to_download = adapter.get('image_urls_to_download')
-            if urls_to_download and isinstance(urls_to_download, list) and len(urls_to_download) > 0:
-                row_data['main_image_url'] = urls_to_download[0]
+        # 数据清洗 (标题空白、主图 URL) 已由 DuplicateItemPipeline 中的 normalize_item 完成
+        # Data cleaning (title whitespace, main image URL) is done by normalize_item in DuplicateItemPipeline
+        row_data = self.row_getter(item)
+        if len(self.fields_to_export) == 1: row_data = (row_data,) # attrgetter 单字段时返回标量
 
         # 写入 CSV 行
         # Write the row to CSV
         try:
-            self.writer.writerow(row_data)
+            with timed('pipeline.csv_write'): self.writer.writerow(row_data)
         except Exception as e:
             logger.error(f"写入 Item 到 CSV 时出错: {e} - Item: {row_data}")
             # 可以选择在这里抛出 DropItem 或记录错误后继续
             # Can choose to raise DropItem here or log the error and continue
-            # raise DropItem(f"Failed to write item to CSV: {adapter.get('product_url')}")
+            # raise DropItem(f"Failed to write item to CSV: {item.product_url}")
 
         return item # 返回 Item 以便其他管道继续处理 (如果还有的话)
                      # Return the item for potential processing by subsequent pipelines
+
+
+# --- SQLite 输出管道 ---
+class SqliteStorePipeline:
+    """
+    将 Item 批量 upsert 到 SQLite 数据库 (products / variations / keyword_hits)。
+    Batch-upserts Items into a SQLite database (products / variations / keyword_hits).
+    数据跨运行累积，供看板按 ASIN / 关键词 / 抓取时间做索引查询。
+    Data accumulates across runs for indexed dashboard queries by ASIN / keyword / crawl time.
+    """
+    def __init__(self, settings):
+        self.db_path = settings.get('SQLITE_STORE_PATH', 'amazon_products.sqlite3')
+        self.batch_size = settings.getint('SQLITE_STORE_BATCH_SIZE', 100)
+        self.flush_interval = settings.getfloat('SQLITE_STORE_FLUSH_INTERVAL', 30) # 秒，0 表示只按批次大小写入
+        self.default_marketplace = default_marketplace_code(settings) # Item 没有站点时写入的站点
+        self.store = None
+        self._flush_loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings)
+
+    def open_spider(self, spider):
+        # 爬虫启动时打开数据库 (表和索引不存在时创建)
+        # Open the database when the spider starts (creates tables and indexes if missing)
+        self.store = ProductStore(self.db_path, batch_size=self.batch_size, default_marketplace=self.default_marketplace)
+        if self.flush_interval > 0:
+            # 定时写入未满一批的数据，看板无需等到整批
+            # Periodically flush partial batches so dashboards don't wait for a full batch
+            self._flush_loop = task.LoopingCall(self._flush)
+            self._flush_loop.start(self.flush_interval, now=False)
+
+    def _flush(self):
+        # 定时写入出错 (如 database is locked) 时只记录日志，LoopingCall 不会因异常停止；缓冲保留到下一次写入
+        # Log periodic flush errors (e.g. database is locked) instead of letting them stop the LoopingCall; the buffer is kept for the next flush
+        try:
+            self.store.flush()
+        except Exception as e:
+            logger.error(f"定时写入 SQLite 失败，将在下一次写入时重试: {e}")
+
+    def close_spider(self, spider):
+        if self._flush_loop and self._flush_loop.running: self._flush_loop.stop()
+        if self.store:
+            self.store.close()
+            logger.info(f"SqliteStorePipeline closed. {self.store.written} items saved to {self.db_path}")
+
+    def process_item(self, item, spider):
+        try:
+            self.store.add(item)
+        except Exception as e:
+            logger.error(f"写入 Item 到 SQLite 时出错: {e} - ASIN: {item.asin}")
+        return item
+
+
+class StreamFeedPipeline:
+    """
+    抓取期间把 Item 实时推送给下游消费者 (NDJSON over Unix socket / HTTP chunked / SSE，见 amazonko/feed.py)。
+    Streams Items to downstream consumers while the crawl runs (see amazonko/feed.py).
+    消费者跟不上时 process_item 等待 (有界队列背压)，抓取随之变慢而不是占用更多内存。
+    When a consumer falls behind, process_item waits (bounded-queue backpressure) so the crawl slows down instead of buffering.
+    """
+    def __init__(self, settings):
+        if not settings.getbool('STREAM_FEED_ENABLED', False):
+            raise NotConfigured("STREAM_FEED_ENABLED 未启用")
+        item_fields = {f.name for f in fields(AmazonkoItem)}
+        self.fields = [f for f in settings.getlist('STREAM_FEED_FIELDS') or settings.getlist('CSV_EXPORT_FIELDS') if f in item_fields] \
+            or sorted(item_fields)
+        self.feed = FeedServer(
+            unix_socket=settings.get('STREAM_FEED_UNIX_SOCKET') or None,
+            http_port=settings.getint('STREAM_FEED_HTTP_PORT', 0) or None,
+            http_host=settings.get('STREAM_FEED_HTTP_HOST', '127.0.0.1'),
+            max_queue=settings.getint('STREAM_FEED_CLIENT_QUEUE', 1000),
+            slow_client_timeout=settings.getfloat('STREAM_FEED_SLOW_CLIENT_TIMEOUT', 60),
+        )
+        if not (self.feed.unix_socket or self.feed.http_port):
+            raise NotConfigured("STREAM_FEED_UNIX_SOCKET 和 STREAM_FEED_HTTP_PORT 都未设置")
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings)
+
+    def open_spider(self, spider):
+        self.feed.start()
+
+    def close_spider(self, spider):
+        self.feed.stop()
+        logger.info(f"StreamFeedPipeline closed. {self.feed.published} items published")
+
+    async def process_item(self, item, spider):
+        if self.feed.clients: # 没有消费者时不序列化
+            await maybe_deferred_to_future(self.feed.publish(item_line(item, self.fields)))
+        return item
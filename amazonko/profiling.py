@@ -0,0 +1,226 @@
+# 按需性能剖析 (采样 CPU 剖析 / 异步等待计时 / tracemalloc 快照)
+# On-demand profiling (sampling CPU profile / async wait timing / tracemalloc snapshots)
+#
+# 通过 PROFILING_ENABLED 在启动时开启，或向进程发送 SIGUSR2 随时开关。
+# - 采样剖析：后台线程每隔 PROFILING_SAMPLE_INTERVAL 秒读取 reactor 线程的调用栈，
+#   按 "折叠栈" 格式计数 (可直接交给 flamegraph.pl / speedscope)。采样期间不影响 reactor 线程本身。
+# - 计时：timed(label) 上下文管理器记录代码块的墙钟时间，块内的 await (Playwright 调用等) 也计入；
+#   另外按请求类别记录下载耗时 (download_latency，包含 goto 和等待条件)。
+# - tracemalloc：PROFILING_TRACEMALLOC 开启时定期保存分配最多的代码行及与上一次快照的差异 (开销较大，默认关闭)。
+# 输出写入 PROFILING_DIR/<爬虫名>-<时间>-<pid>/，每次运行一个目录。
+
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+from amazonko.utils import request_class
+
+logger = logging.getLogger(__name__)
+
+_active = None # 当前运行中的 Profiler (timed() 使用)
+
+
+@contextmanager
+def timed(label):
+    """记录代码块的墙钟时间 (包括块内 await 的等待时间)；剖析未开启时几乎没有开销。"""
+    profiler = _active
+    if profiler is None or not profiler.running:
+        yield; return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.record(label, time.perf_counter() - start)
+
+
+class StackSampler(threading.Thread):
+    """后台线程：定期采样目标线程的调用栈，按折叠栈计数。"""
+    def __init__(self, thread_id, interval, max_depth=64):
+        super().__init__(name='amazonko-profiler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self.lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None: continue
+            names = []
+            while frame is not None and len(names) < self.max_depth:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            with self.lock:
+                self.stacks[';'.join(reversed(names))] += 1; self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+
+    def collapsed(self):
+        with self.lock:
+            return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + '\n'
+
+
+class Profiler:
+    """单次运行的剖析状态：采样线程、计时汇总、tracemalloc 快照。"""
+    def __init__(self, output_dir, sample_interval, tracemalloc_enabled=False, tracemalloc_frames=1, tracemalloc_top=25):
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.tracemalloc_enabled = tracemalloc_enabled
+        self.tracemalloc_frames = tracemalloc_frames
+        self.tracemalloc_top = tracemalloc_top
+        self.timings = {} # label -> [次数, 总耗时, 最大耗时]
+        self.sampler = None
+        self.running = False
+        self._snapshot = None
+        self._snapshot_count = 0
+
+    def start(self, thread_id):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.sampler = StackSampler(thread_id, self.sample_interval)
+        self.sampler.start()
+        if self.tracemalloc_enabled and not tracemalloc.is_tracing(): tracemalloc.start(self.tracemalloc_frames)
+        self.running = True
+        logger.info(f"性能剖析已开启 (采样间隔 {self.sample_interval}s, tracemalloc: {self.tracemalloc_enabled})，输出目录: {self.output_dir}")
+
+    def stop(self):
+        if not self.running: return
+        self.running = False
+        self.sampler.stop(); self.sampler.join(timeout=1)
+        self.flush()
+        if self.tracemalloc_enabled:
+            self.take_snapshot(); tracemalloc.stop(); self._snapshot = None
+        logger.info(f"性能剖析已停止 ({self.sampler.samples} 个样本)，输出目录: {self.output_dir}")
+
+    def record(self, label, seconds):
+        entry = self.timings.get(label)
+        if entry is None: self.timings[label] = [1, seconds, seconds]
+        else: entry[0] += 1; entry[1] += seconds; entry[2] = max(entry[2], seconds)
+
+    def flush(self):
+        """写出当前的折叠栈和计时汇总 (覆盖上一次的文件)。"""
+        if self.sampler is None: return
+        with open(os.path.join(self.output_dir, 'cpu.collapsed'), 'w', encoding='utf-8') as f:
+            f.write(self.sampler.collapsed())
+        summary = {label: {'count': count, 'total_s': round(total, 4), 'mean_ms': round(total / count * 1000, 2), 'max_ms': round(peak * 1000, 2)}
+                   for label, (count, total, peak) in sorted(self.timings.items(), key=lambda kv: -kv[1][1])}
+        with open(os.path.join(self.output_dir, 'timings.json'), 'w', encoding='utf-8') as f:
+            json.dump({'samples': self.sampler.samples, 'sample_interval': self.sample_interval, 'timings': summary}, f, ensure_ascii=False, indent=2)
+
+    def take_snapshot(self):
+        """保存分配最多的代码行，以及与上一次快照相比增长最多的代码行。"""
+        if not tracemalloc.is_tracing(): return
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        self._snapshot_count += 1
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"# {datetime.now().isoformat()} traced={current / 1048576:.1f}MB peak={peak / 1048576:.1f}MB", "", "## top"]
+        lines += [str(stat) for stat in snapshot.statistics('lineno')[:self.tracemalloc_top]]
+        if self._snapshot is not None:
+            lines += ["", "## diff"]
+            lines += [str(stat) for stat in snapshot.compare_to(self._snapshot, 'lineno')[:self.tracemalloc_top]]
+        self._snapshot = snapshot
+        path = os.path.join(self.output_dir, f"tracemalloc-{self._snapshot_count:03d}.txt")
+        with open(path, 'w', encoding='utf-8') as f: f.write('\n'.join(lines) + '\n')
+
+
+class ProfilingExtension:
+    """
+    按需剖析扩展。PROFILING_ENABLED 时随爬虫启动；PROFILING_SIGNAL 时可用 SIGUSR2 开关
+    (kill -USR2 <pid>)，每次开启写入新的输出目录。两者都关闭时不加载。
+    """
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.enabled = settings.getbool('PROFILING_ENABLED', False)
+        self.use_signal = settings.getbool('PROFILING_SIGNAL', True) and hasattr(signal, 'SIGUSR2')
+        if not self.enabled and not self.use_signal:
+            raise NotConfigured
+        self.crawler = crawler
+        self.base_dir = settings.get('PROFILING_DIR', 'profiles')
+        self.sample_interval = settings.getfloat('PROFILING_SAMPLE_INTERVAL', 0.05)
+        self.flush_interval = settings.getfloat('PROFILING_FLUSH_INTERVAL', 60)
+        self.tracemalloc_enabled = settings.getbool('PROFILING_TRACEMALLOC', False)
+        self.tracemalloc_interval = settings.getfloat('PROFILING_TRACEMALLOC_INTERVAL', 300)
+        self.tracemalloc_frames = settings.getint('PROFILING_TRACEMALLOC_FRAMES', 1)
+        self.tracemalloc_top = settings.getint('PROFILING_TRACEMALLOC_TOP', 25)
+        self.profiler = None
+        self.spider_name = None
+        self.reactor_thread_id = None
+        self._loops = []
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        ext = cls(crawler)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(ext.response_received, signal=signals.response_received)
+        return ext
+
+    def spider_opened(self, spider):
+        self.spider_name = spider.name
+        self.reactor_thread_id = threading.get_ident() # 信号处理函数在 reactor 线程中执行
+        if self.use_signal and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR2, self._handle_signal)
+            logger.info(f"性能剖析可通过 SIGUSR2 开关: kill -USR2 {os.getpid()}")
+        if self.enabled: self.start()
+
+    def spider_closed(self, spider):
+        self.stop()
+
+    def _handle_signal(self, signum, frame):
+        from twisted.internet import reactor
+        reactor.callFromThread(self.toggle)
+
+    def toggle(self):
+        if self.profiler is not None and self.profiler.running: self.stop()
+        else: self.start()
+
+    def start(self):
+        global _active
+        if self.profiler is not None and self.profiler.running: return
+        run_name = f"{self.spider_name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.profiler = Profiler(os.path.join(self.base_dir, run_name), self.sample_interval,
+                                 tracemalloc_enabled=self.tracemalloc_enabled, tracemalloc_frames=self.tracemalloc_frames,
+                                 tracemalloc_top=self.tracemalloc_top)
+        self.profiler.start(self.reactor_thread_id)
+        _active = self.profiler
+        if self.flush_interval > 0: self._start_loop(self.profiler.flush, self.flush_interval)
+        if self.tracemalloc_enabled and self.tracemalloc_interval > 0: self._start_loop(self.profiler.take_snapshot, self.tracemalloc_interval)
+
+    def _start_loop(self, func, interval):
+        loop = task.LoopingCall(func)
+        loop.start(interval, now=False)
+        self._loops.append(loop)
+
+    def stop(self):
+        global _active
+        for loop in self._loops:
+            if loop.running: loop.stop()
+        self._loops = []
+        if self.profiler is None or not self.profiler.running: return
+        self.profiler.stop()
+        self.crawler.stats.set_value('profiling/samples', self.profiler.sampler.samples)
+        if _active is self.profiler: _active = None
+
+    def response_received(self, response, request, spider):
+        # 下载耗时 (Playwright 请求包含 goto 和 playwright_page_methods 的等待)
+        if self.profiler is None or not self.profiler.running: return
+        latency = request.meta.get('download_latency')
+        if latency is not None: self.profiler.record(f"download.{request_class(request)}", latency)
@@ -0,0 +1,236 @@
+# 代理端点池：熔断器 + 连接级预检
+# Proxy endpoint pool: circuit breaker + connection-level preflight
+#
+# 将 PROXY_CONFIG 展开为具体的代理端点，每个端点维护一个熔断器：
+# 连续失败 PROXY_BREAKER_THRESHOLD 次后熔断，冷却期内不再分配；
+# 冷却结束后进入半开状态，只放行一个试探请求。
+# 启动时及之后每隔 PROXY_PREFLIGHT_INTERVAL 秒对所有端点做 TCP + CONNECT 预检，
+# 死端口 / 隧道失败在真正的请求之前就被熔断。
+# 预检的 CONNECT 目标是端点实际服务的站点主机 (本次运行中代理子集包含该端点的第一个站点)，
+# 只服务 amazon.co.uk 的代理不会因为 amazon.com 被屏蔽而被误熔断；
+# PROXY_CONFIG 中可用 preflight_target 显式指定，都没有时使用 PROXY_PREFLIGHT_TARGET。
+
+import asyncio
+import base64
+import logging
+import random
+import time
+from urllib.parse import urlparse
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.defer import deferred_from_coro
+from twisted.internet import task
+
+logger = logging.getLogger(__name__)
+
+
+class ProxyEndpoint:
+    """单个代理端点 (完整代理 URL) 及其熔断状态。"""
+    def __init__(self, url, config):
+        self.url = url
+        self.config = config
+        self.provider_type = config.get('provider_type', 'unknown')
+        parsed = urlparse(url)
+        self.host, self.port = parsed.hostname, parsed.port
+        self.username, self.password = parsed.username, parsed.password
+        username = config.get('username') or parsed.username
+        password = config.get('password') or parsed.password
+        # 预计算 Basic Auth 头 (用于标准 HTTPS CONNECT 隧道和预检)
+        self.auth_header = None
+        if username and password:
+            encoded_user_pass = base64.b64encode(f"{username}:{password}".encode()).decode('latin-1')
+            self.auth_header = b'Basic ' + encoded_user_pass.encode('latin-1')
+        # 熔断状态
+        self.consecutive_failures = 0
+        self.trips = 0 # 连续熔断次数 (用于指数退避)
+        self.open_until = 0.0 # 熔断结束时间 (0 表示闭合)
+        self.trial_inflight = False # 半开状态下是否已有试探请求
+        self.preflight_target = config.get('preflight_target') # 预检 CONNECT 的目标 (host:port)，None 表示按站点推导
+
+    @property
+    def is_open(self):
+        return self.open_until > time.time()
+
+    def __repr__(self):
+        return f"<ProxyEndpoint {self.provider_type} {self.host}:{self.port}>"
+
+
+def build_endpoints(proxy_configs):
+    """将启用的 PROXY_CONFIG 配置展开为 ProxyEndpoint 列表。"""
+    endpoints = []
+    for config in proxy_configs:
+        if not config.get('enabled'): continue
+        username = config.get('username'); password = config.get('password')
+        proxy_url_format = config.get('proxy_url_format'); host = config.get('host'); port = config.get('port')
+        # 优先使用格式化模板构建 (如 16yun)
+        if proxy_url_format and host and port and username and password:
+            endpoints.append(ProxyEndpoint(proxy_url_format.format(username=username, password=password, host=host, port=port), config))
+            continue
+        # 其次，endpoint 本身包含协议头时认为它是完整 URL (适用于 Oxylabs)
+        for endpoint in config.get('endpoints', []):
+            if "://" not in endpoint:
+                logger.error(f"无法为提供商 {config.get('provider_type')} 构建有效的代理 URL (endpoint: {endpoint})"); continue
+            if "{username}" in endpoint and "{password}" in endpoint:
+                endpoint = endpoint.format(username=username, password=password)
+            endpoints.append(ProxyEndpoint(endpoint, config))
+    return endpoints
+
+
+class ProxyPool:
+    """
+    代理端点池，按爬虫 (crawler) 共享一个实例 (见 from_crawler)。
+    - pick(exclude): 从可用端点中随机选择，排除本请求已失败过的端点 (只选择，不占用试探名额)。
+    - is_available / claim / release: 请求发出时检查并占用半开端点唯一的试探名额，没有结论时释放。
+    - record_success / record_failure: 由代理中间件根据响应和异常调用。
+    """
+    def __init__(self, settings, stats=None):
+        self.endpoints = build_endpoints(settings.getlist('PROXY_CONFIG'))
+        if not self.endpoints:
+            raise NotConfigured("没有在 PROXY_CONFIG 中找到启用的代理配置。")
+        self.by_url = {ep.url: ep for ep in self.endpoints}
+        self.threshold = settings.getint('PROXY_BREAKER_THRESHOLD', 3)
+        self.cooldown = settings.getfloat('PROXY_BREAKER_COOLDOWN', 120)
+        self.max_cooldown = settings.getfloat('PROXY_BREAKER_MAX_COOLDOWN', 1800)
+        self.preflight_enabled = settings.getbool('PROXY_PREFLIGHT_ENABLED', True)
+        self.preflight_interval = settings.getfloat('PROXY_PREFLIGHT_INTERVAL', 300) # 0 表示只在启动时预检
+        self.preflight_timeout = settings.getfloat('PROXY_PREFLIGHT_TIMEOUT', 5)
+        self.preflight_target = settings.get('PROXY_PREFLIGHT_TARGET', 'www.amazon.com:443')
+        self.stats = stats
+        self._subsets = {} # 提供商元组 -> 端点列表 (站点的代理子集)
+        self._preflight_loop = None
+        logger.info(f"代理池已初始化: {len(self.endpoints)} 个端点 (熔断阈值 {self.threshold}, 冷却 {self.cooldown}s)")
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # 同一个 crawler 中的中间件共享同一个代理池
+        pool = getattr(crawler, 'proxy_pool', None)
+        if pool is None:
+            pool = crawler.proxy_pool = cls(crawler.settings, crawler.stats)
+            crawler.signals.connect(pool.spider_opened, signal=signals.spider_opened)
+            crawler.signals.connect(pool.spider_closed, signal=signals.spider_closed)
+        return pool
+
+    # --- 选择端点 ---
+    def get(self, url):
+        return self.by_url.get(url)
+
+    def is_available(self, endpoint):
+        now = time.time()
+        if endpoint.open_until > now: return False # 熔断中
+        if endpoint.consecutive_failures >= self.threshold and endpoint.trial_inflight: return False # 半开，已有试探请求
+        return True
+
+    def subset(self, provider_types):
+        """返回属于指定提供商的端点 (站点的代理子集)；provider_types 为空时返回 None (表示全部端点)。"""
+        if not provider_types: return None
+        key = tuple(provider_types)
+        if key not in self._subsets:
+            endpoints = [ep for ep in self.endpoints if ep.provider_type in provider_types]
+            if not endpoints: logger.warning(f"没有属于 {list(key)} 的已启用代理端点，改用全部端点")
+            self._subsets[key] = endpoints or None
+        return self._subsets[key]
+
+    def pick(self, exclude=(), candidates=None):
+        """随机选择一个可用端点；全部不可用时选择最早恢复的端点。"""
+        pool = [ep for ep in (candidates or self.endpoints) if ep.url not in exclude] or list(candidates or self.endpoints)
+        available = [ep for ep in pool if self.is_available(ep)]
+        if available:
+            endpoint = random.choice(available)
+        else:
+            endpoint = min(pool, key=lambda ep: ep.open_until)
+            logger.warning(f"所有代理端点均已熔断，临时使用最早恢复的端点: {endpoint}")
+        return endpoint # 只选择，不占用试探名额 (由实际发出请求的代理中间件 claim)
+
+    def claim(self, endpoint):
+        """请求实际经由该端点发出：半开状态的端点占用唯一的试探名额 (由代理中间件调用)。"""
+        if endpoint.consecutive_failures >= self.threshold: endpoint.trial_inflight = True # 半开试探
+
+    def release(self, url):
+        """试探请求没有结论 (非连接级失败的异常) 时释放试探名额，让下一个请求继续试探。"""
+        endpoint = self.by_url.get(url)
+        if endpoint is not None: endpoint.trial_inflight = False
+
+    # --- 熔断器状态 ---
+    def record_success(self, url):
+        endpoint = self.by_url.get(url)
+        if endpoint is None: return
+        if endpoint.consecutive_failures >= self.threshold:
+            logger.info(f"代理端点恢复: {endpoint}")
+        endpoint.consecutive_failures = 0; endpoint.trips = 0; endpoint.open_until = 0.0; endpoint.trial_inflight = False
+
+    def record_failure(self, url, reason='', trip=False):
+        """记录一次连接级失败；达到阈值 (或 trip=True) 时熔断该端点。"""
+        endpoint = self.by_url.get(url)
+        if endpoint is None: return
+        endpoint.consecutive_failures += 1
+        endpoint.trial_inflight = False
+        if trip: endpoint.consecutive_failures = max(endpoint.consecutive_failures, self.threshold)
+        if endpoint.consecutive_failures >= self.threshold and not endpoint.is_open:
+            endpoint.trips += 1
+            cooldown = min(self.cooldown * (2 ** (endpoint.trips - 1)), self.max_cooldown)
+            endpoint.open_until = time.time() + cooldown
+            logger.warning(f"代理端点熔断 {cooldown:.0f}s: {endpoint} (连续失败 {endpoint.consecutive_failures} 次, 原因: {reason})")
+            if self.stats: self.stats.inc_value('proxy/breaker/tripped')
+
+    # --- 预检 ---
+    async def _preflight_endpoint(self, endpoint):
+        """TCP 连接并发送 CONNECT，返回 (成功与否, 原因)。"""
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(endpoint.host, endpoint.port), self.preflight_timeout)
+            target = endpoint.preflight_target or self.preflight_target
+            lines = [f"CONNECT {target} HTTP/1.1", f"Host: {target}"]
+            if endpoint.auth_header: lines.append(f"Proxy-Authorization: {endpoint.auth_header.decode('latin-1')}")
+            for header, value in endpoint.config.get('headers', {}).items():
+                if header == 'Proxy-Tunnel' and value == 'random': value = str(random.randint(1, 10000))
+                lines.append(f"{header}: {value}")
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+            await writer.drain()
+            status_line = await asyncio.wait_for(reader.readline(), self.preflight_timeout)
+            parts = status_line.decode('latin-1').split()
+            status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+            if status == 200: return True, 'ok'
+            return False, f"CONNECT status {status or status_line[:40]!r}"
+        except asyncio.TimeoutError:
+            return False, 'timeout'
+        except OSError as e:
+            return False, f"{type(e).__name__}: {e}"
+        finally:
+            if writer is not None:
+                writer.close()
+
+    async def preflight(self):
+        """并发预检所有端点，失败的端点直接熔断，成功的端点恢复。"""
+        results = await asyncio.gather(*(self._preflight_endpoint(ep) for ep in self.endpoints))
+        healthy = 0
+        for endpoint, (ok, reason) in zip(self.endpoints, results):
+            if ok: healthy += 1; self.record_success(endpoint.url)
+            else: self.record_failure(endpoint.url, reason=f"预检失败: {reason}", trip=True)
+        logger.info(f"代理预检完成: {healthy}/{len(self.endpoints)} 个端点可用")
+        if self.stats: self.stats.set_value('proxy/preflight/healthy', healthy)
+
+    def _run_preflight(self):
+        return deferred_from_coro(self.preflight())
+
+    def assign_preflight_targets(self, marketplaces):
+        """按端点服务的站点设置预检目标：优先显式列出该提供商的站点，其次使用全部代理的站点 (proxy_providers 为空)。"""
+        marketplaces = list(marketplaces)
+        for endpoint in self.endpoints:
+            if endpoint.config.get('preflight_target'): continue
+            marketplace = next((m for m in marketplaces if endpoint.provider_type in m.proxy_providers), None) \
+                or next((m for m in marketplaces if not m.proxy_providers), None)
+            if marketplace is None: continue
+            parsed = urlparse(marketplace.base_url)
+            endpoint.preflight_target = f"{parsed.hostname}:{parsed.port or (443 if parsed.scheme == 'https' else 80)}"
+
+    def spider_opened(self, spider):
+        if not self.preflight_enabled: return
+        self.assign_preflight_targets(getattr(spider, 'marketplaces', {}).values())
+        if self.preflight_interval > 0:
+            self._preflight_loop = task.LoopingCall(self._run_preflight)
+            self._preflight_loop.start(self.preflight_interval, now=False)
+        return self._run_preflight() # 启动时等待首次预检完成再开始抓取
+
+    def spider_closed(self, spider):
+        if self._preflight_loop and self._preflight_loop.running: self._preflight_loop.stop()
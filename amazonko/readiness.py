@@ -0,0 +1,92 @@
+# 页面就绪策略与自适应超时
+# Page readiness strategies and adaptive timeouts
+#
+# 每种页面类型 (search / detail) 可以选择不同的就绪判断方式 (PAGE_READINESS)：
+#   visible  : goto 到 domcontentloaded，再等待选择器可见 (需要布局和绘制，最慢)
+#   attached : goto 到 domcontentloaded，再等待选择器出现在 DOM 中
+#   commit   : goto 到 commit (收到响应即返回)，再轮询选择器是否出现
+#   content  : goto 到 commit，轮询选择器出现，且 marker 脚本已出现或 DOM 已解析完成
+# 等待超时根据观测到的加载时间 p95 自适应调整，避免容器缺失时白等一分钟。
+
+import json
+import logging
+import math
+from collections import defaultdict, deque
+
+from scrapy_playwright.page import PageMethod
+
+logger = logging.getLogger(__name__)
+
+# content 策略：容器已挂载，且 (marker 脚本已出现 或 文档已解析完成)
+CONTENT_READY_JS = """
+([selector, marker]) => {
+    if (!document.querySelector(selector)) return false;
+    if (document.readyState !== 'loading') return true;
+    return marker ? Array.from(document.scripts).some(s => s.text && s.text.includes(marker)) : false;
+}
+"""
+SELECTOR_PRESENT_JS = "(selector) => !!document.querySelector(selector)"
+
+
+class ReadinessPolicy:
+    """
+    根据 PAGE_READINESS 为每种页面类型生成 goto 选项和 playwright_page_methods，
+    并根据观测到的加载时间 (download_latency) 计算自适应超时。
+    """
+    def __init__(self, settings):
+        self.strategies = settings.getdict('PAGE_READINESS')
+        self.initial_timeout = settings.getint('READINESS_TIMEOUT_INITIAL', 30000) # 毫秒，样本不足时使用
+        self.min_timeout = settings.getint('READINESS_TIMEOUT_MIN', 5000)
+        self.max_timeout = settings.getint('READINESS_TIMEOUT_MAX', 60000)
+        self.p95_factor = settings.getfloat('READINESS_P95_FACTOR', 1.5)
+        self.min_samples = settings.getint('READINESS_MIN_SAMPLES', 20)
+        self.poll_interval = settings.getint('READINESS_POLL_INTERVAL', 100) # commit / content 策略的轮询间隔 (毫秒)
+        window = settings.getint('READINESS_WINDOW', 200)
+        self.samples = defaultdict(lambda: deque(maxlen=window)) # 页面类型 -> 最近的加载时间 (毫秒)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings)
+
+    def observe(self, page_type, seconds):
+        """记录一次成功加载的耗时 (秒)。"""
+        if seconds is None: return
+        self.samples[page_type].append(seconds * 1000)
+
+    def observe_timeout(self, page_type):
+        """就绪等待超时：把当前超时值作为一个样本 (真实耗时至少这么长)，使超时向上调整。"""
+        self.samples[page_type].append(self.timeout_for(page_type))
+
+    def p95(self, page_type):
+        samples = self.samples.get(page_type)
+        if not samples or len(samples) < self.min_samples: return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)]
+
+    def timeout_for(self, page_type):
+        p95 = self.p95(page_type)
+        if p95 is None: return self.initial_timeout
+        return int(min(self.max_timeout, max(self.min_timeout, p95 * self.p95_factor)))
+
+    def goto_options(self, page_type):
+        strategy = self.strategies.get(page_type, {}).get('strategy', 'visible')
+        return {'wait_until': 'commit' if strategy in ('commit', 'content') else 'domcontentloaded'}
+
+    def page_methods(self, page_type):
+        config = self.strategies.get(page_type, {})
+        strategy = config.get('strategy', 'visible')
+        selector = config.get('selector')
+        if not selector: return []
+        timeout = self.timeout_for(page_type)
+        if strategy in ('visible', 'attached'):
+            return [PageMethod('wait_for_selector', selector, state=strategy, timeout=timeout)]
+        if strategy == 'commit':
+            return [PageMethod('wait_for_function', SELECTOR_PRESENT_JS, arg=selector, polling=self.poll_interval, timeout=timeout)]
+        if strategy == 'content':
+            return [PageMethod('wait_for_function', CONTENT_READY_JS, arg=[selector, config.get('marker')], polling=self.poll_interval, timeout=timeout)]
+        logger.error(f"未知的页面就绪策略 '{strategy}' (页面类型: {page_type})，使用 visible")
+        return [PageMethod('wait_for_selector', selector, state='visible', timeout=timeout)]
+
+    def summary(self):
+        return json.dumps({page_type: {'samples': len(samples), 'p95_ms': self.p95(page_type), 'timeout_ms': self.timeout_for(page_type)}
+                           for page_type, samples in self.samples.items()}, ensure_ascii=False)
@@ -0,0 +1,106 @@
+# 渲染后页面 (Playwright DOM 快照) 缓存存储
+# Rendered page (Playwright DOM snapshot) cache storage
+#
+# 以 SQLite 单文件存储 zlib 压缩后的 HTML，按 URL + locale 作为键，
+# 支持按页面类型的 TTL 以及总大小上限 (按最近访问时间 LRU 淘汰)。
+# 命中时的访问时间先记在内存中，累积 access_batch 条、写入新页面或关闭时再批量写回，
+# 读取路径上不做逐次提交 (fsync)。
+
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import zlib
+
+from w3lib.url import canonicalize_url
+
+logger = logging.getLogger(__name__)
+
+
+def rendered_cache_key(url, locale):
+    """根据规范化 URL 和 locale 生成缓存键。"""
+    return hashlib.sha1(f"{canonicalize_url(url)}|{locale}".encode('utf-8')).hexdigest()
+
+
+class RenderedPageStore:
+    """
+    渲染页面缓存的 SQLite 存储。
+    - body 以 zlib 压缩存储，size 记录压缩后的字节数。
+    - 总大小超过 max_bytes 时，按 last_access 从旧到新淘汰 (淘汰前先写回缓冲的访问时间)。
+    """
+    def __init__(self, path, max_bytes=0, compress_level=6, access_batch=100):
+        self.path = path
+        self.max_bytes = max_bytes # 0 表示不限制
+        self.compress_level = compress_level
+        self.access_batch = max(1, access_batch)
+        self._accessed = {} # 键 -> 尚未写回的最近访问时间
+        cache_dir = os.path.dirname(path)
+        if cache_dir: os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " key TEXT PRIMARY KEY, url TEXT NOT NULL, page_type TEXT, status INTEGER NOT NULL,"
+            " body BLOB NOT NULL, size INTEGER NOT NULL, stored_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_pages_last_access ON pages (last_access)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        logger.info(f"渲染页面缓存已打开: {path} (当前约 {self.total_bytes} 字节)")
+
+    def get(self, key, ttl):
+        """返回 (url, status, body_bytes)；不存在或已过期 (ttl 秒) 时返回 None。"""
+        row = self.conn.execute("SELECT url, status, body, size, stored_at FROM pages WHERE key = ?", (key,)).fetchone()
+        if row is None: return None
+        url, status, body, size, stored_at = row
+        now = time.time()
+        if ttl and now - stored_at > ttl:
+            self._delete(key, size); return None
+        self._accessed[key] = now
+        if len(self._accessed) >= self.access_batch: self.flush_access(); self.conn.commit()
+        return url, status, zlib.decompress(body)
+
+    def flush_access(self):
+        """把缓冲的访问时间写回 (在调用方的事务中，由调用方提交)。"""
+        if not self._accessed: return
+        self.conn.executemany("UPDATE pages SET last_access = ? WHERE key = ?", [(t, k) for k, t in self._accessed.items()])
+        self._accessed.clear()
+
+    def put(self, key, url, page_type, status, body):
+        compressed = zlib.compress(body, self.compress_level)
+        old = self.conn.execute("SELECT size FROM pages WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO pages (key, url, page_type, status, body, size, stored_at, last_access)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, url, page_type, status, compressed, len(compressed), now, now),
+        )
+        self.total_bytes += len(compressed) - (old[0] if old else 0)
+        self._accessed.pop(key, None)
+        self.flush_access() # 与本次写入一起提交；淘汰也需要最新的访问时间
+        self._evict()
+        self.conn.commit()
+
+    def _delete(self, key, size):
+        self._accessed.pop(key, None)
+        self.conn.execute("DELETE FROM pages WHERE key = ?", (key,))
+        self.conn.commit()
+        self.total_bytes -= size
+
+    def _evict(self):
+        # LRU 淘汰直到总大小回到上限以内
+        if not self.max_bytes or self.total_bytes <= self.max_bytes: return
+        evicted = 0
+        for key, size in self.conn.execute("SELECT key, size FROM pages ORDER BY last_access").fetchall():
+            if self.total_bytes <= self.max_bytes: break
+            self.conn.execute("DELETE FROM pages WHERE key = ?", (key,))
+            self.total_bytes -= size; evicted += 1
+        logger.debug(f"渲染页面缓存淘汰 {evicted} 条记录，当前约 {self.total_bytes} 字节")
+
+    def close(self):
+        try:
+            self.flush_access(); self.conn.commit()
+        finally:
+            self.conn.close()
@@ -0,0 +1,140 @@
+# 按请求类别划分的调度队列
+# Request-class aware scheduler priority queue
+#
+# 搜索页、详情页各自有独立的优先级队列和并发 (slot) 预算，
+# 避免翻页请求排在一大批详情页之后被"饿死"。
+# (变体 Item 由详情页解析产生，不发出单独的请求，因此没有 variation 类别。)
+# 图片请求由 ImagesPipeline 直接交给下载器，不经过调度器：
+# 其并发预算通过独立的下载 slot ('images'，见 DOWNLOAD_SLOTS) 控制，这里只做统计。
+# 带有 meta['marketplace'] 的请求按 (类别, 站点) 分队列 (如 detail@uk)，预算对每个站点分别生效，
+# 被限速的站点占满自己的预算后不会挤占其他站点。
+
+import hashlib
+import logging
+from collections import defaultdict
+
+from scrapy import signals
+from scrapy.pqueues import ScrapyPriorityQueue
+
+from amazonko.utils import get_rss_bytes, request_queue_name
+
+logger = logging.getLogger(__name__)
+
+# 产生 Item 的请求类别：在途 Item 过多时暂停这些类别
+ITEM_PRODUCING_CLASSES = ('detail',)
+
+
+def _class_of(queue_name):
+    return queue_name.split('@', 1)[0]
+
+
+def _path_safe(name):
+    """队列名转为可用作 JOBDIR 子目录的名称 (替换特殊字符，并加上哈希避免替换后重名)。"""
+    safe = ''.join(c if c.isalnum() or c in '-._' else '_' for c in name)
+    return f"{safe}-{hashlib.md5(name.encode('utf-8')).hexdigest()}"
+
+
+class RequestClassPriorityQueue:
+    """
+    SCHEDULER_PRIORITY_QUEUE 的实现。
+    - 每个请求类别一个 ScrapyPriorityQueue。
+    - pop 时只从 "在途请求数 < 预算" 的类别中选择，优先选择预算占用率最低的类别；
+      占用率相同时按 REQUEST_CLASS_BUDGETS 中的顺序 (search 在前)，保证翻页不被饿死。
+    - 在途 Item (管道中处理、等待图片下载) 超过上限，或进程 RSS 超过软上限时，
+      暂停 detail 类别，直到 Item 排空。
+    - 所有类别都被限制时返回 None，引擎会在下一次循环中重试。
+    """
+    @classmethod
+    def from_crawler(cls, crawler, downstream_queue_cls, key, startprios=None, **kwargs):
+        return cls(crawler, downstream_queue_cls, key, startprios, **kwargs)
+
+    def __init__(self, crawler, downstream_queue_cls, key, class_startprios=None, **kwargs):
+        if class_startprios and not isinstance(class_startprios, dict):
+            raise ValueError("RequestClassPriorityQueue 只能从同一队列类保存的状态恢复 (startprios 需为 dict)。")
+        self.crawler = crawler
+        self.downstream_queue_cls = downstream_queue_cls
+        self.key = key
+        self._pq_kwargs = kwargs # 例如 start_queue_cls
+        settings = crawler.settings
+        self.budgets = {name: int(budget) for name, budget in settings.getdict('REQUEST_CLASS_BUDGETS').items()}
+        self.class_order = list(self.budgets)
+        self.max_inflight_items = settings.getint('MAX_INFLIGHT_ITEMS', 0) # 0 表示不限制
+        self.memory_soft_limit = settings.getint('SCHEDULER_MEMORY_SOFT_LIMIT_MB', 0) * 1024 * 1024
+        self.inflight = defaultdict(int) # 请求类别 -> 下载器中的在途请求数 (包括图片)
+        self._paused_logged = False
+
+        self.pqueues = {} # 请求类别 -> ScrapyPriorityQueue
+        for name, startprios in (class_startprios or {}).items():
+            self.pqueues[name] = self._pqfactory(name, startprios)
+
+        crawler.signals.connect(self._request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(self._request_left_downloader, signal=signals.request_left_downloader)
+
+    def _pqfactory(self, name, startprios=()):
+        return ScrapyPriorityQueue.from_crawler(
+            self.crawler, self.downstream_queue_cls, self.key + '/' + _path_safe(name), startprios, **self._pq_kwargs
+        )
+
+    def _request_reached_downloader(self, request, spider):
+        self.inflight[request_queue_name(request)] += 1
+
+    def _request_left_downloader(self, request, spider):
+        name = request_queue_name(request)
+        if self.inflight[name] > 0: self.inflight[name] -= 1
+
+    def _items_backlogged(self):
+        """在途 Item 数量或进程内存超过上限时返回 True。"""
+        engine = self.crawler.engine
+        slot = getattr(getattr(engine, 'scraper', None), 'slot', None)
+        itemproc_size = getattr(slot, 'itemproc_size', 0)
+        if self.max_inflight_items and itemproc_size >= self.max_inflight_items: return True
+        if self.memory_soft_limit:
+            rss = get_rss_bytes()
+            if rss is not None and rss >= self.memory_soft_limit: return True
+        return False
+
+    def _next_class(self):
+        candidates = [name for name, queue in self.pqueues.items() if len(queue)]
+        if not candidates: return None
+        if any(_class_of(name) in ITEM_PRODUCING_CLASSES for name in candidates) and self._items_backlogged():
+            if not self._paused_logged:
+                logger.info("在途 Item 或内存超过上限，暂停调度详情页请求。"); self._paused_logged = True
+            candidates = [name for name in candidates if _class_of(name) not in ITEM_PRODUCING_CLASSES]
+        else:
+            self._paused_logged = False
+        best_name, best_key = None, None
+        for name in candidates:
+            class_name = _class_of(name)
+            budget = self.budgets.get(class_name, 0) # 未配置预算的类别不限制
+            if budget and self.inflight[name] >= budget: continue
+            order = self.class_order.index(class_name) if class_name in self.class_order else len(self.class_order)
+            sort_key = (self.inflight[name] / budget if budget else 0.0, order)
+            if best_key is None or sort_key < best_key: best_name, best_key = name, sort_key
+        return best_name
+
+    def push(self, request):
+        name = request_queue_name(request)
+        if name not in self.pqueues: self.pqueues[name] = self._pqfactory(name)
+        self.pqueues[name].push(request)
+
+    def pop(self):
+        name = self._next_class()
+        if name is None: return None
+        queue = self.pqueues[name]
+        request = queue.pop()
+        if not len(queue):
+            del self.pqueues[name]
+            queue.close()
+        return request
+
+    def peek(self):
+        name = self._next_class()
+        return self.pqueues[name].peek() if name is not None else None
+
+    def close(self):
+        active = {name: queue.close() for name, queue in self.pqueues.items()}
+        self.pqueues.clear()
+        return active
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.pqueues.values())
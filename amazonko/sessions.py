@@ -0,0 +1,86 @@
+# 浏览器会话持久化 (Playwright storage_state: cookies + localStorage)
+# Browser session persistence (Playwright storage_state: cookies + localStorage)
+#
+# 按身份 (代理端点 + UA + locale) 保存成功页面之后的 storage_state，下次运行创建同一身份的
+# 上下文时通过 context 参数 storage_state 恢复，跳过首次访问的位置 / Cookie 提示。
+# - 保存按身份节流 (SESSION_SAVE_INTERVAL)，先写临时文件再 os.replace，避免留下半个文件。
+# - 超过 SESSION_TTL 的会话在加载时丢弃 (启动时也会清理)；身份因被阻止而轮换时删除其会话。
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def session_key(proxy_url, user_agent, locale):
+    """会话键：同一出口 (代理端点) + UA + locale 才复用同一份 Cookie。"""
+    return hashlib.sha1(f"{proxy_url or 'direct'}|{user_agent}|{locale}".encode('utf-8')).hexdigest()[:20]
+
+
+class SessionStore:
+    """storage_state 的文件存储，每个会话一个 JSON 文件。"""
+    def __init__(self, directory, ttl=24 * 3600, save_interval=300):
+        self.directory = directory
+        self.ttl = ttl # 秒，0 表示不过期
+        self.save_interval = save_interval
+        self._last_saved = {} # 会话键 -> 本次运行最后保存时间
+        os.makedirs(directory, exist_ok=True)
+        self.prune()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('SESSION_DIR', 'sessions'), ttl=settings.getint('SESSION_TTL', 24 * 3600),
+                   save_interval=settings.getfloat('SESSION_SAVE_INTERVAL', 300))
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _expired(self, saved_at):
+        return bool(self.ttl) and time.time() - saved_at > self.ttl
+
+    def load(self, key):
+        """返回未过期的 storage_state (dict)，不存在或已过期时返回 None。"""
+        try:
+            with open(self._path(key), encoding='utf-8') as f: data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取会话失败，已忽略: {key} - {e}"); self.delete(key); return None
+        if self._expired(data.get('saved_at', 0)):
+            logger.debug(f"会话已过期: {key}"); self.delete(key); return None
+        return data.get('storage_state')
+
+    def should_save(self, key):
+        return time.time() - self._last_saved.get(key, 0) >= self.save_interval
+
+    def save(self, key, storage_state):
+        self._last_saved[key] = time.time()
+        path = self._path(key); tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'saved_at': time.time(), 'storage_state': storage_state}, f)
+            os.replace(tmp_path, path) # 原子替换
+        except OSError as e:
+            logger.error(f"保存会话失败: {key} - {e}")
+            try: os.remove(tmp_path)
+            except OSError: pass
+
+    def delete(self, key):
+        self._last_saved.pop(key, None)
+        try: os.remove(self._path(key))
+        except OSError: pass
+
+    def prune(self):
+        """删除过期的会话文件和残留的临时文件。"""
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stale = name.endswith('.tmp') or (name.endswith('.json') and self._expired(os.path.getmtime(path)))
+                if stale: os.remove(path); removed += 1
+            except OSError:
+                continue
+        if removed: logger.info(f"清理了 {removed} 个过期会话文件")
@@ -10,9 +10,21 @@ NEWSPIDER_MODULE = "amazonko.spiders"
 
 # ... (基本设置, CUSTOM_USER_AGENTS, 中间件, 管道等保持不变) ...
 ROBOTSTXT_OBEY = False
-CONCURRENT_REQUESTS = 4
+AMAZON_BASE_URL = 'https://www.amazon.com' # 站点根 URL；基准测试时指向本地模拟服务器 (benchmarks/mock_amazon.py)
+CONCURRENT_REQUESTS = 6 # 4 个页面 (见 REQUEST_CLASS_BUDGETS) + 2 个图片 (见 DOWNLOAD_SLOTS['images'])
 DOWNLOAD_DELAY = 1.5
 CONCURRENT_REQUESTS_PER_DOMAIN = 4
+# --- 站点 (marketplace)：-a marketplaces=us,uk,de 在一次运行中并行抓取多个站点 ---
+# 每个站点: base_url, locale, timezone_id (浏览器上下文), proxy_providers (PROXY_CONFIG 的 provider_type，为空表示全部),
+# concurrency / delay (该站点主机的下载 slot 预算，默认 CONCURRENT_REQUESTS_PER_DOMAIN / DOWNLOAD_DELAY), 可选 context_args
+MARKETPLACES = {
+    'us': {'base_url': 'https://www.amazon.com', 'locale': 'en-US', 'timezone_id': 'America/New_York'},
+    'uk': {'base_url': 'https://www.amazon.co.uk', 'locale': 'en-GB', 'timezone_id': 'Europe/London'},
+    'de': {'base_url': 'https://www.amazon.de', 'locale': 'de-DE', 'timezone_id': 'Europe/Berlin'},
+    'fr': {'base_url': 'https://www.amazon.fr', 'locale': 'fr-FR', 'timezone_id': 'Europe/Paris'},
+    'jp': {'base_url': 'https://www.amazon.co.jp', 'locale': 'ja-JP', 'timezone_id': 'Asia/Tokyo', 'delay': 2.0},
+}
+CRAWL_MARKETPLACES = [] # 默认抓取的站点代码；为空时只抓取 AMAZON_BASE_URL 对应的站点
 DEFAULT_REQUEST_HEADERS = {
     "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
     "Accept-Language": "en-US,en;q=0.9", # 简化语言设置，只保留 en-US 和 en
@@ -28,26 +40,60 @@ CUSTOM_USER_AGENTS = [
     'Mozilla/5.0 (iPhone; CPU iPhone OS 16_3 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.3 Mobile/15E148 Safari/604.1'
 ]
 FAKEUSERAGENT_FALLBACK = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.93 Safari/537.36'
+# --- 抓取身份 (代理端点 + UA + 视口 + locale 绑定，按关键词粘性分配，被阻止时轮换) ---
+IDENTITY_ENABLED = True
+# 只使用与 PLAYWRIGHT_BROWSER_TYPE 一致的 UA；视口与 UA 的平台匹配
+IDENTITY_PROFILES = [
+    {'browser': 'chromium', 'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36', 'viewport': {'width': 1920, 'height': 1080}},
+    {'browser': 'chromium', 'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36', 'viewport': {'width': 1366, 'height': 768}},
+    {'browser': 'chromium', 'user_agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36', 'viewport': {'width': 1440, 'height': 900}, 'device_scale_factor': 2},
+    {'browser': 'chromium', 'user_agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36', 'viewport': {'width': 1920, 'height': 1080}},
+    {'browser': 'firefox', 'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/110.0', 'viewport': {'width': 1920, 'height': 1080}},
+    {'browser': 'webkit', 'user_agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.3 Safari/605.1.15', 'viewport': {'width': 1440, 'height': 900}},
+]
+IDENTITY_MAX_BLOCKS = 2 # 连续被阻止 (403/429/503/Robot Check) 次数达到后轮换身份
+IDENTITY_MAX_PAGES = 0 # 每个身份最多渲染的页面数，0 表示不限制
+# --- 会话持久化 (按身份保存 Playwright storage_state，下次运行恢复) ---
+SESSION_ENABLED = True
+SESSION_DIR = 'sessions'
+SESSION_TTL = 24 * 3600 # 会话有效期 (秒)，过期后丢弃
+SESSION_SAVE_INTERVAL = 300 # 同一身份两次保存的最小间隔 (秒)
 DOWNLOADER_MIDDLEWARES = {
     'scrapy.downloadermiddlewares.retry.RetryMiddleware': 90,
     'scrapy.downloadermiddlewares.cookies.CookiesMiddleware': None,
     'scrapy.downloadermiddlewares.useragent.UserAgentMiddleware': None,
     'scrapy_fake_useragent.middleware.RandomUserAgentMiddleware': None,
-    'amazonko.middlewares.CustomRandomUserAgentMiddleware': 400,
+    'amazonko.middlewares.IdentityMiddleware': 350, # 一致的 UA / 代理 / 浏览器上下文
+    'amazonko.middlewares.BrowserWatchdogMiddleware': 360, # 浏览器上下文在途请求 / 页数统计 (见 WATCHDOG_*)
+    'amazonko.middlewares.CustomRandomUserAgentMiddleware': 400, # 身份中间件关闭时的后备
+    'amazonko.middlewares.RenderedPageCacheMiddleware': 520, # 命中时跳过代理分配和浏览器
     'amazonko.middlewares.CustomHttpProxyMiddleware': 543,
     'scrapy.downloadermiddlewares.httpproxy.HttpProxyMiddleware': None,
     'scrapy.downloadermiddlewares.httpcompression.HttpCompressionMiddleware': 810,
     'scrapy.downloadermiddlewares.redirect.RedirectMiddleware': 900,
     'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware': 950,
 }
+SPIDER_MIDDLEWARES = {
+    'amazonko.middlewares.PageCloseSpiderMiddleware': 50, # 回调结束后关闭遗漏的 Playwright 页面
+}
+EXTENSIONS = {
+   "amazonko.profiling.ProfilingExtension": 500,
+}
 ITEM_PIPELINES = {
    "amazonko.pipelines.DuplicateItemPipeline": 100,
    "amazonko.pipelines.CustomImagePipeline": 200,
+   "amazonko.pipelines.StreamFeedPipeline": 250, # 图片处理完成后立即推送 (STREAM_FEED_ENABLED 时启用)
    "amazonko.pipelines.CsvExportPipeline": 300,
+   "amazonko.pipelines.SqliteStorePipeline": 310,
 }
 IMAGES_STORE = 'images'
 IMAGES_URLS_FIELD = 'image_urls_to_download'
 IMAGES_RESULT_FIELD = 'image_download_results'
+IMAGES_STORAGE_MODE = 'original' # 'original': 原样保存 (不经 PIL 重新编码); 'reencode': ImagesPipeline 默认行为 (转 RGB JPEG)
+IMAGES_VALIDATE = False # original 模式下是否用 PIL 校验图片 (在线程池中执行)
+IMAGES_MAX_DIMENSION = 0 # original 模式下的最大边长，超过时按原格式缩小；0 表示不缩放
+IMAGES_WORKER_THREADS = 2 # 图片处理 / 写盘线程数
+IMAGES_WORKER_QUEUE_SIZE = 8 # 同时提交到线程池的图片任务上限
 AUTOTHROTTLE_ENABLED = True
 AUTOTHROTTLE_START_DELAY = 5
 AUTOTHROTTLE_MAX_DELAY = 60
@@ -58,6 +104,27 @@ HTTPCACHE_EXPIRATION_SECS = 0
 HTTPCACHE_DIR = "httpcache"
 HTTPCACHE_IGNORE_HTTP_CODES = [500, 502, 503, 504, 522, 524, 408, 429, 403, 407]
 REQUEST_FINGERPRINTER_IMPLEMENTATION = '2.7'
+# --- 按请求类别调度 (search / detail 各自独立的队列和并发预算；变体 Item 来自详情页，没有单独的请求) ---
+SCHEDULER_PRIORITY_QUEUE = 'amazonko.scheduler.RequestClassPriorityQueue'
+REQUEST_CLASS_BUDGETS = {'search': 1, 'detail': 3} # 顺序即同等占用率时的优先顺序
+MAX_INFLIGHT_ITEMS = 200 # 管道中在途 Item (等待图片下载等) 的上限，超过时暂停详情页调度
+SCHEDULER_MEMORY_SOFT_LIMIT_MB = 0 # 进程 RSS 软上限 (MB)，超过时暂停详情页调度；0 表示不检查
+# --- ASIN 列表模式 (-a asin_file=asins.txt，- 表示标准输入；见 amazonko/asinlist.py) ---
+ASIN_LIST_CHUNK_SIZE = 500 # 每次从列表中读取并调度的 ASIN 数
+ASIN_LIST_LOW_WATERMARK = 100 # 调度器中待处理请求少于此数时读取下一批 (请求队列大小约为两者之和)
+ASIN_LIST_IDENTITIES = 8 # 各批 ASIN 轮流使用的抓取身份数 (第 n 批使用粘性键 asins-<n % 该值>)
+# 图片请求不经过调度器，使用独立的下载 slot 控制并发
+DOWNLOAD_SLOTS = {
+    'images': {'concurrency': 2, 'delay': 0.25, 'randomize_delay': True},
+}
+# --- 渲染页面缓存 (Playwright 请求使用；HttpCacheMiddleware 只缓存非 Playwright 请求，如图片) ---
+RENDER_CACHE_ENABLED = True
+RENDER_CACHE_PATH = 'httpcache/rendered.sqlite3'
+RENDER_CACHE_TTLS = {'search': 30 * 60, 'detail': 24 * 3600} # 按页面类型的 TTL (秒)，0 表示不缓存
+RENDER_CACHE_DEFAULT_TTL = 3600
+RENDER_CACHE_MAX_BYTES = 512 * 1024 * 1024 # 压缩后总大小上限，超出按 LRU 淘汰
+RENDER_CACHE_COMPRESS_LEVEL = 6
+RENDER_CACHE_ACCESS_BATCH = 100 # 命中时的访问时间 (LRU) 累积多少条后批量写回
 # JOBDIR = 'crawls/amazonko-runX'
 
 # --- Playwright 设置 ---
@@ -66,6 +133,26 @@ DOWNLOAD_HANDLERS = {
     "https": "scrapy_playwright.handler.ScrapyPlaywrightDownloadHandler",
 }
 TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
+# 浏览器模式: 'launch' 每次运行启动 Chromium (PLAYWRIGHT_LAUNCH_OPTIONS)；
+# 'attach' 通过 CDP 连接本机常驻的共享 Chromium (不存在或不健康时自动启动，见 amazonko/browser_server.py)
+BROWSER_MODE = 'launch'
+BROWSER_SERVER_PORT = 9222 # 常驻浏览器的 CDP 端口 (只监听 127.0.0.1)
+BROWSER_SERVER_DIR = '.browser_server' # pid 文件、锁、浏览器用户数据目录和日志
+# --- 浏览器内存看门狗 (见 amazonko/watchdog.py) ---
+WATCHDOG_ENABLED = True
+WATCHDOG_INTERVAL = 30 # 检查间隔 (秒)
+WATCHDOG_PAGE_MAX_AGE = 600 # 页面打开超过该秒数视为遗留页面并关闭
+WATCHDOG_CONTEXT_MAX_PAGES = 200 # 每个浏览器上下文渲染该数量的页面后回收 (排空后关闭)，0 表示不回收
+WATCHDOG_CONTEXT_IDLE = 300 # 上下文超过该秒数没有请求时关闭 (如已轮换身份的上下文)
+WATCHDOG_BROWSER_RSS_MB = 3072 # 浏览器进程树 RSS 上限 (MB)：超过时回收上下文，仍超过则重启浏览器；0 表示不检查 (attach 模式不检查)
+WATCHDOG_BROWSER_MAX_PAGES = 5000 # 浏览器累计渲染该数量的页面后重启 (先排空在途请求；attach 模式只回收本次运行的上下文)，0 表示不重启
+WATCHDOG_DRAIN_TIMEOUT = 120 # 重启浏览器前等待在途请求结束的最长时间 (秒)
+BROWSER_SERVER_EXECUTABLE = None # 默认依次查找 PATH 和 Playwright 下载的 Chromium
+BROWSER_SERVER_START_TIMEOUT = 30 # 启动后等待 CDP 可用的时间 (秒)
+BROWSER_SERVER_HEALTH_TIMEOUT = 1.0 # 健康检查 (GET /json/version) 超时 (秒)
+BROWSER_SERVER_HEALTH_INTERVAL = 30 # 运行期间的健康检查间隔 (秒)，0 表示不检查
+BROWSER_SERVER_MONITOR_TIMEOUT = 5 # 运行期间每次健康检查的超时 (秒)，负载高时浏览器响应可能较慢
+BROWSER_SERVER_MAX_FAILURES = 3 # 连续失败多少次才认为浏览器不可用 (只重启本进程启动的浏览器)
 #PLAYWRIGHT_BROWSER_TYPE = "firefox" # 可以尝试 'firefox' 或 'webkit'
 PLAYWRIGHT_BROWSER_TYPE = "chromium" # 可以尝试 'firefox' 或 'webkit'
 
@@ -90,6 +177,21 @@ PLAYWRIGHT_LAUNCH_OPTIONS = {
 }
 # Playwright 页面导航超时
 PLAYWRIGHT_DEFAULT_NAVIGATION_TIMEOUT = 180 * 1000
+# 页面就绪策略 (按页面类型): visible / attached / commit / content
+PAGE_READINESS = {
+    'search': {'strategy': 'attached', 'selector': 'div.s-result-item[data-asin]'},
+    # content: #dp-container 已挂载，且变体脚本 (dimensionValuesDisplayData) 已出现或文档已解析完成
+    'detail': {'strategy': 'content', 'selector': '#dp-container', 'marker': 'dimensionValuesDisplayData'},
+}
+READINESS_TIMEOUT_INITIAL = 30000 # 样本不足时的等待超时 (毫秒)
+READINESS_TIMEOUT_MIN = 5000
+READINESS_TIMEOUT_MAX = 60000
+READINESS_P95_FACTOR = 1.5 # 超时 = 观测到的加载时间 p95 × 系数
+READINESS_MIN_SAMPLES = 20
+READINESS_WINDOW = 200 # 每种页面类型保留的最近样本数
+READINESS_POLL_INTERVAL = 100 # commit / content 策略的轮询间隔 (毫秒)
+# DOM 提取模式: 'compact' 在浏览器内只提取需要的片段并替换文档 (传输和解析量小)；'full' 传输完整 HTML
+DOM_EXTRACTION_MODE = 'compact'
 # Playwright 上下文参数 (继续尝试模拟地理位置)
 PLAYWRIGHT_CONTEXT_ARGS = {
     "locale": "en-US",
@@ -102,6 +204,8 @@ PLAYWRIGHT_CONTEXT_ARGS = {
 
 # --- 通用代理配置 ---
 # (保持不变，确保凭据和列表正确, 并启用你想用的代理)
+# 可选 'locale' / 'timezone_id'：使用该提供商端点的身份采用与出口 IP 一致的语言和时区
+# 可选 'preflight_target' (host:port)：预检 CONNECT 的目标，默认为该提供商服务的站点主机
 PROXY_CONFIG = [
     {
         'provider_type': 'oxylabs_isp',
@@ -131,6 +235,14 @@ PROXY_CONFIG = [
 ]
 # (代理配置检查逻辑保持不变)
 if not any(p.get('enabled') for p in PROXY_CONFIG): print("...警告：没有启用的代理配置...")
+# --- 代理熔断与预检 ---
+PROXY_BREAKER_THRESHOLD = 3 # 连续失败次数达到阈值后熔断端点
+PROXY_BREAKER_COOLDOWN = 120 # 首次熔断冷却时间 (秒)，之后每次连续熔断翻倍
+PROXY_BREAKER_MAX_COOLDOWN = 1800
+PROXY_PREFLIGHT_ENABLED = True # 启动时对所有端点做 TCP + CONNECT 预检
+PROXY_PREFLIGHT_INTERVAL = 300 # 周期性预检间隔 (秒)，0 表示只在启动时预检
+PROXY_PREFLIGHT_TIMEOUT = 5
+PROXY_PREFLIGHT_TARGET = 'www.amazon.com:443' # 默认预检目标：端点不属于本次运行的任何站点、也没有配置 preflight_target 时使用
 
 # --- 其他设置 ---
 # (日志 / 重试 / CSV 设置保持不变)
@@ -143,7 +255,47 @@ RETRY_HTTP_CODES = [500, 502, 503, 504, 522, 524, 408, 429, 403, 407]
 CSV_OUTPUT_FILE = 'amazon_products.csv'
 CSV_EXPORT_FIELDS = [
     'title', 'main_image_url', 'downloaded_image_name', 'product_url', 'asin',
-    'search_keyword', 'is_variation', 'variation_type', 'variation_value', 'crawled_at'
+    'search_keyword', 'is_variation', 'variation_type', 'variation_value', 'crawled_at', 'marketplace'
 ]
 CSV_EXPORT_ENCODING = 'utf-8'
 CSV_INCLUDE_HEADER = True
+
+# --- SQLite 输出 (跨运行累积，按 ASIN upsert) ---
+SQLITE_STORE_PATH = 'amazon_products.sqlite3'
+SQLITE_STORE_BATCH_SIZE = 100 # 每个事务写入的 Item 数
+SQLITE_STORE_FLUSH_INTERVAL = 30 # 定时写入未满一批的数据 (秒)，0 表示只按批次写入
+
+# --- 实时 Item 推送 (NDJSON，供改价服务等下游在抓取期间消费) ---
+STREAM_FEED_ENABLED = False
+STREAM_FEED_UNIX_SOCKET = 'amazonko-feed.sock' # 为空则不监听 Unix socket
+STREAM_FEED_HTTP_PORT = 0 # 例如 8765: GET http://127.0.0.1:8765/items (NDJSON) 或 ?format=sse；0 表示不监听 HTTP
+STREAM_FEED_HTTP_HOST = '127.0.0.1'
+STREAM_FEED_FIELDS = [] # 推送的字段，为空时与 CSV_EXPORT_FIELDS 相同
+STREAM_FEED_CLIENT_QUEUE = 1000 # 每个消费者最多排队的 Item 数，满了之后抓取等待 (背压)
+STREAM_FEED_SLOW_CLIENT_TIMEOUT = 60 # 消费者阻塞抓取超过该秒数时断开它，0 表示一直等待
+
+# --- 按需性能剖析 (也可运行中用 kill -USR2 <pid> 开关) ---
+PROFILING_ENABLED = False
+PROFILING_SIGNAL = True # 允许 SIGUSR2 开关剖析
+PROFILING_DIR = 'profiles' # 每次运行写入 profiles/<爬虫名>-<时间>-<pid>/
+PROFILING_SAMPLE_INTERVAL = 0.05 # reactor 线程调用栈采样间隔 (秒)，生产环境可用 0.05~0.1
+PROFILING_FLUSH_INTERVAL = 60 # 定期写出折叠栈和计时汇总 (秒)
+PROFILING_TRACEMALLOC = False # tracemalloc 开销较大，需要排查内存时再开启
+PROFILING_TRACEMALLOC_INTERVAL = 300 # 快照间隔 (秒)
+PROFILING_TRACEMALLOC_FRAMES = 1
+PROFILING_TRACEMALLOC_TOP = 25
+
+# --- 调试产物采集 (失败请求 / 无链接页面的截图和 HTML) ---
+ARTIFACTS_ENABLED = True
+ARTIFACTS_DIR = 'artifacts' # 产物目录 (按文件数量轮转)
+ARTIFACTS_SAMPLE_RATE = 0.1 # 默认采样率
+ARTIFACTS_SAMPLE_RATES = {'nolinks': 1.0, 'error': 0.1} # 按产物类型覆盖采样率
+ARTIFACTS_MAX_COUNT = 50 # 单次运行最多采集次数
+ARTIFACTS_MAX_BYTES = 100 * 1024 * 1024 # 单次运行最多写入字节数
+ARTIFACTS_FULL_PAGE = False # False 只截视口，True 截整页 (更慢、更大)
+ARTIFACTS_SCREENSHOT = True
+ARTIFACTS_SCREENSHOT_TYPE = 'jpeg'
+ARTIFACTS_SCREENSHOT_QUALITY = 60
+ARTIFACTS_HTML = True # HTML 快照以 gzip 压缩保存
+ARTIFACTS_DIR_MAX_FILES = 500 # 目录中最多保留的文件数，超出时删除最旧的
+ARTIFACTS_MAX_PENDING_WRITES = 8 # 后台写队列上限，队列满时跳过采集
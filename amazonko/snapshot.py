@@ -0,0 +1,123 @@
+# 精简 DOM 快照 (浏览器内提取)
+# Minimal DOM snapshot (in-page extraction)
+#
+# compact 模式下，页面就绪后在浏览器内执行提取脚本，只收集回调需要的片段
+# (搜索结果链接、下一页链接、商品标题、主图属性、变体脚本)，然后把文档替换为
+# 只包含 <title> 和 JSON 负载的极小 HTML。scrapy-playwright 随后序列化的 page.content()
+# 只有几 KB，Python 端也不需要为整页构建 lxml 树。
+# 如果页面上没有找到预期内容 (例如被阻止的页面)，脚本不替换文档，保留完整 HTML 以便排查。
+# full 模式 (或渲染缓存中的旧页面) 下，同样的快照对象从完整 HTML 中用选择器构建。
+
+import html
+import json
+import re
+
+PAYLOAD_SCRIPT_ID = 'amazonko-payload'
+_PAYLOAD_START = '<script id="%s" type="application/json">' % PAYLOAD_SCRIPT_ID
+_PAYLOAD_WINDOW = 16384 # compact 文档中负载紧跟在 <title> 之后，只在开头查找标记
+
+PRODUCT_LINK_SELECTOR = 'a.a-link-normal.s-no-outline[href*="/dp/"]'
+NEXT_PAGE_SELECTOR = 'a.s-pagination-item.s-pagination-next'
+VARIATION_SCRIPT_MARKER = 'dimensionValuesDisplayData'
+
+# 用提取到的负载替换整个文档 (JSON 中的 '<' 转义，避免提前结束 script 标签)
+_REPLACE_DOCUMENT_JS = """
+    const title = document.title;
+    const json = JSON.stringify(payload).replace(/</g, '\\\\u003c');
+    document.open();
+    document.write('<html><head><title></title></head><body><script id="%s" type="application/json">' + json + '</' + 'script></body></html>');
+    document.close();
+    document.title = title;
+    return true;
+""" % PAYLOAD_SCRIPT_ID
+
+SEARCH_EXTRACT_JS = """
+() => {
+    const payload = {
+        links: Array.from(document.querySelectorAll('%s')).map(a => a.getAttribute('href')),
+        next: (document.querySelector('%s') || {getAttribute: () => null}).getAttribute('href'),
+    };
+    if (!payload.links.length) return false; // 保留完整文档以便排查
+    %s
+}
+""" % (PRODUCT_LINK_SELECTOR, NEXT_PAGE_SELECTOR, _REPLACE_DOCUMENT_JS)
+
+DETAIL_EXTRACT_JS = """
+() => {
+    const attr = (selector, name) => { const el = document.querySelector(selector); return el ? el.getAttribute(name) : null; };
+    const titleEl = document.querySelector('#productTitle') || document.querySelector('h1#title span#productTitle');
+    const script = Array.from(document.scripts).find(s => s.text && s.text.includes('%s'));
+    const payload = {
+        product_title: titleEl ? titleEl.textContent : null,
+        dynamic_image: attr('#imgTagWrapperId img', 'data-a-dynamic-image') || attr('#landingImage', 'data-a-dynamic-image'),
+        landing_src: attr('#landingImage', 'src'),
+        wrapper_src: attr('#imgTagWrapperId img', 'src'),
+        variation_script: script ? script.text : null,
+    };
+    if (!payload.product_title && !payload.dynamic_image && !payload.landing_src) return false; // 保留完整文档以便排查
+    %s
+}
+""" % (VARIATION_SCRIPT_MARKER, _REPLACE_DOCUMENT_JS)
+
+
+def is_compact_response(response):
+    """响应是否为 compact 快照 (文档开头有负载标记)；完整页面只检查前 16 KB，不扫描整页。"""
+    return response.text.find(_PAYLOAD_START, 0, _PAYLOAD_WINDOW) >= 0
+
+
+def _extract_payload(response):
+    """从 compact 模式的响应中取出 JSON 负载；不是 compact 响应时返回 None。负载本身不限大小 (变体脚本可能很长)。"""
+    text = response.text
+    start = text.find(_PAYLOAD_START, 0, _PAYLOAD_WINDOW)
+    if start < 0: return None
+    start += len(_PAYLOAD_START)
+    end = text.find('</script>', start) # JSON 中的 '<' 已转义，负载内不会出现 </script>
+    if end < 0: return None
+    try: return json.loads(text[start:end])
+    except ValueError: return None
+
+
+def _page_title(response):
+    match = re.search(r'<title[^>]*>(.*?)</title>', response.text, re.DOTALL | re.IGNORECASE)
+    return html.unescape(match.group(1)).strip() if match else ''
+
+
+class SearchSnapshot:
+    """搜索结果页回调需要的数据：页面标题、商品链接 (原始 href)、下一页链接。"""
+    __slots__ = ('compact', 'page_title', 'links', 'next_href')
+
+    def __init__(self, response):
+        payload = _extract_payload(response)
+        self.compact = payload is not None
+        if self.compact:
+            self.page_title = _page_title(response)
+            self.links = [href for href in payload.get('links') or [] if href]
+            self.next_href = payload.get('next')
+        else:
+            self.page_title = response.css('title::text').get('')
+            self.links = response.css(PRODUCT_LINK_SELECTOR + '::attr(href)').getall()
+            self.next_href = response.css(NEXT_PAGE_SELECTOR + '::attr(href)').get()
+
+
+class DetailSnapshot:
+    """详情页回调需要的数据：页面标题、商品标题、主图相关属性、变体脚本。"""
+    __slots__ = ('compact', 'page_title', 'product_title', 'dynamic_image', 'landing_src', 'wrapper_src', 'variation_script')
+
+    def __init__(self, response):
+        payload = _extract_payload(response)
+        self.compact = payload is not None
+        if self.compact:
+            self.page_title = _page_title(response)
+            self.product_title = (payload.get('product_title') or '').strip()
+            self.dynamic_image = payload.get('dynamic_image')
+            self.landing_src = payload.get('landing_src')
+            self.wrapper_src = payload.get('wrapper_src')
+            self.variation_script = payload.get('variation_script')
+        else:
+            self.page_title = response.css('title::text').get('')
+            self.product_title = response.css('#productTitle::text').get('').strip() or response.css('h1#title span#productTitle::text').get('').strip()
+            self.dynamic_image = response.css('#imgTagWrapperId img::attr(data-a-dynamic-image)').get() \
+                                 or response.css('#landingImage::attr(data-a-dynamic-image)').get() # 备用选择器
+            self.landing_src = response.css('#landingImage::attr(src)').get()
+            self.wrapper_src = response.css('#imgTagWrapperId img::attr(src)').get()
+            self.variation_script = response.xpath(f"//script[contains(text(), '{VARIATION_SCRIPT_MARKER}')]/text()").get()
@@ -1,15 +1,27 @@
 import scrapy
 import json
+import os
 import re
 import logging
-from urllib.parse import urljoin, urlparse, parse_qs, unquote # 导入 unquote 用于解码 URL
+from urllib.parse import urljoin
 from scrapy.utils.response import open_in_browser # 调试时在浏览器中打开响应
 from amazonko.items import AmazonkoItem # 导入定义的 Item
-from scrapy.utils.project import get_project_settings # 获取项目设置
+from amazonko.artifacts import ArtifactCapture # 调试产物采集 (截图 / HTML 快照)
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from twisted.internet import threads
 from datetime import datetime
 # 导入 PageMethod 以便在 meta 中使用
 from scrapy_playwright.page import PageMethod
 import traceback # 用于打印更详细的 JSON 解析错误
+from weakref import WeakSet
+from amazonko.fingerprint import build_spoof_script # 语言 / 时区指纹覆盖脚本
+from amazonko.readiness import ReadinessPolicy # 按页面类型的就绪策略和自适应超时
+from amazonko.snapshot import SearchSnapshot, DetailSnapshot, SEARCH_EXTRACT_JS, DETAIL_EXTRACT_JS # 精简 DOM 快照
+from amazonko.profiling import timed # 按需剖析计时 (未开启时几乎无开销)
+from amazonko.browser_server import BrowserServerMonitor, ensure_browser_server # 常驻浏览器 (attach 模式)
+from amazonko.marketplaces import load_marketplaces, marketplace_for_url # 多站点 (us / uk / de ...)
+from amazonko.asinlist import AsinListReader # ASIN 列表模式 (跳过搜索页)
 
 logger = logging.getLogger(__name__)
 
@@ -18,8 +30,8 @@ def clean_json_string(json_string):
     """尝试更健壮地清理可能包含注释或尾随逗号的 JSON 字符串"""
     if not isinstance(json_string, str): return json_string
     try:
-        # 移除 JavaScript 单行注释 //...
-        json_string = re.sub(r"//.*", "", json_string)
+        # 移除 JavaScript 单行注释 //... (不匹配 URL 中的 "://")
+        json_string = re.sub(r"(?<!:)//.*", "", json_string)
         # 移除 JavaScript 多行注释 /*...*/ (非贪婪匹配)
         json_string = re.sub(r"/\*.*?\*/", "", json_string, flags=re.DOTALL)
         # 移除行首行尾的空白符
@@ -43,208 +55,287 @@ class AmazonkoSpider(scrapy.Spider):
     name = "amazonko" # 爬虫名称
     allowed_domains = ["amazon.com"] # 允许爬取的域名
 
-    # ( __init__ 方法保持不变 )
-    def __init__(self, keyword=None, max_pages=None, max_items=None, *args, **kwargs):
+    def __init__(self, keyword=None, max_pages=None, max_items=None, marketplaces=None, asin_file=None, *args, **kwargs):
         super(AmazonkoSpider, self).__init__(*args, **kwargs)
-        if keyword is None: raise ValueError("请使用 -a keyword='您的搜索词' 提供关键词")
-        self.search_keyword = keyword
-        self.start_urls = [f"https://www.amazon.com/s?k={keyword.replace(' ', '+')}"]
-        settings = get_project_settings()
-        self.max_pages = int(max_pages) if max_pages is not None else settings.getint('MAX_PAGES_TO_CRAWL', 0)
-        self.max_items = int(max_items) if max_items is not None else settings.getint('MAX_ITEMS_TO_CRAWL', 0)
-        self.crawled_pages = 0
+        if keyword is None and asin_file is None: raise ValueError("请使用 -a keyword='您的搜索词' 提供关键词，或使用 -a asin_file=asins.txt (- 表示标准输入) 提供 ASIN 列表")
+        self.search_keyword = keyword # ASIN 列表模式下可选，只作为 Item 的 search_keyword 和身份的粘性键
+        self._asin_file_arg = asin_file # 指定时跳过搜索页，直接抓取列表中 ASIN 的详情页 (见 amazonko/asinlist.py)
+        self._max_pages_arg = max_pages; self._max_items_arg = max_items # 由 _configure 结合设置解析
+        self._marketplaces_arg = marketplaces # 逗号分隔的站点代码，例如 -a marketplaces=us,uk,de
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        """
+        使用 crawler.settings (包括命令行 -s 覆盖) 初始化，不再另外调用 get_project_settings()。
+        BROWSER_MODE = 'attach' 时确保常驻浏览器可用，并让 scrapy-playwright 通过 CDP 连接它
+        (设置在 crawler 冻结设置、创建下载处理器之前写入)。
+        每个站点的主机使用独立的下载 slot (并发 / 延迟预算)；多站点时全局并发上限按站点数放大。
+        """
+        settings = crawler.settings
+        marketplaces = load_marketplaces(settings, kwargs.get('marketplaces'))
+        download_slots = dict(settings.getdict('DOWNLOAD_SLOTS'))
+        for marketplace in marketplaces: download_slots.setdefault(marketplace.host, marketplace.download_slot())
+        settings.set('DOWNLOAD_SLOTS', download_slots, priority='spider')
+        if len(marketplaces) > 1:
+            settings.set('CONCURRENT_REQUESTS', settings.getint('CONCURRENT_REQUESTS') * len(marketplaces), priority='spider')
+        browser_monitor = None
+        if settings.get('BROWSER_MODE', 'launch') == 'attach':
+            cdp_url = ensure_browser_server(settings)
+            settings.set('PLAYWRIGHT_CDP_URL', cdp_url, priority='spider')
+            browser_monitor = BrowserServerMonitor(settings)
+            logger.info(f"连接常驻浏览器: {cdp_url}")
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider._configure(settings, marketplaces)
+        spider.browser_monitor = browser_monitor
+        if browser_monitor: crawler.signals.connect(spider._spider_opened, signal=signals.spider_opened)
+        if spider.asin_list: # 分批调度：爬虫启动、待处理请求不足或爬虫空闲时从列表中取下一批
+            crawler.signals.connect(spider._feed_asins_on_open, signal=signals.spider_opened)
+            crawler.signals.connect(spider._feed_asins_on_response, signal=signals.response_received)
+            crawler.signals.connect(spider._feed_asins_on_idle, signal=signals.spider_idle)
+        return spider
+
+    def _configure(self, settings, marketplaces=None):
+        # 要抓取的站点 (未指定时为 AMAZON_BASE_URL 对应的站点，可指向本地模拟服务器，见 benchmarks/mock_amazon.py)
+        marketplaces = marketplaces or load_marketplaces(settings, self._marketplaces_arg)
+        self.marketplaces = {m.code: m for m in marketplaces}
+        self.base_url = marketplaces[0].base_url
+        self.allowed_domains = list(dict.fromkeys(m.domain for m in marketplaces))
+        self.asin_list = AsinListReader(self._asin_file_arg, self.marketplaces) if self._asin_file_arg else None
+        self.asin_chunk_size = settings.getint('ASIN_LIST_CHUNK_SIZE', 500)
+        self.asin_low_watermark = settings.getint('ASIN_LIST_LOW_WATERMARK', 100)
+        self.asin_identities = max(1, settings.getint('ASIN_LIST_IDENTITIES', 8))
+        self._asin_reading = False # 是否正在 (线程中) 读取下一批
+        self._asin_chunks = 0 # 已调度的批次数 (批次编号对 ASIN_LIST_IDENTITIES 取模作为身份的粘性键)
+        self.start_urls = [] if self.asin_list else [m.search_url(self.search_keyword) for m in marketplaces]
+        self.max_pages = int(self._max_pages_arg) if self._max_pages_arg is not None else settings.getint('MAX_PAGES_TO_CRAWL', 0)
+        self.max_items = int(self._max_items_arg) if self._max_items_arg is not None else settings.getint('MAX_ITEMS_TO_CRAWL', 0)
+        self.crawled_pages = {code: 0 for code in self.marketplaces} # 按站点统计搜索页数 (MAX_PAGES 对每个站点生效)
         self.crawled_items_count = 0
-        logger.info(f"启动爬虫，关键词: '{self.search_keyword}'")
+        self.artifacts = ArtifactCapture.from_settings(settings) # 按采样率和预算保存调试产物
+        self.item_context = {} # (站点, ASIN) -> 图片下载使用的代理 (路由数据不放在 Item 中，由图片管道取出)
+        self.context_args = settings.getdict('PLAYWRIGHT_CONTEXT_ARGS') # 默认的 Playwright 上下文参数
+        self._spoofed_contexts = WeakSet() # 已注册指纹覆盖 init script 的浏览器上下文
+        self.readiness = ReadinessPolicy.from_settings(settings) # 页面就绪策略 (PAGE_READINESS)
+        self.dom_extraction_mode = settings.get('DOM_EXTRACTION_MODE', 'compact') # 'compact': 浏览器内提取精简快照; 'full': 传输完整 HTML
+        if self.asin_list: logger.info(f"启动爬虫 (ASIN 列表模式): {self._asin_file_arg}，站点: {', '.join(self.marketplaces)}")
+        else: logger.info(f"启动爬虫，关键词: '{self.search_keyword}'，站点: {', '.join(self.marketplaces)}")
         logger.info(f"最大抓取页数: {'无限制' if self.max_pages == 0 else self.max_pages}")
         logger.info(f"最大抓取商品数 (含变体): {'无限制' if self.max_items == 0 else self.max_items}")
 
+    def _spider_opened(self, spider):
+        self.browser_monitor.start() # 运行期间定期检查常驻浏览器，崩溃时重启
+
+    def _marketplace(self, request_or_response):
+        code = request_or_response.meta.get('marketplace')
+        if code in self.marketplaces: return self.marketplaces[code]
+        return marketplace_for_url(self.marketplaces.values(), request_or_response.url) or next(iter(self.marketplaces.values()))
+
+    def _playwright_meta(self, page_type, marketplace, **extra):
+        """
+        构建所有 Playwright 页面请求 (搜索页、翻页、详情页) 共用的 meta。
+        指纹覆盖脚本由 _init_page 在页面创建时按上下文注册，不再在 goto 之后 evaluate。
+        goto 选项和等待条件由 ReadinessPolicy 按页面类型生成 (超时根据观测到的 p95 自适应)。
+        compact 模式下，在等待条件之后追加浏览器内提取脚本 (见 amazonko/snapshot.py)。
+        上下文参数 (locale / 时区) 来自请求所属的站点。
+        """
+        page_methods = self.readiness.page_methods(page_type)
+        if self.dom_extraction_mode == 'compact':
+            page_methods.append(PageMethod('evaluate', SEARCH_EXTRACT_JS if page_type == 'search' else DETAIL_EXTRACT_JS))
+        meta = {
+            'playwright': True, # 启用 Playwright
+            'playwright_include_page': True, # 需要访问 Playwright Page 对象
+            'playwright_context_kwargs': { # 继续传递上下文参数 (仅在创建上下文时生效)
+                'locale': marketplace.locale,
+                'timezone_id': marketplace.timezone_id,
+                'geolocation': None, # 禁用默认地理位置
+                'permissions': [], # 清空权限
+                'viewport': {"width": 1920, "height": 1080}, # 保持视口设置
+                **marketplace.context_args, # 站点额外的上下文参数
+            },
+            'playwright_page_init_callback': self._init_page, # 页面创建后、导航前执行
+            'playwright_page_goto_options': self.readiness.goto_options(page_type),
+            'playwright_page_methods': page_methods,
+            'page_type': page_type, # 渲染缓存 / 调度器按页面类型处理
+            'marketplace': marketplace.code, # 调度器按站点分配预算，代理 / 身份按站点选择
+            'dont_cache': True, # Playwright 页面由渲染缓存处理，不走 HttpCacheMiddleware
+        }
+        meta.update(extra)
+        return meta
+
+    async def _init_page(self, page, request):
+        """
+        页面初始化回调：每个浏览器上下文只注册一次指纹覆盖 init script。
+        上下文级别的 init script 会被该上下文中的所有页面 (包括之后的详情页、翻页) 继承，
+        并且在页面自身的脚本之前执行。
+        """
+        context = page.context
+        if context in self._spoofed_contexts: return
+        self._spoofed_contexts.add(context) # 先标记，避免同一上下文的并发页面重复注册
+        context_kwargs = request.meta.get('playwright_context_kwargs', {})
+        locale = context_kwargs.get('locale', self.context_args.get('locale', 'en-US'))
+        timezone_id = context_kwargs.get('timezone_id', self.context_args.get('timezone_id', 'America/New_York'))
+        try:
+            await context.add_init_script(script=build_spoof_script(locale, timezone_id))
+            logger.debug(f"已为浏览器上下文注册指纹覆盖脚本 (locale={locale}, timezone={timezone_id})")
+        except Exception as e:
+            self._spoofed_contexts.discard(context)
+            logger.error(f"注册指纹覆盖脚本失败: {e}")
+
     def start_requests(self):
         """
         生成初始请求。使用 Playwright。
-        注入 JS 以尝试覆盖地理位置信息。
+        地理位置 / 语言 / 时区覆盖由上下文级 init script 完成 (见 _init_page)。
         使用简化的等待条件。
         """
+        if self.asin_list: return # ASIN 列表在线程中分批读取，由 _feed_asins 调度 (爬虫启动时调度第一批)
         if not self.start_urls: logger.error("未提供关键词，无法开始请求。"); return
-        settings = get_project_settings(); locale = settings.get('PLAYWRIGHT_CONTEXT_ARGS', {}).get('locale', 'en-US'); timezone_id = settings.get('PLAYWRIGHT_CONTEXT_ARGS', {}).get('timezone_id', 'America/New_York')
-        # 准备注入的 JS 代码
-        spoof_js = f"""
-        () => {{
-            try {{
-                // 覆盖语言设置
-                Object.defineProperty(navigator, 'language', {{ value: '{locale}', configurable: true }});
-                Object.defineProperty(navigator, 'languages', {{ value: ['{locale}', 'en'], configurable: true }});
-                // 尝试模拟地理位置 API (返回固定值或错误)
-                if (navigator.geolocation) {{
-                    navigator.geolocation.getCurrentPosition = function(success, error) {{
-                        console.log('Spoofed getCurrentPosition called');
-                        // success({{ coords: {{ latitude: 40.7128, longitude: -74.0060, accuracy: 100 }}, timestamp: Date.now() }}); // 模拟纽约
-                        error({{ code: 1, message: "Geolocation access denied by spoof." }}); // 或者模拟拒绝
-                    }};
-                    navigator.geolocation.watchPosition = function(success, error) {{
-                        console.log('Spoofed watchPosition called');
-                        // return setInterval(() => success({{ coords: {{ latitude: 40.7128, longitude: -74.0060, accuracy: 100 }}, timestamp: Date.now() }}), 1000); // 模拟持续更新
-                        error({{ code: 1, message: "Geolocation access denied by spoof." }}); // 或者模拟拒绝
-                        return 0; // 返回 watchId
-                    }};
-                    logger.info('Geolocation API spoofed.');
-                }}
-                // 覆盖时区 (更可靠的方式)
-                Date.prototype.getTimezoneOffset = function() {{
-                    // 需要根据 timezone_id 计算正确的偏移量 (分钟)
-                    // 这比较复杂，可以先返回一个固定值，例如纽约是 -240 (夏令时) 或 -300 (标准时间)
-                    // 或者使用更复杂的库来计算
-                    // 简单示例：返回纽约大致的偏移量
-                    const offset = new Date().toLocaleString("{locale}", {{timeZone: "{timezone_id}", timeZoneName: "shortOffset"}}).split("GMT")[1];
-                    if (offset) return -parseInt(offset, 10) * 60;
-                    return -240; // 备用：纽约夏令时偏移
-                }};
-                Intl.DateTimeFormat.prototype.resolvedOptions = new Proxy(Intl.DateTimeFormat.prototype.resolvedOptions, {{
-                    apply(target, self, args) {{
-                        const options = Reflect.apply(target, self, args);
-                        options.timeZone = '{timezone_id}';
-                        options.locale = '{locale}';
-                        return options;
-                    }}
-                 }});
-                 logger.info('Timezone and Locale spoofed.');
-            }} catch (e) {{ console.error('Error during JS spoofing:', e); }}
-        }}
-        """
-
-        for url in self.start_urls:
+        for marketplace in self.marketplaces.values(): # 各站点的搜索并行进行
             yield scrapy.Request(
-                url,
+                marketplace.search_url(self.search_keyword),
                 callback=self.parse_search_results,
-                meta={
-                    'playwright': True, # 启用 Playwright
-                    'playwright_include_page': True, # 需要访问 Playwright Page 对象
-                    'playwright_context_kwargs': { # 继续传递上下文参数
-                        'locale': locale,
-                        'timezone_id': timezone_id,
-                        'geolocation': None, # 禁用默认地理位置
-                        'permissions': [], # 清空权限
-                        'viewport': {"width": 1920, "height": 1080}, # 保持视口设置
-                    },
-                    'playwright_page_goto_options': {
-                        'wait_until': 'domcontentloaded', # 等待 DOM 加载即可
-                    },
-                    'playwright_page_methods': [
-                        # *** 在页面加载前执行 JS 注入 ***
-                        PageMethod('evaluate', spoof_js),
-                        # *******************************
-                        # 等待条件：等待第一个搜索结果项容器可见
-                        PageMethod('wait_for_selector', 'div.s-result-item[data-asin]', state='visible', timeout=60000),
-                    ],
-                    'current_page': 1
-                },
+                # 等待条件：第一个搜索结果项容器 (见 PAGE_READINESS['search'])
+                meta=self._playwright_meta('search', marketplace, current_page=1),
                 errback=self.errback_handle, # 指定错误处理函数
             )
 
+    # --- ASIN 列表模式 ---
+    def _asin_requests(self, chunk):
+        """为一批 (Marketplace, ASIN) 生成直接进入 parse_product_detail 的规范详情页请求。"""
+        chunk_id = self._asin_chunks; self._asin_chunks += 1
+        for marketplace, asin in chunk: # 同一站点的同一 ASIN 重复出现时由请求去重 (规范 URL 的指纹) 过滤
+            yield scrapy.Request(
+                marketplace.product_url(asin), callback=self.parse_product_detail,
+                meta=self._playwright_meta(
+                    'detail', marketplace, asin=asin, search_keyword=self.search_keyword, handle_httpstatus_list=[404, 503],
+                    # 各批轮流使用固定数量的身份：整个列表不会由同一个身份抓取，身份数量也不随列表长度增长
+                    identity_key=f"asins-{chunk_id % self.asin_identities}",
+                ),
+                errback=self.errback_handle,
+            )
+
+    def _asin_limit_reached(self):
+        return self.max_items > 0 and self.crawled_items_count >= self.max_items
+
+    def _feed_asins(self):
+        """
+        调度器中待处理的请求少于 ASIN_LIST_LOW_WATERMARK 时在线程中读取下一批 (标准输入可能长时间没有数据，
+        不能阻塞 reactor)，读取完成后调度。返回列表是否还有剩余 (包括正在读取)。
+        """
+        if self._asin_reading: return True
+        if self.asin_list.done or self._asin_limit_reached(): return False
+        engine = self.crawler.engine
+        if len(engine.scheduler) >= self.asin_low_watermark: return True
+        self._asin_reading = True
+        d = threads.deferToThread(self.asin_list.next_chunk, self.asin_chunk_size)
+        d.addCallback(self._schedule_asins)
+        d.addErrback(lambda failure: logger.error(f"读取 ASIN 列表失败: {failure.value}"))
+        d.addBoth(self._asin_read_finished)
+        return True
+
+    def _schedule_asins(self, chunk):
+        if self._asin_limit_reached(): return
+        engine = self.crawler.engine
+        for request in self._asin_requests(chunk): engine.crawl(request)
+        self.crawler.stats.inc_value('asin_list/scheduled', len(chunk))
+        if self.asin_list.done: logger.info(f"ASIN 列表已读完: {self.asin_list.lines} 行，无效 {self.asin_list.invalid} 行")
+
+    def _asin_read_finished(self, _):
+        self._asin_reading = False
+
+    def _feed_asins_on_open(self, spider):
+        self._feed_asins()
+
+    def _feed_asins_on_response(self, response, request, spider):
+        if request.meta.get('page_type') == 'detail': self._feed_asins()
+
+    def _feed_asins_on_idle(self, spider):
+        if self._feed_asins(): raise DontCloseSpider # 列表还有剩余 (或正在等待标准输入)，不关闭爬虫
+
     async def parse_search_results(self, response):
         """
         解析搜索结果页面。
         使用上次成功的选择器。
         修正了详情页请求的 meta 和等待条件。
+        渲染缓存命中时没有 playwright_page (page 为 None)。
         """
-        page_number = response.meta.get('current_page', 1); self.crawled_pages += 1
-        logger.info(f"正在解析搜索结果页面: {page_number} - URL: {response.url}")
+        marketplace = self._marketplace(response)
+        page_number = response.meta.get('current_page', 1); self.crawled_pages[marketplace.code] = self.crawled_pages.get(marketplace.code, 0) + 1
+        logger.info(f"正在解析搜索结果页面 [{marketplace.code}]: {page_number} - URL: {response.url}")
         page = response.meta.get('playwright_page')
+        if not response.meta.get('render_cache_hit'): self.readiness.observe('search', response.meta.get('download_latency'))
+        try:
+            # 精简快照 (compact 模式来自浏览器内提取，否则从完整 HTML 用选择器构建)
+            with timed('search.snapshot'): snapshot = SearchSnapshot(response)
 
-        # 检查是否是错误页面（例如包含 "page not found" 或 "狗页面" 的标题）
-        page_title = await page.title() if page else response.css('title::text').get('')
-        if "page not found" in page_title.lower() or "sorry" in page_title.lower() or "robot check" in page_title.lower():
-            logger.error(f"检测到错误/阻止页面 (标题: {page_title})，URL: {response.url}。跳过解析。")
-            if page and not page.is_closed(): await page.close()
-            return # 不再处理此错误页面
-
-        # *** 使用上次成功的选择器 ***
-        PRODUCT_LINK_SELECTOR = 'a.a-link-normal.s-no-outline[href*="/dp/"]::attr(href)'
-        # **************************
-
-        product_links_raw = response.css(PRODUCT_LINK_SELECTOR).getall()
-        logger.info(f"使用选择器 '{PRODUCT_LINK_SELECTOR}' 在页面 {page_number} 找到 {len(product_links_raw)} 个链接。")
-
-        # (链接验证和去重逻辑保持不变)
-        valid_product_links = []
-        seen_asins = set()
-        for link in product_links_raw:
-            if '/sspa/click' in link:
-                try:
-                    parsed_qs_data = parse_qs(urlparse(link).query)
-                    if 'url' in parsed_qs_data: link = urljoin(response.url, unquote(parsed_qs_data['url'][0]).split('?')[0])
-                    else: continue
-                except Exception as e: logger.warning(f"解析 SSPA 链接时出错: {link} - Error: {e}"); continue
-            else: link = urljoin(response.url, link.split('?')[0])
-            asin_match = re.search(r'/(dp|gp/product)/([A-Z0-9]{10})', link)
-            if asin_match:
-                asin = asin_match.group(2)
-                if asin not in seen_asins: seen_asins.add(asin); valid_product_links.append(link)
-            else: logger.debug(f"链接不含 ASIN，跳过: {link}")
-        logger.info(f"在页面 {page_number} 找到 {len(valid_product_links)} 个有效且唯一的商品链接")
-        if not valid_product_links:
-             logger.warning(f"在页面 {page_number} 未找到有效的商品链接。请检查主要选择器 '{PRODUCT_LINK_SELECTOR}' 和页面内容。")
-             if page: # 保存调试文件
-                 try:
-                     html_content = await page.content()
-                     with open(f"page_{page_number}_nolinks_source.html", "w", encoding="utf-8") as f: f.write(html_content)
-                     await page.screenshot(path=f"page_{page_number}_nolinks_screenshot.png", full_page=True)
-                     logger.info(f"已保存页面 {page_number} (无有效链接) 的源码和截图。")
-                 except Exception as e: logger.error(f"保存调试文件失败: {e}")
-
-        # 处理商品链接
-        for product_url in valid_product_links:
-            if self.max_items > 0 and self.crawled_items_count >= self.max_items: logger.info(...); return
-            asin_match = re.search(r'/(dp|gp/product)/(\w{10})', product_url); asin = asin_match.group(2) if asin_match else None
-            if not asin: logger.error(...); continue
-
-            # *** 获取当前请求使用的代理信息，传递给详情页请求 ***
-            current_proxy = response.request.meta.get('proxy')
-            # *************************************************
+            # 检查是否是错误页面（例如包含 "page not found" 或 "狗页面" 的标题）
+            page_title = snapshot.page_title
+            if "page not found" in page_title.lower() or "sorry" in page_title.lower() or "robot check" in page_title.lower():
+                logger.error(f"检测到错误/阻止页面 (标题: {page_title})，URL: {response.url}。跳过解析。")
+                return # 不再处理此错误页面
 
-            yield scrapy.Request(
-                product_url, callback=self.parse_product_detail,
-                meta={
-                    'playwright': True, 'playwright_include_page': True,
-                    'playwright_page_goto_options': {'wait_until': 'domcontentloaded'},
-                    # *** 修改详情页等待条件：等待更通用的容器 ***
-                    'playwright_page_methods': [
-                        PageMethod('wait_for_selector', '#dp-container', state='visible', timeout=60000)
-                    ],
-                    # *****************************************
-                    'asin': asin, 'search_keyword': self.search_keyword,
-                    'handle_httpstatus_list': [404, 503],
-                    'proxy_info_for_images': current_proxy # <-- 将代理信息传递下去
-                }, priority=10, errback=self.errback_handle,
-            )
+            product_links_raw = snapshot.links
+            logger.info(f"{'(compact) ' if snapshot.compact else ''}在页面 {page_number} 找到 {len(product_links_raw)} 个链接。")
 
-        # (翻页逻辑保持不变)
-        if self.max_pages > 0 and self.crawled_pages >= self.max_pages: logger.info(f"已达到最大抓取页数 ({self.max_pages})，停止翻页。"); return
-        next_page_selector = 'a.s-pagination-item.s-pagination-next'
-        next_page_relative_url = response.css(next_page_selector + '::attr(href)').get()
-        if next_page_relative_url:
-            next_page_url = urljoin(response.url, next_page_relative_url)
-            logger.info(f"找到下一页链接: {next_page_url}")
-            yield scrapy.Request(
-                next_page_url, callback=self.parse_search_results,
-                meta={
-                    'playwright': True, 'playwright_include_page': True,
-                    'playwright_page_goto_options': {'wait_until': 'domcontentloaded'},
-                    'playwright_page_methods': [
-                        PageMethod('wait_for_selector', 'div.s-result-item[data-asin]', state='visible', timeout=60000)
-                    ],
-                    'current_page': page_number + 1,
-                }, errback=self.errback_handle,
-            )
-        else: logger.info("未找到下一页链接...")
-        if page and not page.is_closed(): await page.close()
+            # 链接验证和去重：SSPA 跳转 / 相对 / 带 slug 的链接统一规范化为本站点的 /dp/{ASIN}
+            valid_product_links = [] # (url, asin)
+            seen_asins = set()
+            for link in product_links_raw:
+                try: product_url, asin = marketplace.canonical_product_url(link, base=response.url)
+                except Exception as e: logger.warning(f"解析商品链接时出错: {link} - Error: {e}"); continue
+                if asin:
+                    if asin not in seen_asins: seen_asins.add(asin); valid_product_links.append((product_url, asin))
+                else: logger.debug(f"链接不含 ASIN，跳过: {link}")
+            logger.info(f"在页面 {page_number} 找到 {len(valid_product_links)} 个有效且唯一的商品链接")
+            if not valid_product_links:
+                 logger.warning(f"在页面 {page_number} 未找到有效的商品链接。请检查主要选择器 (amazonko/snapshot.py) 和页面内容。")
+                 # 按采样率和预算保存调试产物 (压缩 HTML + 视口截图)
+                 with timed('search.artifacts'): await self.artifacts.capture(page, 'nolinks', f"page_{page_number}")
+
+            # 处理商品链接
+            for product_url, asin in valid_product_links:
+                if self.max_items > 0 and self.crawled_items_count >= self.max_items: logger.info(f"已达到最大抓取商品数 ({self.max_items})，停止调度详情页。"); return
+
+                # *** 获取当前请求使用的代理信息，传递给详情页请求 ***
+                current_proxy = response.request.meta.get('proxy')
+                # *************************************************
+
+                yield scrapy.Request(
+                    product_url, callback=self.parse_product_detail,
+                    # *** 详情页等待条件：见 PAGE_READINESS['detail'] ***
+                    meta=self._playwright_meta(
+                        'detail', marketplace,
+                        asin=asin, search_keyword=self.search_keyword,
+                        handle_httpstatus_list=[404, 503],
+                        proxy_info_for_images=current_proxy, # <-- 将代理信息传递下去 (请求 meta，不进入 Item)
+                    ), priority=10, errback=self.errback_handle,
+                )
+
+            # (翻页逻辑保持不变)
+            if self.max_pages > 0 and self.crawled_pages[marketplace.code] >= self.max_pages: logger.info(f"[{marketplace.code}] 已达到最大抓取页数 ({self.max_pages})，停止翻页。"); return
+            next_page_relative_url = snapshot.next_href
+            if next_page_relative_url:
+                next_page_url = urljoin(response.url, next_page_relative_url)
+                logger.info(f"找到下一页链接: {next_page_url}")
+                yield scrapy.Request(
+                    next_page_url, callback=self.parse_search_results,
+                    meta=self._playwright_meta('search', marketplace, current_page=page_number + 1),
+                    errback=self.errback_handle,
+                )
+            else: logger.info("未找到下一页链接...")
+        finally:
+            # 所有提前 return (错误页面、max_items、max_pages) 都要关闭页面，否则页面一直占用浏览器内存
+            if page and not page.is_closed():
+                with timed('search.page_close'): await page.close()
 
     async def parse_product_detail(self, response):
         """
         解析商品详情页面。
         增强了主图提取和 JSON 解析。
         从 meta 获取代理信息以传递给 Item。
+        渲染缓存命中时没有 playwright_page (page 为 None)。
         """
         page = response.meta.get('playwright_page')
+        marketplace = self._marketplace(response)
         asin = response.meta.get('asin')
         search_keyword = response.meta.get('search_keyword')
         product_url = response.url
@@ -252,12 +343,16 @@ class AmazonkoSpider(scrapy.Spider):
         proxy_info = response.request.meta.get('proxy_info_for_images')
         # ***************************
         if not asin: logger.error(f"详情页请求未能接收到 ASIN: {response.url}"); return
+        if not response.meta.get('render_cache_hit'): self.readiness.observe('detail', response.meta.get('download_latency'))
 
         try:
             if response.status in [404, 503]: logger.warning(...); return
 
+            # 精简快照 (compact 模式来自浏览器内提取，否则从完整 HTML 用选择器构建)
+            with timed('detail.snapshot'): snapshot = DetailSnapshot(response)
+
             # 检查是否是错误页面
-            page_title = await page.title() if page else response.css('title::text').get('')
+            page_title = snapshot.page_title
             if "page not found" in page_title.lower() or "sorry" in page_title.lower() or "robot check" in page_title.lower():
                 logger.error(f"检测到详情页错误/阻止页面 (标题: {page_title})，URL: {response.url}。跳过解析。")
                 return
@@ -265,15 +360,14 @@ class AmazonkoSpider(scrapy.Spider):
             logger.info(f"正在解析商品详情页: {product_url} (ASIN: {asin})")
 
             # (提取 title 和 main_image_url 逻辑不变)
-            title = response.css('#productTitle::text').get('').strip() or response.css('h1#title span#productTitle::text').get('').strip() or "N/A"
+            title = snapshot.product_title or "N/A"
             
             # *** 增强主图 URL 提取逻辑 ***
             main_image_url = None
             large_image_url_from_json = None # 存储从 JSON 找到的最大图
             try:
                 # 1. 优先解析 data-a-dynamic-image JSON
-                dynamic_image_data = response.css('#imgTagWrapperId img::attr(data-a-dynamic-image)').get() \
-                                     or response.css('#landingImage::attr(data-a-dynamic-image)').get() # 备用选择器
+                dynamic_image_data = snapshot.dynamic_image
                 if dynamic_image_data:
                     try:
                         image_dict = json.loads(dynamic_image_data)
@@ -290,11 +384,11 @@ class AmazonkoSpider(scrapy.Spider):
                      main_image_url = large_image_url_from_json
                 else:
                     # 3. 否则，尝试 #landingImage 的 src
-                    main_image_url = response.css('#landingImage::attr(src)').get()
+                    main_image_url = snapshot.landing_src
                     if main_image_url: logger.debug(f"通过 #landingImage src 找到主图: {main_image_url[:60]}...")
                     else:
                         # 4. 最后尝试 #imgTagWrapperId img 的 src
-                        main_image_url = response.css('#imgTagWrapperId img::attr(src)').get()
+                        main_image_url = snapshot.wrapper_src
                         if main_image_url: logger.debug(f"通过 #imgTagWrapperId img src 找到主图: {main_image_url[:60]}...")
 
                 # 尝试去除 URL 中的尺寸参数 (如果存在且看起来是标准格式)
@@ -315,20 +409,20 @@ class AmazonkoSpider(scrapy.Spider):
             if not main_image_url: logger.warning(f"最终未能提取主图 URL (ASIN: {asin})")
             
             # --- 创建主商品的 Item ---
-            item = AmazonkoItem()
-            item['search_keyword'] = search_keyword; item['product_url'] = product_url; item['asin'] = asin; item['title'] = title; item['image_urls_to_download'] = [main_image_url] if main_image_url else []; item['is_variation'] = False; item['crawled_at'] = datetime.now().isoformat()
-            # *** 将代理信息存入 Item，以便图片管道使用 ***
-            item['proxy_info_for_images'] = proxy_info
-            # ******************************************
+            crawled_at = datetime.now().isoformat() # 同一详情页的主商品和变体共用一个时间戳
+            item = AmazonkoItem(search_keyword=search_keyword, marketplace=marketplace.code, product_url=product_url, asin=asin, title=title, image_urls_to_download=[main_image_url] if main_image_url else [], is_variation=False, crawled_at=crawled_at)
 
             if self.max_items > 0 and self.crawled_items_count >= self.max_items: return
             self.crawled_items_count += 1
+            # *** 将代理信息存入 item_context，以便图片管道使用 ***
+            if proxy_info: self.item_context[(marketplace.code, asin)] = proxy_info
+            # **************************************************
             logger.debug(f"Yielding 主商品: ASIN={asin}...")
             yield item
             
             
             # --- 提取颜色变体信息 ---
-            variation_data_script = response.xpath("//script[contains(text(), 'dimensionValuesDisplayData')]/text()").get()
+            variation_data_script = snapshot.variation_script
             variation_asin_map = {}
             variation_image_map = {}
 
@@ -345,9 +439,9 @@ class AmazonkoSpider(scrapy.Spider):
                     if json_match:
                         variation_json_str = json_match.group(1)
                         # 清理字符串
-                        cleaned_json_str = clean_json_string(variation_json_str)
+                        with timed('detail.clean_json'): cleaned_json_str = clean_json_string(variation_json_str)
                         try:
-                            variation_data = json.loads(cleaned_json_str)
+                            with timed('detail.variation_json'): variation_data = json.loads(cleaned_json_str)
                             # (后续解析 color_data 和 color_images 逻辑不变)
                             if 'dimensionValuesDisplayData' in variation_data:
                                 for var_asin, details in variation_data.get('dimensionValuesDisplayData', {}).items():
@@ -372,7 +466,7 @@ class AmazonkoSpider(scrapy.Spider):
                      logger.error(f"处理变体脚本时发生意外错误 (ASIN: {asin}): {e}\n{traceback.format_exc()}")
 
             # (HTML swatch 提取逻辑不变)
-            if not variation_asin_map:
+            if not variation_asin_map and not snapshot.compact: # compact 快照中没有 swatch HTML
                 color_swatches = response.css('ul[aria-labelledby="color_name-label"] li[data-asin]') or response.css('#variation_color_name ul li')
                 # ... (swatch 解析逻辑) ...
 
@@ -383,32 +477,32 @@ class AmazonkoSpider(scrapy.Spider):
                 if self.max_items > 0 and self.crawled_items_count >= self.max_items: return
                 var_image_url = variation_image_map.get(var_asin, main_image_url)
                 if not var_image_url: logger.error(...); continue
-                variation_item = AmazonkoItem()
-                # ... (填充 variation_item) ...
-                variation_item['search_keyword'] = search_keyword; variation_item['product_url'] = f"{product_url.split('/dp/')[0]}/dp/{var_asin}"; variation_item['asin'] = var_asin; variation_item['title'] = f"{title} ({color})"; variation_item['image_urls_to_download'] = [var_image_url]; variation_item['is_variation'] = True; variation_item['variation_type'] = 'Color'; variation_item['variation_value'] = color; variation_item['crawled_at'] = datetime.now().isoformat()
-                # *** 将代理信息也存入变体 Item *** 11:11新增
-                variation_item['proxy_info_for_images'] = proxy_info
-                # **********************************
+                variation_item = AmazonkoItem(search_keyword=search_keyword, marketplace=marketplace.code, product_url=marketplace.product_url(var_asin), asin=var_asin, title=f"{title} ({color})", image_urls_to_download=[var_image_url], is_variation=True, parent_asin=asin, variation_type='Color', variation_value=color, crawled_at=crawled_at)
+                # *** 变体图片也使用同一代理 ***
+                if proxy_info: self.item_context[(marketplace.code, var_asin)] = proxy_info
+                # ****************************
                 self.crawled_items_count += 1
                 yield variation_item
 
         finally:
             # 确保 Playwright 页面关闭
              if page and not page.is_closed():
-                await page.close()
+                with timed('detail.page_close'): await page.close()
 
     async def errback_handle(self, failure):
-        # (内容同上一版本，包含截图)
         logger.error(f"请求失败: {failure.request.url} - 类型: {failure.type} - 值: {failure.value}")
+        if "TimeoutError" in str(failure.type) and failure.request.meta.get('page_type'):
+            self.readiness.observe_timeout(failure.request.meta['page_type']) # 超时后向上调整该页面类型的等待超时
         page = failure.request.meta.get('playwright_page')
         if page and not page.is_closed():
             logger.debug(f"尝试关闭失败请求的页面: {failure.request.url}")
-            try:
-                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-                 screenshot_path = f"error_screenshot_{timestamp}.png"
-                 await page.screenshot(path=screenshot_path, full_page=True)
-                 logger.info(f"已保存错误截图: {screenshot_path} (针对 URL: {failure.request.url})")
-            except Exception as ss_err: logger.error(f"保存错误截图失败: {ss_err}")
+            await self.artifacts.capture(page, 'error', failure.request.url) # 按采样率和预算保存调试产物
             try: await page.close(); logger.debug(f"因错误关闭 Playwright 页面: {failure.request.url}")
             except Exception as e: logger.error(f"关闭失败的 Playwright 页面时出错: {e}")
 
+    def closed(self, reason):
+        # 爬虫关闭时等待调试产物写完
+        if self.browser_monitor: self.browser_monitor.stop() # 常驻浏览器本身继续运行，供下次使用
+        if self.asin_list and not self._asin_reading: self.asin_list.close() # 读取线程仍在等待输入时不关闭文件
+        self.artifacts.close()
+        logger.info(f"页面就绪超时统计: {self.readiness.summary()}")
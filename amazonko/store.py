@@ -0,0 +1,124 @@
+# 商品数据 SQLite 存储 (输出后端)
+# Product data SQLite store (output backend)
+#
+# 与 CSV 导出不同，数据跨多次运行累积：按 (站点, ASIN) upsert 到 products / variations 表
+# (同一 ASIN 在不同站点是不同的商品页，标题 / 链接 / 图片各不相同)，
+# 每个 (关键词, 站点, ASIN) 的命中记录在 keyword_hits 表中。
+# 写入按批次在单个事务中执行 (WAL 模式)，查询端 (看板) 可以在抓取期间并发读取。
+
+import logging
+import os
+import sqlite3
+
+from amazonko.profiling import timed
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS products ("
+    " marketplace TEXT NOT NULL, asin TEXT NOT NULL, title TEXT, product_url TEXT, main_image_url TEXT, downloaded_image_name TEXT,"
+    " first_seen_at TEXT, crawled_at TEXT, PRIMARY KEY (marketplace, asin))",
+    "CREATE TABLE IF NOT EXISTS variations ("
+    " marketplace TEXT NOT NULL, asin TEXT NOT NULL, parent_asin TEXT, variation_type TEXT, variation_value TEXT, title TEXT, product_url TEXT,"
+    " main_image_url TEXT, downloaded_image_name TEXT, first_seen_at TEXT, crawled_at TEXT, PRIMARY KEY (marketplace, asin))",
+    "CREATE TABLE IF NOT EXISTS keyword_hits ("
+    " search_keyword TEXT NOT NULL, marketplace TEXT NOT NULL, asin TEXT NOT NULL, is_variation INTEGER NOT NULL DEFAULT 0,"
+    " hits INTEGER NOT NULL DEFAULT 1, first_seen_at TEXT, crawled_at TEXT, PRIMARY KEY (search_keyword, marketplace, asin))",
+    "CREATE INDEX IF NOT EXISTS idx_products_asin ON products (asin)", # 跨站点按 ASIN 查询
+    "CREATE INDEX IF NOT EXISTS idx_products_crawled_at ON products (crawled_at)",
+    "CREATE INDEX IF NOT EXISTS idx_variations_asin ON variations (marketplace, asin)",
+    "CREATE INDEX IF NOT EXISTS idx_variations_parent_asin ON variations (marketplace, parent_asin)",
+    "CREATE INDEX IF NOT EXISTS idx_variations_crawled_at ON variations (crawled_at)",
+    "CREATE INDEX IF NOT EXISTS idx_keyword_hits_asin ON keyword_hits (marketplace, asin)",
+    "CREATE INDEX IF NOT EXISTS idx_keyword_hits_crawled_at ON keyword_hits (crawled_at)",
+)
+
+# 已有的图片文件名等字段不被本次的空值覆盖；first_seen_at 只在首次插入时写入
+UPSERT_PRODUCT = (
+    "INSERT INTO products (marketplace, asin, title, product_url, main_image_url, downloaded_image_name, first_seen_at, crawled_at)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+    " ON CONFLICT (marketplace, asin) DO UPDATE SET"
+    " title = COALESCE(excluded.title, title), product_url = COALESCE(excluded.product_url, product_url),"
+    " main_image_url = COALESCE(excluded.main_image_url, main_image_url),"
+    " downloaded_image_name = COALESCE(excluded.downloaded_image_name, downloaded_image_name),"
+    " crawled_at = excluded.crawled_at"
+)
+UPSERT_VARIATION = (
+    "INSERT INTO variations (marketplace, asin, parent_asin, variation_type, variation_value, title, product_url, main_image_url,"
+    " downloaded_image_name, first_seen_at, crawled_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    " ON CONFLICT (marketplace, asin) DO UPDATE SET"
+    " parent_asin = COALESCE(excluded.parent_asin, parent_asin),"
+    " variation_type = COALESCE(excluded.variation_type, variation_type),"
+    " variation_value = COALESCE(excluded.variation_value, variation_value),"
+    " title = COALESCE(excluded.title, title), product_url = COALESCE(excluded.product_url, product_url),"
+    " main_image_url = COALESCE(excluded.main_image_url, main_image_url),"
+    " downloaded_image_name = COALESCE(excluded.downloaded_image_name, downloaded_image_name),"
+    " crawled_at = excluded.crawled_at"
+)
+UPSERT_KEYWORD_HIT = (
+    "INSERT INTO keyword_hits (search_keyword, marketplace, asin, is_variation, hits, first_seen_at, crawled_at) VALUES (?, ?, ?, ?, 1, ?, ?)"
+    " ON CONFLICT (search_keyword, marketplace, asin) DO UPDATE SET hits = hits + 1, crawled_at = excluded.crawled_at"
+)
+
+
+class ProductStore:
+    """
+    商品数据的 SQLite 存储。
+    - add(item) 只把行放入内存缓冲区，缓冲达到 batch_size 时自动 flush。
+    - flush() 在单个事务中批量 upsert 三张表；暂时性错误 (OperationalError) 时保留缓冲并抛出，其他错误时丢弃本批。
+    - default_marketplace: Item 没有站点时使用。
+    """
+    def __init__(self, path, batch_size=100, default_marketplace='us'):
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.default_marketplace = default_marketplace
+        db_dir = os.path.dirname(path)
+        if db_dir: os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA: self.conn.execute(statement)
+        self.conn.commit()
+        self.products, self.variations, self.keyword_hits = [], [], []
+        self.pending = 0 # 缓冲中的 Item 数
+        self.written = 0 # 已写入的 Item 数
+        logger.info(f"商品数据库已打开: {path}")
+
+    def add(self, item):
+        if not item.asin: return
+        marketplace = item.marketplace or self.default_marketplace
+        if item.is_variation:
+            self.variations.append((marketplace, item.asin, item.parent_asin, item.variation_type, item.variation_value, item.title, item.product_url,
+                                    item.main_image_url, item.downloaded_image_name, item.crawled_at, item.crawled_at))
+        else:
+            self.products.append((marketplace, item.asin, item.title, item.product_url, item.main_image_url, item.downloaded_image_name,
+                                  item.crawled_at, item.crawled_at))
+        if item.search_keyword:
+            self.keyword_hits.append((item.search_keyword, marketplace, item.asin, int(item.is_variation), item.crawled_at, item.crawled_at))
+        self.pending += 1
+        if self.pending >= self.batch_size: self.flush()
+
+    def flush(self):
+        if not self.pending: return
+        try:
+            with timed('pipeline.sqlite_flush'), self.conn: # 单个事务，异常时回滚
+                if self.products: self.conn.executemany(UPSERT_PRODUCT, self.products)
+                if self.variations: self.conn.executemany(UPSERT_VARIATION, self.variations)
+                if self.keyword_hits: self.conn.executemany(UPSERT_KEYWORD_HIT, self.keyword_hits)
+        except sqlite3.OperationalError:
+            raise # database is locked 等暂时性错误：保留缓冲，下一次写入时重试
+        except sqlite3.Error as e: # 约束错误等重试也不会成功：丢弃本批，避免缓冲无限增长
+            logger.error(f"商品数据库写入失败，丢弃本批 {self.pending} 条 Item: {e}")
+            self.products, self.variations, self.keyword_hits = [], [], []
+            self.pending = 0
+            return
+        logger.debug(f"商品数据库写入 {self.pending} 条 Item (产品 {len(self.products)}, 变体 {len(self.variations)})")
+        self.written += self.pending
+        self.products, self.variations, self.keyword_hits = [], [], []
+        self.pending = 0
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
@@ -0,0 +1,59 @@
+# 通用辅助函数
+# Shared helpers
+
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def get_rss_bytes(pid=None):
+    """
+    返回进程当前的常驻内存 (RSS, 字节)。读取 /proc/<pid>/statm，
+    非 Linux 平台或进程不存在时返回 None。
+    """
+    try:
+        with open(f"/proc/{pid or 'self'}/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def process_tree(pid):
+    """返回 pid 及其所有子孙进程的 pid (读取 /proc/*/stat)。"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit(): continue
+        try:
+            with open(f"/proc/{entry}/stat") as f: ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop(); tree.append(current); stack.extend(children.get(current, ()))
+    return tree
+
+
+def get_tree_rss_bytes(pid, include_root=True):
+    """返回进程树 (pid 及其子孙进程) 的 RSS 总和 (字节)；非 Linux 平台返回 None。"""
+    if get_rss_bytes(pid) is None: return None
+    pids = process_tree(pid)
+    if not include_root: pids = pids[1:]
+    return sum(get_rss_bytes(p) or 0 for p in pids)
+
+
+def request_class(request):
+    """
+    返回请求的类别 (search / detail / image / other)，
+    用于调度预算和统计。优先使用 meta['request_class']，其次 meta['page_type']。
+    """
+    return request.meta.get('request_class') or request.meta.get('page_type') or 'other'
+
+
+def request_queue_name(request):
+    """调度队列名: 请求类别，多站点时加上站点代码 (如 detail@uk)，每个站点有独立的类别预算。"""
+    marketplace = request.meta.get('marketplace')
+    return f"{request_class(request)}@{marketplace}" if marketplace else request_class(request)
@@ -0,0 +1,212 @@
+# 浏览器内存看门狗：关闭遗留页面，按页数 / 内存回收浏览器上下文和浏览器
+# Browser memory watchdog: close orphaned pages, recycle contexts / the browser by page count or RSS
+#
+# 长时间运行时同一个 Chromium 一直存活：回调没有关闭的页面 (提前 return 等) 和渲染进程的内存碎片
+# 会让 RSS 持续上涨，直到被 OOM killer 结束。看门狗每 WATCHDOG_INTERVAL 秒检查一次：
+# - 页面: 打开超过 WATCHDOG_PAGE_MAX_AGE 秒的页面视为遗留页面，强制关闭。
+#   (回调结束后仍未关闭的页面由 PageCloseSpiderMiddleware 立即关闭。)
+# - 上下文: 渲染 WATCHDOG_CONTEXT_MAX_PAGES 个页面后回收 —— 之后的请求改用新名称的上下文
+#   (身份上下文的代数 +1，默认上下文 default-gN)，旧上下文在在途请求和页面都结束后关闭 (先排空)。
+#   长时间 (WATCHDOG_CONTEXT_IDLE 秒) 没有请求的上下文 (如已轮换身份的上下文) 也会被关闭。
+# - 浏览器 (launch 模式): 浏览器进程树 RSS 超过 WATCHDOG_BROWSER_RSS_MB 时先回收全部上下文；回收后仍超过，
+#   或浏览器累计渲染 WATCHDOG_BROWSER_MAX_PAGES 个页面后，暂停引擎、等待在途页面请求结束，
+#   然后关闭浏览器 (scrapy-playwright 在下一个请求时重新启动)，再恢复引擎。
+# - attach 模式: 常驻浏览器被多个爬虫共享，进程 RSS 包含其他运行的页面，不能作为本次运行的依据，
+#   也不能由某个爬虫重启 (会断开其他运行)。因此不检查 RSS；累计页数达到上限时只回收本次运行的上下文。
+
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from weakref import WeakKeyDictionary
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.defer import deferred_from_coro
+from twisted.internet import task
+
+from amazonko.utils import get_tree_rss_bytes
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONTEXT = 'default'
+
+
+class BrowserWatchdog:
+    """
+    按爬虫 (crawler) 共享一个实例 (见 from_crawler)，由 BrowserWatchdogMiddleware 在请求经过时更新。
+    - context_for(request): 没有指定上下文的 Playwright 请求使用当前代的默认上下文。
+    - request_started / request_finished: 按上下文统计在途请求 (用于排空)。
+    - page_rendered: 按上下文统计渲染页数，达到上限时回收上下文。
+    """
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('WATCHDOG_ENABLED', True):
+            raise NotConfigured("WATCHDOG_ENABLED 未启用。")
+        self.crawler = crawler
+        self.settings = settings
+        self.stats = crawler.stats
+        self.interval = settings.getfloat('WATCHDOG_INTERVAL', 30)
+        self.page_max_age = settings.getfloat('WATCHDOG_PAGE_MAX_AGE', 600)
+        self.context_max_pages = settings.getint('WATCHDOG_CONTEXT_MAX_PAGES', 200) # 0 表示不按页数回收
+        self.context_idle = settings.getfloat('WATCHDOG_CONTEXT_IDLE', 300)
+        self.browser_rss_limit = settings.getint('WATCHDOG_BROWSER_RSS_MB', 0) * 1024 * 1024 # 0 表示不检查
+        self.browser_max_pages = settings.getint('WATCHDOG_BROWSER_MAX_PAGES', 0) # 0 表示不按页数重启
+        self.drain_timeout = settings.getfloat('WATCHDOG_DRAIN_TIMEOUT', 120)
+        self.attach_mode = settings.get('BROWSER_MODE', 'launch') == 'attach'
+        self.default_generation = 0
+        self.inflight = defaultdict(int) # 上下文名称 -> 在途 Playwright 请求数
+        self.pages = defaultdict(int) # 上下文名称 -> 已渲染页数
+        self.last_used = {} # 上下文名称 -> 最后一次有请求的时间
+        self.retiring = set() # 等待排空后关闭的上下文
+        self.browser_pages = 0 # 当前浏览器累计渲染页数
+        self.contexts_recycled_for_rss = False # RSS 超限时是否已经回收过全部上下文
+        self._page_seen = WeakKeyDictionary() # Page -> 首次看到的时间
+        self._loop = None
+        self._restarting = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        watchdog = getattr(crawler, 'browser_watchdog', None)
+        if watchdog is None:
+            watchdog = crawler.browser_watchdog = cls(crawler)
+            crawler.signals.connect(watchdog.spider_opened, signal=signals.spider_opened)
+            crawler.signals.connect(watchdog.spider_closed, signal=signals.spider_closed)
+        return watchdog
+
+    def spider_opened(self, spider):
+        if self.interval <= 0: return
+        self._loop = task.LoopingCall(self._tick)
+        self._loop.start(self.interval, now=False)
+
+    def spider_closed(self, spider):
+        if self._loop and self._loop.running: self._loop.stop()
+
+    # --- 由中间件调用 ---
+    def context_for(self, request):
+        name = request.meta.get('playwright_context')
+        if name and not name.startswith(DEFAULT_CONTEXT + '-g'): return name # 身份上下文由 IdentityMiddleware 指定
+        return f"{DEFAULT_CONTEXT}-g{self.default_generation}" # 重试请求也改用当前代的默认上下文
+
+    def request_started(self, name):
+        self.inflight[name] += 1
+        self.last_used[name] = time.monotonic()
+
+    def request_finished(self, name):
+        if self.inflight[name] > 0: self.inflight[name] -= 1
+
+    def page_rendered(self, name, identity=None):
+        self.pages[name] += 1; self.browser_pages += 1
+        if self.context_max_pages and self.pages[name] >= self.context_max_pages and name not in self.retiring:
+            self._recycle_context(name, identity, f"已渲染 {self.pages[name]} 个页面")
+
+    # --- 回收 ---
+    def _recycle_context(self, name, identity=None, reason=''):
+        """之后的请求改用新上下文，旧上下文在排空后关闭。"""
+        self.retiring.add(name)
+        manager = getattr(self.crawler, 'identity_manager', None)
+        if identity is not None and manager is not None:
+            if identity.context_name == name: manager.recycle(identity) # 身份代数 +1 (保留会话)
+        elif name == f"{DEFAULT_CONTEXT}-g{self.default_generation}":
+            self.default_generation += 1
+        self.stats.inc_value('watchdog/context_recycled')
+        logger.info(f"回收浏览器上下文 {name} ({reason})，排空后关闭")
+
+    def _recycle_all_contexts(self, reason):
+        manager = getattr(self.crawler, 'identity_manager', None)
+        identities = {ident.context_name: ident for ident in manager.identities.values()} if manager else {}
+        for handler in self._handlers():
+            for name in list(handler.context_wrappers):
+                if name not in self.retiring: self._recycle_context(name, identities.get(name), reason)
+
+    def _handlers(self):
+        """当前已创建的 scrapy-playwright 下载处理器 (http / https 各一个实例)。"""
+        engine = self.crawler.engine
+        handlers = getattr(getattr(getattr(engine, 'downloader', None), 'handlers', None), '_handlers', {})
+        return [h for h in handlers.values() if hasattr(h, 'context_wrappers')]
+
+    def browser_rss(self):
+        """本进程启动的浏览器 (驱动 + 浏览器，即本进程的子孙进程) 的 RSS (字节)；attach 模式无法归属到本次运行，返回 None。"""
+        if self.attach_mode: return None
+        return get_tree_rss_bytes(os.getpid(), include_root=False)
+
+    # --- 定期检查 ---
+    def _tick(self):
+        d = deferred_from_coro(self.check()) # LoopingCall 等待本次检查 (包括重启浏览器) 完成后才开始计时
+        d.addErrback(lambda failure: logger.error(f"浏览器看门狗检查失败: {failure.value}"))
+        return d
+
+    async def check(self):
+        now = time.monotonic()
+        open_pages = 0; open_contexts = 0
+        for handler in self._handlers():
+            for name, wrapper in list(handler.context_wrappers.items()):
+                open_contexts += 1
+                pages = list(wrapper.context.pages)
+                for page in pages:
+                    first_seen = self._page_seen.setdefault(page, now)
+                    if now - first_seen > self.page_max_age and not page.is_closed():
+                        logger.warning(f"关闭遗留页面 (上下文 {name}，已打开 {now - first_seen:.0f}s): {page.url}")
+                        await self._close_quietly(page)
+                        self.stats.inc_value('watchdog/orphan_pages_closed')
+                open_pages += sum(1 for page in pages if not page.is_closed())
+                idle = now - self.last_used.get(name, now)
+                if self.inflight[name] == 0 and not any(not page.is_closed() for page in wrapper.context.pages) \
+                        and (name in self.retiring or idle > self.context_idle):
+                    await self._close_context(name, wrapper)
+        self.stats.set_value('watchdog/open_pages', open_pages)
+        self.stats.set_value('watchdog/open_contexts', open_contexts)
+
+        rss = self.browser_rss()
+        if rss is not None:
+            self.stats.max_value('watchdog/browser_rss_max', rss)
+            logger.debug(f"浏览器看门狗: {open_contexts} 个上下文, {open_pages} 个页面, 浏览器 RSS {rss / 1048576:.0f} MB")
+        over_rss = bool(self.browser_rss_limit and rss and rss > self.browser_rss_limit)
+        if self.browser_max_pages and self.browser_pages >= self.browser_max_pages:
+            if self.attach_mode: # 共享的常驻浏览器不重启，只换用新的上下文
+                self._recycle_all_contexts(f"累计渲染 {self.browser_pages} 个页面"); self.browser_pages = 0
+            else:
+                await self.restart_browser(f"累计渲染 {self.browser_pages} 个页面")
+        elif over_rss and not self.contexts_recycled_for_rss:
+            self.contexts_recycled_for_rss = True
+            self._recycle_all_contexts(f"浏览器 RSS {rss / 1048576:.0f} MB 超过上限")
+        elif over_rss and not self.retiring:
+            await self.restart_browser(f"回收上下文后浏览器 RSS 仍为 {rss / 1048576:.0f} MB")
+        elif not over_rss:
+            self.contexts_recycled_for_rss = False
+
+    async def _close_quietly(self, target):
+        try: await target.close()
+        except Exception as e: logger.debug(f"关闭时出错 (可能已关闭): {e}")
+
+    async def _close_context(self, name, wrapper):
+        await self._close_quietly(wrapper.context) # 处理器在 close 事件中移除该上下文
+        self.retiring.discard(name); self.pages.pop(name, None); self.inflight.pop(name, None); self.last_used.pop(name, None)
+        self.stats.inc_value('watchdog/contexts_closed')
+        logger.info(f"已关闭浏览器上下文 {name}")
+
+    async def restart_browser(self, reason):
+        """暂停引擎，等待在途页面请求结束后重启浏览器，再恢复引擎 (只用于 launch 模式)。"""
+        if self._restarting or self.attach_mode: return
+        self._restarting = True
+        engine = self.crawler.engine
+        logger.warning(f"重启浏览器 ({reason})，先排空在途请求")
+        engine.pause()
+        try:
+            deadline = time.monotonic() + self.drain_timeout
+            while sum(self.inflight.values()) and time.monotonic() < deadline:
+                await asyncio.sleep(0.5)
+            if sum(self.inflight.values()):
+                logger.warning(f"排空超时 ({self.drain_timeout:.0f}s)，仍有 {sum(self.inflight.values())} 个在途请求，强制重启")
+            for handler in self._handlers():
+                for name, wrapper in list(handler.context_wrappers.items()): await self._close_context(name, wrapper)
+                browser = getattr(handler, 'browser', None)
+                if browser is not None: await self._close_quietly(browser) # 处理器在下一个请求时重新启动浏览器
+            self.retiring.clear(); self.pages.clear()
+            self.browser_pages = 0; self.contexts_recycled_for_rss = False
+            self.default_generation += 1
+            self.stats.inc_value('watchdog/browser_restarted')
+        finally:
+            engine.unpause()
+            self._restarting = False
@@ -0,0 +1,88 @@
+# 浏览器启动耗时基准测试
+# Browser start-up benchmark
+#
+# 比较一次短抓取在 "第一个页面加载完成" 之前的准备耗时：
+#   launch : 启动 Playwright 驱动 + chromium.launch(PLAYWRIGHT_LAUNCH_OPTIONS) (当前每次运行的方式)
+#   attach : 启动 Playwright 驱动 + connect_over_cdp 连接常驻浏览器 (BROWSER_MODE = 'attach')
+# 两种方式之后都创建上下文、打开页面并加载同一个本地页面。每种方式重复 --runs 次，报告中位数和最大值。
+# attach 模式首次运行前会用 ensure_browser_server 启动常驻浏览器 (不计入耗时)，结束后默认将其关闭。
+#
+# 用法 (Usage):
+#     python benchmarks/browser_startup.py [--runs 5] [--keep-server]
+# 需要已安装 Playwright 浏览器 (playwright install chromium)。
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from playwright.async_api import async_playwright
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SCRAPY_SETTINGS_MODULE', 'amazonko.settings')
+from scrapy.utils.project import get_project_settings
+from amazonko.browser_server import ensure_browser_server, stop_browser_server
+
+PAGE_HTML = b"<html><head><title>bench</title></head><body><div id='dp-container'>ok</div></body></html>"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200); self.send_header('Content-Type', 'text/html'); self.send_header('Content-Length', str(len(PAGE_HTML)))
+        self.end_headers(); self.wfile.write(PAGE_HTML)
+
+    def log_message(self, *args): pass
+
+
+async def first_page(mode, url, launch_options, cdp_url):
+    """返回 (浏览器就绪耗时, 第一个页面加载完成耗时)，单位秒。"""
+    start = time.perf_counter()
+    async with async_playwright() as pw:
+        if mode == 'launch':
+            browser = await pw.chromium.launch(**launch_options)
+        else:
+            browser = await pw.chromium.connect_over_cdp(cdp_url)
+        ready = time.perf_counter() - start
+        context = await browser.new_context()
+        page = await context.new_page()
+        await page.goto(url, wait_until='domcontentloaded')
+        await page.wait_for_selector('#dp-container', state='attached')
+        loaded = time.perf_counter() - start
+        await context.close()
+        await browser.close() # attach 模式下只断开连接，常驻浏览器继续运行
+    return ready, loaded
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Browser start-up benchmark (launch vs attach)")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--keep-server', action='store_true', help="结束后保留常驻浏览器")
+    args = parser.parse_args()
+    settings = get_project_settings()
+    launch_options = dict(settings.getdict('PLAYWRIGHT_LAUNCH_OPTIONS'), headless=True)
+    settings.set('PLAYWRIGHT_LAUNCH_OPTIONS', launch_options) # 常驻浏览器同样无头启动
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/bench"
+
+    warm_start = time.perf_counter()
+    cdp_url = ensure_browser_server(settings)
+    print(f"browser server ready: {cdp_url} ({time.perf_counter() - warm_start:.2f}s, not counted)")
+    try:
+        for mode in ('launch', 'attach'):
+            results = [await first_page(mode, url, launch_options, cdp_url) for _ in range(args.runs)]
+            ready = [r[0] for r in results]; loaded = [r[1] for r in results]
+            print(f"{mode:<7} runs={args.runs}  browser ready: median={statistics.median(ready) * 1000:7.0f} ms max={max(ready) * 1000:7.0f} ms  "
+                  f"first page: median={statistics.median(loaded) * 1000:7.0f} ms max={max(loaded) * 1000:7.0f} ms")
+    finally:
+        if not args.keep_server: stop_browser_server(settings)
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
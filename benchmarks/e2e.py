@@ -0,0 +1,165 @@
+# 端到端吞吐量基准测试
+# End-to-end throughput benchmark
+#
+# 启动本地模拟 Amazon 服务器 (可选本地正向代理)，在子进程中用真实的爬虫、中间件、
+# Playwright 下载处理器和全部管道抓取它，然后报告：
+#   items/min、pages/min (搜索页 + 详情页)、重试次数、CPU 时间、Scrapy 进程和整个进程树 (含浏览器) 的峰值 RSS。
+# 子进程使用自动生成的覆盖设置模块 (from amazonko.settings import * 后改写站点 URL、代理和输出路径)，
+# 所有输出写入 --out 目录，不影响项目目录中的 CSV / 数据库 / 图片。
+#
+# 用法 (Usage):
+#     python benchmarks/e2e.py [--keyword "usb c cable"] [--max-pages 3] [--max-items 0] [--proxy]
+#                              [--latency 0.3] [--error-rate 0.05] [--captcha-rate 0.02] [--variations 3]
+#                              [--set DOWNLOAD_DELAY=0] [--set CONCURRENT_REQUESTS=8] [--json]
+# 需要已安装 Playwright 浏览器 (playwright install chromium)。
+
+import argparse
+import ast
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from amazonko.utils import get_rss_bytes, process_tree
+from mock_amazon import add_config_arguments, config_from_args, start_servers
+
+OVERLAY_MODULE = 'e2e_settings'
+
+OVERLAY_TEMPLATE = """# 由 benchmarks/e2e.py 自动生成
+from amazonko.settings import *
+
+AMAZON_BASE_URL = {base_url!r}
+PROXY_CONFIG = {proxy_config!r}
+PROXY_PREFLIGHT_TARGET = {preflight_target!r}
+LOG_LEVEL = 'INFO'
+LOG_FILE = {log_file!r}
+CSV_OUTPUT_FILE = {out!r} + '/products.csv'
+SQLITE_STORE_PATH = {out!r} + '/products.sqlite3'
+IMAGES_STORE = {out!r} + '/images'
+ARTIFACTS_DIR = {out!r} + '/artifacts'
+RENDER_CACHE_ENABLED = False # 每次都真实渲染，测量的是抓取链路而不是缓存
+HTTPCACHE_ENABLED = False
+# 无头模式；Chromium 默认不对回环地址使用代理，需显式取消该例外
+PLAYWRIGHT_LAUNCH_OPTIONS = dict(PLAYWRIGHT_LAUNCH_OPTIONS, headless=True,
+                                 args=PLAYWRIGHT_LAUNCH_OPTIONS.get('args', []) + ['--proxy-bypass-list=<-loopback>'])
+"""
+
+
+def parse_override(text):
+    key, _, value = text.partition('=')
+    try: value = ast.literal_eval(value)
+    except (ValueError, SyntaxError): pass # 按字符串处理
+    return key.strip(), value
+
+
+def write_overlay(out_dir, base_url, proxy_url, preflight_target):
+    proxy_config = [{'provider_type': 'mock', 'endpoints': [proxy_url], 'headers': {}, 'enabled': True}] if proxy_url else []
+    with open(os.path.join(out_dir, OVERLAY_MODULE + '.py'), 'w', encoding='utf-8') as f:
+        f.write(OVERLAY_TEMPLATE.format(base_url=base_url, proxy_config=proxy_config, preflight_target=preflight_target,
+                                        log_file=os.path.join(out_dir, 'scrapy.log'), out=out_dir))
+
+
+def run_child(args):
+    """子进程：用覆盖设置运行爬虫，并把统计信息写入 JSON。"""
+    sys.path.insert(0, args.out)
+    os.environ['SCRAPY_SETTINGS_MODULE'] = OVERLAY_MODULE
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+    settings = get_project_settings()
+    for override in args.set:
+        key, value = parse_override(override); settings.set(key, value, priority='cmdline')
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler('amazonko')
+    process.crawl(crawler, keyword=args.keyword, max_pages=args.max_pages, max_items=args.max_items)
+    process.start()
+    with open(os.path.join(args.out, 'stats.json'), 'w', encoding='utf-8') as f:
+        json.dump(crawler.stats.get_stats(), f, default=str, indent=2)
+    # 爬虫未能启动 (例如缺少依赖) 时 process.start() 不会抛出异常，没有 finish_reason 即视为失败
+    if not crawler.stats.get_value('finish_reason'): sys.exit(1)
+
+
+def run_benchmark(args):
+    os.makedirs(args.out, exist_ok=True)
+    config = config_from_args(args)
+    server, proxy = start_servers(config, proxy_port=0 if args.proxy else None)
+    host, port = server.server_address[:2]
+    base_url = f"http://{host}:{port}"
+    proxy_url = f"http://{proxy.server_address[0]}:{proxy.server_address[1]}" if proxy else None
+    write_overlay(args.out, base_url, proxy_url, f"{host}:{port}")
+
+    command = [sys.executable, os.path.abspath(__file__), '--child', '--out', args.out, '--keyword', args.keyword,
+               '--max-pages', str(args.max_pages), '--max-items', str(args.max_items)]
+    for override in args.set: command += ['--set', override]
+    start = time.perf_counter()
+    child = subprocess.Popen(command, cwd=ROOT)
+    peak_rss = peak_tree_rss = 0
+    while child.poll() is None:
+        peak_rss = max(peak_rss, get_rss_bytes(child.pid) or 0)
+        peak_tree_rss = max(peak_tree_rss, sum(get_rss_bytes(pid) or 0 for pid in process_tree(child.pid)))
+        time.sleep(args.sample_interval)
+    elapsed = time.perf_counter() - start
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN) # 子进程及其已回收的子孙进程 (浏览器、Playwright 驱动)
+    server.shutdown()
+    if proxy: proxy.shutdown()
+
+    stats = {}
+    stats_path = os.path.join(args.out, 'stats.json')
+    if os.path.exists(stats_path):
+        with open(stats_path, encoding='utf-8') as f: stats = json.load(f)
+    minutes = elapsed / 60
+    items = stats.get('item_scraped_count', 0)
+    pages = config.counts['search'] + config.counts['detail']
+    report = {
+        'exit_code': child.returncode,
+        'finish_reason': stats.get('finish_reason'),
+        'elapsed_s': round(elapsed, 2),
+        'items': items,
+        'items_per_min': round(items / minutes, 1) if minutes else 0,
+        'pages': pages,
+        'pages_per_min': round(pages / minutes, 1) if minutes else 0,
+        'images': config.counts['image'],
+        'retries': stats.get('retry/count', 0),
+        'retry_max_reached': stats.get('retry/max_reached', 0),
+        'captchas_served': config.counts['captcha'],
+        'errors_served': config.counts['error'],
+        'proxy_requests': config.counts['proxy_get'] + config.counts['proxy_connect'],
+        'cpu_user_s': round(usage.ru_utime, 2),
+        'cpu_system_s': round(usage.ru_stime, 2),
+        'peak_rss_mb': round(peak_rss / 1048576, 1),
+        'peak_tree_rss_mb': round(peak_tree_rss / 1048576, 1),
+        'out': args.out,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items(): print(f"{key:<20} {value}")
+    return child.returncode
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark against the mock Amazon server")
+    parser.add_argument('--keyword', default='usb c cable')
+    parser.add_argument('--max-pages', type=int, default=3)
+    parser.add_argument('--max-items', type=int, default=0)
+    parser.add_argument('--proxy', action='store_true', help="通过本地正向代理访问 (测试代理中间件和预检)")
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help="覆盖 Scrapy 设置 (可多次指定)")
+    parser.add_argument('--out', default=None, help="输出目录 (默认临时目录)")
+    parser.add_argument('--sample-interval', type=float, default=0.5, help="RSS 采样间隔 (秒)")
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args); return
+    args.out = os.path.abspath(args.out or tempfile.mkdtemp(prefix='amazonko-e2e-'))
+    sys.exit(run_benchmark(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+# 本地模拟 Amazon 服务器 (以及可选的本地正向代理)
+# Local mock Amazon server (plus an optional local forward proxy)
+#
+# 提供与爬虫选择器匹配的搜索结果页、详情页 (含颜色变体脚本) 和图片，
+# 可配置延迟、错误率 (503)、CAPTCHA 比例和翻页深度，用于离线测量整条抓取链路的吞吐量。
+# 页面内容由 (关键词, 页码, 序号) 确定性生成，同一配置多次运行结果一致。
+#
+# 用法 (Usage):
+#     python benchmarks/mock_amazon.py [--port 8800] [--proxy-port 8801] [--latency 0.3] [--error-rate 0.05]
+#                                      [--captcha-rate 0.02] [--pages 5] [--results 16] [--variations 3]
+# 然后设置 AMAZON_BASE_URL = 'http://127.0.0.1:8800' (e2e.py 会自动完成这些步骤)。
+
+import argparse
+import base64
+import hashlib
+import html
+import http.client
+import json
+import random
+import re
+import select
+import socket
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# 32x32 JPEG (所有商品图片共用)
+IMAGE_BYTES = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDABALDA4MChAODQ4SERATGCgaGBYWGDEjJR0oOjM9PDkzODdASFxOQERXRTc4UG1RV19iZ2hnPk1xeXBkeFxlZ2P/"
+    "2wBDARESEhgVGC8aGi9jQjhCY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2P/wAARCAAgACADASIAAhEBAxEB/8QA"
+    "HwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUFBAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkK"
+    "FhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXG"
+    "x8jJytLT1NXW19jZ2uHi4+Tl5ufo6erx8vP09fb3+Pn6/8QAHwEAAwEBAQEBAQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREAAgECBAQDBAcFBAQAAQJ3AAEC"
+    "AxEEBSExBhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYkNOEl8RcYGRomJygpKjU2Nzg5OkNERUZHSElKU1RVVldYWVpjZGVmZ2hpanN0dXZ3eHl6goOE"
+    "hYaHiImKkpOUlZaXmJmaoqOkpaanqKmqsrO0tba3uLm6wsPExcbHyMnK0tPU1dbX2Nna4uPk5ebn6Onq8vP09fb3+Pn6/9oADAMBAAIRAxEAPwCSiiivGPWC"
+    "iiigAooooAKKKKAP/9k="
+)
+COLORS = ('Black', 'White', 'Red', 'Blue', 'Green', 'Silver', 'Pink', 'Gray')
+ASIN_RE = re.compile(r'/dp/([A-Z0-9]{10})')
+
+CAPTCHA_HTML = """<html><head><title>Robot Check</title></head><body>
+<form action="/errors/validateCaptcha"><h4>Enter the characters you see below</h4>
+<img src="/captcha/image.jpg"><input id="captchacharacters" name="field-keywords"></form></body></html>"""
+
+
+def make_asin(*parts):
+    """由任意参数确定性生成 10 位 ASIN。"""
+    return 'B0' + hashlib.sha1('|'.join(map(str, parts)).encode()).hexdigest()[:8].upper()
+
+
+class MockConfig:
+    def __init__(self, latency=0.3, jitter=0.5, error_rate=0.0, captcha_rate=0.0, pages=5, results=16, variations=3, seed=0):
+        self.latency = latency # 平均延迟 (秒)
+        self.jitter = jitter # 延迟在 latency × (1 ± jitter) 之间均匀分布
+        self.error_rate = error_rate # 返回 503 的比例 (页面和图片)
+        self.captcha_rate = captcha_rate # 返回 CAPTCHA 页面的比例 (仅搜索页和详情页)
+        self.pages = pages # 搜索结果翻页深度
+        self.results = results # 每页商品数
+        self.variations = variations # 每个商品的颜色变体数
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = Counter() # 按路由统计的请求数 (search / detail / image / captcha / error / proxy_*)
+
+    def roll(self, rate):
+        with self.lock: return self.random.random() < rate
+
+    def delay(self):
+        if self.latency <= 0: return
+        with self.lock: factor = 1 + self.random.uniform(-self.jitter, self.jitter)
+        time.sleep(max(0.0, self.latency * factor))
+
+    def count(self, key):
+        with self.lock: self.counts[key] += 1
+
+
+def search_page(base_url, keyword, page, config):
+    items = []
+    for i in range(config.results):
+        asin = make_asin(keyword, page, i)
+        title = f"{keyword.title()} Product {page}-{i}"
+        slug = re.sub(r'[^A-Za-z0-9]+', '-', title)
+        href = f"/{slug}/dp/{asin}/ref=sr_1_{i + 1}?keywords={keyword.replace(' ', '+')}&amp;qid=1&amp;sr=8-{i + 1}"
+        items.append(
+            f'<div class="s-result-item" data-asin="{asin}"><div class="s-product-image-container">'
+            f'<a class="a-link-normal s-no-outline" href="{href}"><img class="s-image" src="{base_url}/images/I/{asin}._AC_UL320_.jpg"></a>'
+            f'</div><h2><span>{html.escape(title)}</span></h2></div>'
+        )
+    next_link = ''
+    if page < config.pages:
+        next_link = f'<a class="s-pagination-item s-pagination-next" href="/s?k={keyword.replace(" ", "+")}&amp;page={page + 1}">Next</a>'
+    return (f'<html><head><title>Amazon.com : {html.escape(keyword)}</title></head><body>'
+            f'<div class="s-main-slot">{"".join(items)}</div><span class="s-pagination-strip">{next_link}</span></body></html>')
+
+
+def detail_page(base_url, asin, config):
+    title = f"Mock Product {asin}"
+    variations = {make_asin(asin, c): [COLORS[c % len(COLORS)]] for c in range(config.variations)}
+    color_images = {var_asin: [{'variant': 'MAIN', 'hiRes': f"{base_url}/images/I/{var_asin}._AC_SL1500_.jpg",
+                                'large': f"{base_url}/images/I/{var_asin}._AC_SL500_.jpg"}] for var_asin in variations}
+    variation_json = json.dumps({'dimensionValuesDisplayData': variations, 'colorImages': color_images})
+    dynamic_image = html.escape(json.dumps({f"{base_url}/images/I/{asin}._AC_SL1500_.jpg": [1500, 1500],
+                                            f"{base_url}/images/I/{asin}._AC_SL500_.jpg": [500, 500]}))
+    return (f'<html><head><title>Amazon.com: {title}</title></head><body><div id="dp-container">'
+            f'<h1 id="title"><span id="productTitle">  {title}  </span></h1>'
+            f'<div id="imgTagWrapperId"><img id="landingImage" src="{base_url}/images/I/{asin}._AC_SX425_.jpg" data-a-dynamic-image="{dynamic_image}"></div>'
+            f'<div id="variation_color_name"><ul>{"".join(f"<li data-asin={a}>{c[0]}</li>" for a, c in variations.items())}</ul></div>'
+            f"</div><script>var dataToReturn = jQuery.parseJSON('{variation_json}');</script></body></html>")
+
+
+class MockAmazonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config = None # 由 make_server 设置
+
+    def _send(self, status, body, content_type='text/html; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD': self.wfile.write(body)
+
+    def do_GET(self):
+        config = self.config
+        parsed = urlparse(self.path)
+        base_url = f"http://{self.headers.get('Host', '%s:%s' % self.server.server_address)}"
+        config.delay()
+        if config.roll(config.error_rate):
+            config.count('error'); return self._send(503, b'<html><head><title>Service Unavailable</title></head></html>')
+        if parsed.path.startswith('/images/'):
+            config.count('image'); return self._send(200, IMAGE_BYTES, 'image/jpeg')
+        if parsed.path == '/s' or ASIN_RE.search(parsed.path):
+            if config.roll(config.captcha_rate):
+                config.count('captcha'); return self._send(200, CAPTCHA_HTML.encode())
+        if parsed.path == '/s':
+            query = parse_qs(parsed.query)
+            keyword = query.get('k', [''])[0]; page = int(query.get('page', ['1'])[0])
+            config.count('search')
+            return self._send(200, search_page(base_url, keyword, page, config).encode())
+        match = ASIN_RE.search(parsed.path)
+        if match:
+            config.count('detail')
+            return self._send(200, detail_page(base_url, match.group(1), config).encode())
+        config.count('not_found')
+        self._send(404, b'<html><head><title>Page Not Found</title></head></html>')
+
+    do_HEAD = do_GET
+
+    def log_message(self, *args): pass
+
+
+class ForwardProxyHandler(BaseHTTPRequestHandler):
+    """最简正向代理：支持 CONNECT 隧道 (预检 / HTTPS) 和绝对 URI 的 GET。"""
+    protocol_version = 'HTTP/1.1'
+    config = None
+
+    def do_CONNECT(self):
+        self.config.count('proxy_connect')
+        host, _, port = self.path.rpartition(':')
+        try:
+            upstream = socket.create_connection((host, int(port)), timeout=10)
+        except OSError:
+            self.send_error(502); return
+        self.send_response(200, 'Connection Established'); self.end_headers()
+        sockets = [self.connection, upstream]
+        try:
+            while True:
+                readable, _, errored = select.select(sockets, [], sockets, 30)
+                if errored or not readable: break
+                for sock in readable:
+                    data = sock.recv(65536)
+                    if not data: return
+                    (upstream if sock is self.connection else self.connection).sendall(data)
+        finally:
+            upstream.close()
+            self.close_connection = True
+
+    def do_GET(self):
+        self.config.count('proxy_get')
+        target = urlparse(self.path)
+        if not target.hostname:
+            self.send_error(400); return
+        conn = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=30)
+        try:
+            headers = {k: v for k, v in self.headers.items() if k.lower() not in ('proxy-authorization', 'proxy-connection', 'connection')}
+            conn.request('GET', target.path + (f"?{target.query}" if target.query else ''), headers=headers)
+            upstream = conn.getresponse(); body = upstream.read()
+        except OSError:
+            self.send_error(502); return
+        finally:
+            conn.close()
+        self.send_response(upstream.status)
+        for key, value in upstream.getheaders():
+            if key.lower() not in ('transfer-encoding', 'connection', 'content-length'): self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): pass
+
+
+def make_server(handler_cls, config, host='127.0.0.1', port=0):
+    handler = type(handler_cls.__name__, (handler_cls,), {'config': config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_servers(config, port=0, proxy_port=None):
+    """在后台线程中启动模拟服务器 (以及代理)，返回 (server, proxy_server 或 None)。"""
+    server = make_server(MockAmazonHandler, config, port=port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    proxy = None
+    if proxy_port is not None:
+        proxy = make_server(ForwardProxyHandler, config, port=proxy_port)
+        threading.Thread(target=proxy.serve_forever, daemon=True).start()
+    return server, proxy
+
+
+def add_config_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.3, help="平均响应延迟 (秒)")
+    parser.add_argument('--jitter', type=float, default=0.5)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="返回 503 的比例")
+    parser.add_argument('--captcha-rate', type=float, default=0.0, help="返回 CAPTCHA 页面的比例")
+    parser.add_argument('--pages', type=int, default=5, help="搜索结果翻页深度")
+    parser.add_argument('--results', type=int, default=16, help="每页商品数")
+    parser.add_argument('--variations', type=int, default=3, help="每个商品的颜色变体数")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def config_from_args(args):
+    return MockConfig(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, captcha_rate=args.captcha_rate,
+                      pages=args.pages, results=args.results, variations=args.variations, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Amazon server")
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--proxy-port', type=int, default=None, help="同时启动本地正向代理")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    config = config_from_args(args)
+    server, proxy = start_servers(config, port=args.port, proxy_port=args.proxy_port)
+    print(f"mock amazon: http://127.0.0.1:{server.server_address[1]}" + (f"  proxy: http://127.0.0.1:{proxy.server_address[1]}" if proxy else ''))
+    try:
+        while True:
+            time.sleep(10)
+            print(dict(config.counts))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        if proxy: proxy.shutdown()
+
+
+if __name__ == '__main__':
+    main()
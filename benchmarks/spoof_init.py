@@ -0,0 +1,80 @@
+# 指纹覆盖注入方式基准测试
+# Fingerprint override injection benchmark
+#
+# 比较两种方式在 N 次导航中的耗时，以及页面脚本首次读取 navigator.language 时是否已被覆盖：
+#   evaluate : 旧方式，每个页面 goto 之后再 PageMethod('evaluate', spoof_js) (多一次 CDP 往返，且执行太晚)
+#   init     : 新方式，每个上下文注册一次 add_init_script，所有页面继承
+#
+# 用法 (Usage):
+#     python benchmarks/spoof_init.py [--pages 50] [--headed]
+# 需要已安装 Playwright 浏览器 (playwright install chromium)。
+
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from playwright.async_api import async_playwright
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from amazonko.fingerprint import build_spoof_script
+
+LOCALE, TIMEZONE_ID = 'de-DE', 'Europe/Berlin' # 与浏览器默认值不同，便于判断覆盖是否生效
+
+# 页面内联脚本在解析时记录 navigator.language (模拟站点脚本读取语言)
+PAGE_HTML = b"""<html><head><title>bench</title>
+<script>window.__seenLanguage = navigator.language;</script></head>
+<body><div id="dp-container">ok</div></body></html>"""
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200); self.send_header('Content-Type', 'text/html'); self.send_header('Content-Length', str(len(PAGE_HTML)))
+        self.end_headers(); self.wfile.write(PAGE_HTML)
+
+    def log_message(self, *args): pass
+
+
+async def run_mode(browser, mode, url, pages):
+    context = await browser.new_context()
+    # 旧实现的 evaluate 使用函数表达式；init script 使用立即执行的脚本
+    evaluate_js = "() => {" + build_spoof_script(LOCALE, TIMEZONE_ID) + "}"
+    start = time.perf_counter()
+    if mode == 'init': await context.add_init_script(script=build_spoof_script(LOCALE, TIMEZONE_ID))
+    spoofed_early = 0
+    for i in range(pages):
+        page = await context.new_page()
+        await page.goto(f"{url}?p={i}", wait_until='domcontentloaded')
+        if mode == 'evaluate': await page.evaluate(evaluate_js)
+        await page.wait_for_selector('#dp-container', state='attached')
+        if await page.evaluate("window.__seenLanguage") == LOCALE: spoofed_early += 1
+        await page.close()
+    elapsed = time.perf_counter() - start
+    await context.close()
+    print(f"{mode:<9} pages={pages:>4}  total={elapsed:7.2f}s  per-page={elapsed / pages * 1000:7.1f} ms  "
+          f"language spoofed before page scripts: {spoofed_early}/{pages}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Fingerprint injection benchmark")
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--headed', action='store_true')
+    args = parser.parse_args()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/bench"
+    async with async_playwright() as pw:
+        launch_start = time.perf_counter()
+        browser = await pw.chromium.launch(headless=not args.headed)
+        print(f"browser launch: {time.perf_counter() - launch_start:.2f}s")
+        for mode in ('evaluate', 'init'):
+            await run_mode(browser, mode, url, args.pages)
+        await browser.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())